@@ -48,6 +48,95 @@ def init(ctx):
     DB.from_config(CONFIG)
 
     
+@main.command()
+@click.option('--poll-interval', type=float, default=5., help='seconds between index progress checks')
+@click.pass_context
+def migrate_views(ctx, poll_interval):
+    ''' update the design docs, building changed views before swapping them in '''
+    DB.from_config(CONFIG)
+    migrated = DB.migrate_design_docs(poll_interval=poll_interval)
+    click.echo(f'migrated design docs: {migrated}')
+
+
+@main.command()
+@click.option('-n', type=int, default=1000, help='documents per document type')
+@click.pass_context
+def benchmark_codec(ctx, n):
+    ''' measure the docs/s of the document serialization '''
+    from app.benchmarks import bench_codec, format_results
+    click.echo(format_results(bench_codec(n)))
+
+
+@main.command()
+@click.option('-n', type=int, default=2000, help='filemaker records')
+@click.option('--patients', type=int, default=500, help='distinct patients of the records')
+@click.option('--repeat', type=int, default=3, help='runs, the median is reported')
+@click.pass_context
+def benchmark_ingest(ctx, n, patients, repeat):
+    ''' measure the ingest and aggregation on the in-process couchdb stand-in '''
+    from app.benchmarks import bench_ingest, format_stage_results
+    click.echo(format_stage_results(bench_ingest(n, patients, repeat)))
+
+
+@main.command()
+@click.option('-n', type=int, default=10000, help='filemaker records')
+@click.option('--patients', type=int, default=2000, help='distinct patients of the records')
+@click.option('--latency', type=float, default=0., help='seconds every filemaker request takes')
+@click.option('--error-rate', type=float, default=0., help='fraction of failing filemaker requests')
+@click.option('--prefetch', type=int, default=4, help='filemaker pages fetched ahead')
+@click.option('--mode', type=click.Choice(['offset', 'delta']), default='offset', help='filemaker sync mode')
+@click.option('--stream/--no-stream', default=True, help='decode the records one by one while they arrive')
+@click.pass_context
+def benchmark_filemaker_sync(ctx, n, patients, latency, error_rate, prefetch, mode, stream):
+    ''' measure a full filemaker sync from a local stand-in server '''
+    from app.benchmarks import bench_filemaker_sync, format_stage_results
+    results = bench_filemaker_sync(n, patients, latency, error_rate, prefetch, mode, stream)
+    click.echo(format_stage_results(results))
+    click.echo(f"filemaker requests: {results['requests']}")
+
+
+@main.command()
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', type=int, default=8081)
+@click.option('-n', type=int, default=100000, help='filemaker records')
+@click.option('--patients', type=int, default=20000, help='distinct patients of the records')
+@click.option('--latency', type=float, default=0., help='seconds every request takes')
+@click.option('--error-rate', type=float, default=0., help='fraction of failing requests')
+@click.pass_context
+def filemaker_standin(ctx, host, port, n, patients, latency, error_rate):
+    ''' serve synthetic records like the filemaker data api, user and password are user and psw '''
+    from app.filemaker_standin import FilemakerStandin
+    standin = FilemakerStandin(n, patients, latency=latency, error_rate=error_rate)
+    standin.app().run(host=host, port=port, threaded=True)
+
+
+@main.command()
+@click.option('--threshold', type=float, default=0.7, help='minimum score of a suggested pair')
+@click.pass_context
+def suggest_patient_merges(ctx, threshold):
+    ''' queue the patients that are probably the same person for review '''
+    from app.linkage import suggest_patient_merges, merge_suggestions
+    DB.from_config(CONFIG)
+    new = suggest_patient_merges(DB, threshold=threshold)
+    click.echo(f'{len(new)} new merge suggestions')
+    for s in merge_suggestions(DB):
+        click.echo(f"{s.score:.3f} {' '.join(s.patients)} {s.similarities}")
+
+
+@main.command()
+@click.pass_context
+def watch_sequencer_output(ctx):
+    ''' hand new and changed sequencer runs to the workers as soon as they are written '''
+    from app.tasks import sync_sequencer_output, sync_sequencer_runs
+    from app.sequencer_scan import SequencerWatcher
+    mq.conf.update(**CONFIG.celery_config)
+    # catch up with the runs that changed while nobody watched
+    sync_sequencer_output.delay()
+    watcher = SequencerWatcher(CONFIG['miseq_output_folder'], sync_sequencer_runs.delay,
+            settle=CONFIG['sequencer_watch_settle'])
+    watcher.run()
+
+
 @main.command()
 @click.pass_context
 def run(ctx):
@@ -0,0 +1,217 @@
+import json
+import time
+import random
+from copy import deepcopy
+from datetime import datetime
+from statistics import median
+
+from app.model import Examination, SequencerRun, PipelineRun, filemaker_examination_types
+from app.parsers import parse_date
+from app.codec import dump_document, load_document
+from app.config import Config
+from app.db_memory import MEMORY_COUCH
+from app.fingerprints import FingerprintIndex
+from app.filemaker_standin import synthetic_record, FilemakerStandin, StandinServer
+
+''' benchmarks of hot paths, run them with the benchmark-* cli commands
+
+the database benchmarks use the in-process couchdb stand-in of app.db_memory,
+so they run without services and only measure our side of the requests
+'''
+
+
+def _filemaker_record(i):
+    ''' a filemaker record with the size of a real one, examinations embed it '''
+    d = {f'Feld_{k}': f'wert {k} von record {i}' for k in range(120)}
+    d.update({
+        'Untersuchung': 'DNA Panel ONCOHS',
+        'Zeitstempel': '01/02/2023',
+        'Name': 'Mustermann',
+        'Vorname': 'Erika',
+        'GBD': '01/01/1970',
+        })
+    return d
+
+
+def sample_documents(n=1000):
+    ''' n models of each type that is benchmarked '''
+    now = datetime(2023, 1, 2, 3, 4, 5)
+    samples = {
+        'examination': [
+            Examination(
+                id=f'exam{i}',
+                examinationtype='DNA Panel ONCOHS',
+                started_date=now,
+                sequencer_runs=[f'run{i}'],
+                pipeline_runs=[],
+                filemaker_record=_filemaker_record(i),
+                last_sync_time=now,
+                ) for i in range(n)],
+        'sequencer_run': [
+            SequencerRun(
+                id=f'run{i}',
+                original_path=f'/data/runs/230102_M00001_{i:04d}_000000000-ABCDE',
+                name_dirty=False,
+                parsed={'date': '230102', 'device': 'M00001', 'run_number': i},
+                indexed_time=now,
+                outputs=[f'/data/runs/run{i}/sample{k}_S{k}_L001_R1_001.fastq.gz' for k in range(24)],
+                ) for i in range(n)],
+        'pipeline_run': [
+            PipelineRun(
+                id=f'prun{i}',
+                created_time=now,
+                input_samples=[f'/data/runs/run{i}/sample{k}_S{k}_L001_R1_001.fastq.gz' for k in range(24)],
+                workflow='test',
+                panel_type='NGS oncoHS',
+                status='successful',
+                logs={'stdout': 'x' * 1000, 'stderr': ''},
+                ) for i in range(n)],
+        }
+    return samples
+
+
+def _docs_per_second(fn, xs, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for x in xs:
+            fn(x)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return len(xs) / best
+
+
+def bench_codec(n=1000, repeat=3):
+    ''' docs/s of the old and the new serialization and deserialization
+
+    returns {document_type: {'dump_before', 'dump_after', 'load_before', 'load_after'}}
+    '''
+    results = {}
+    for doctype, models in sample_documents(n).items():
+        cls = type(models[0])
+        docs = [dump_document(m) for m in models]
+
+        results[doctype] = {
+            'dump_before': _docs_per_second(lambda m: json.loads(m.model_dump_json()), models, repeat),
+            'dump_after': _docs_per_second(dump_document, models, repeat),
+            'load_before': _docs_per_second(lambda d: cls(**d), docs, repeat),
+            'load_after': _docs_per_second(lambda d: load_document(cls, d), docs, repeat),
+            }
+    return results
+
+
+def format_results(results):
+    lines = [f"{'document':<16}{'op':<8}{'before docs/s':>16}{'after docs/s':>16}{'speedup':>10}"]
+    for doctype, r in results.items():
+        for op in ['dump', 'load']:
+            before, after = r[f'{op}_before'], r[f'{op}_after']
+            lines.append(f'{doctype:<16}{op:<8}{before:>16.0f}{after:>16.0f}{after/before:>9.1f}x')
+    return '\n'.join(lines)
+
+
+class StaticFilemaker:
+    ''' serves generated records like the filemaker data api '''
+    def __init__(self, records):
+        self.records = records
+
+    def get_all_records(self, offset, limit=1000):
+        # filemaker offsets start at 1, offsets after the last record
+        # give an empty page like Filemaker.get_all_records
+        return {'data': self.records[offset-1:offset-1+limit]}
+
+    def get_new_records_by_date(self, day, month, year, examination_types=filemaker_examination_types, limit=1000, offset=1, field='Zeitstempel'):
+        ''' like the filemaker _find of Filemaker.get_new_records_by_date '''
+        since = datetime(int(year), int(month), int(day))
+        found = [r for r in self.records
+                if r['fieldData']['Untersuchung'] in examination_types
+                and parse_date(r['fieldData'][field]) >= since]
+        found.sort(key=lambda r: parse_date(r['fieldData'][field]))
+        return {'data': found[offset-1:offset-1+limit]}
+
+
+def filemaker_records(n, patients, seed=0):
+    ''' n reproducible filemaker records of examinations of the given number of patients '''
+    return [synthetic_record(i, patients, seed) for i in range(n)]
+
+
+def memory_config():
+    config = Config()
+    config.set(dev=True, overrides={'couchdb_backend': 'memory'})
+    return config
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def bench_ingest(n=2000, patients=500, repeat=3, seed=0):
+    ''' seconds and docs/s of the filemaker ingest, examination creation and
+    patient aggregation on an empty memory database, the median of repeat runs
+    '''
+    from app import tasks_impl
+
+    records = filemaker_records(n, patients, seed)
+    stages = {'ingest': [], 'create_examinations': [], 'aggregate_patients': []}
+
+    for _ in range(repeat):
+        MEMORY_COUCH.reset()
+        tasks_impl.DB.init_db(memory_config())
+
+        # processor modifies the records
+        filemaker = StaticFilemaker(deepcopy(records))
+        index = FingerprintIndex.open(tasks_impl.DB)
+        stages['ingest'].append(_timed(lambda: tasks_impl.retrieve_new_filemaker_data_incremental(
+            filemaker, tasks_impl.processor, index, backoff_time=0)))
+        stages['create_examinations'].append(_timed(tasks_impl.create_examinations))
+        stages['aggregate_patients'].append(_timed(tasks_impl.aggregate_patients))
+
+    return {stage: {'seconds': median(ts), 'docs_per_second': n / median(ts)} for stage, ts in stages.items()}
+
+
+def bench_filemaker_sync(n=10000, patients=2000, latency=0., error_rate=0., prefetch=4, mode='offset', stream=True, seed=0):
+    ''' seconds and records/s of a full sync from the local filemaker stand-in
+    into an empty memory database, and of the examination creation and
+    patient aggregation of the synced records
+
+    unlike bench_ingest the records go through http and app.filemaker_api,
+    so the prefetching and the rate control are measured too
+    '''
+    from app import tasks_impl
+    from app.filemaker_api import Filemaker, new_records_query
+
+    MEMORY_COUCH.reset()
+    tasks_impl.DB.init_db(memory_config())
+
+    standin = FilemakerStandin(n, patients, seed, latency, error_rate)
+    if mode == 'delta':
+        retrieve = tasks_impl.retrieve_new_filemaker_data_delta
+        # build the find index before the clock starts, like filemakers own
+        retrieve_n = len(standin.find(new_records_query(1, 1, 1970), [{'fieldName': 'Zeitstempel', 'sortOrder': 'ascend'}]))
+    else:
+        retrieve = tasks_impl.retrieve_new_filemaker_data_incremental
+        retrieve_n = n
+
+    index = FingerprintIndex.open(tasks_impl.DB)
+    with StandinServer(standin) as server:
+        with Filemaker(server.address, standin.user, standin.psw, standin.database, standin.layout,
+                pool_size=prefetch, scheme='http') as filemaker:
+            seconds = {'sync': _timed(lambda: retrieve(filemaker, tasks_impl.processor, index, prefetch=prefetch, stream=stream))}
+
+    seconds['create_examinations'] = _timed(tasks_impl.create_examinations)
+    seconds['aggregate_patients'] = _timed(tasks_impl.aggregate_patients)
+
+    synced = len(tasks_impl.DB.all_docs(startkey='filemaker_record_row_', endkey='filemaker_record_row_\ufff0').ids())
+    results = {stage: {'seconds': t, 'docs_per_second': synced / t} for stage, t in seconds.items()}
+    results['sync']['docs_per_second'] = retrieve_n / seconds['sync']
+    results['requests'] = {'total': standin.requests, 'errors': standin.errors, 'synced': synced}
+    return results
+
+
+def format_stage_results(results):
+    lines = [f"{'stage':<24}{'seconds':>10}{'docs/s':>12}"]
+    for stage, r in results.items():
+        if 'seconds' in r:
+            lines.append(f"{stage:<24}{r['seconds']:>10.3f}{r['docs_per_second']:>12.0f}")
+    return '\n'.join(lines)
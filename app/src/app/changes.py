@@ -0,0 +1,115 @@
+from celery.utils.log import get_task_logger
+
+from app.db import NotFound, _wrap
+
+''' incremental processing of the documents that changed since the last run '''
+
+logger = get_task_logger(__name__)
+
+# number of changes that are read and dispatched at once
+CHANGES_BATCH_SIZE = 1000
+
+
+class ChangesConsumer:
+    '''
+    durable consumer of the couchdb _changes feed
+
+    handlers are registered per document type and are called with a list of
+    the wrapped documents of that type that changed since the last run.
+    the sequence up to which the changes were handled is checkpointed in the
+    document 'changes_checkpoint_<name>', so every consumer name sees every
+    change once, even across restarts
+
+    the checkpoint is only advanced after all handlers of a batch succeeded,
+    handlers therefore have to be idempotent, a failed batch is handled again
+    '''
+
+    def __init__(self, db, name, batch_size=CHANGES_BATCH_SIZE):
+        self.db = db
+        self.name = name
+        self.batch_size = batch_size
+        self.checkpoint_id = f'changes_checkpoint_{name}'
+        self.handlers = {}
+
+    def register(self, document_type, handler=None):
+        ''' register a handler for a document type, can be used as decorator '''
+        def add(fn):
+            self.handlers.setdefault(document_type, []).append(fn)
+            return fn
+
+        if handler is None:
+            return add
+        return add(handler)
+
+    def _load_checkpoint(self):
+        try:
+            return self.db.get(self.checkpoint_id, cached=False)
+        except NotFound:
+            return {'id': self.checkpoint_id, 'last_seq': 0}
+
+    def skip_to(self, seq):
+        ''' checkpoint seq without handling the changes before it,
+        for callers that processed the documents another way
+        '''
+        checkpoint = self._load_checkpoint()
+        checkpoint['last_seq'] = seq
+        self.db.save(checkpoint)
+
+    def advance(self, document_types):
+        ''' move the checkpoint to the end of the feed without reading the
+        changes, for callers that only need to know if something changed.
+        returns True if documents of document_types changed since the checkpoint
+        '''
+        checkpoint = self._load_checkpoint()
+        # changes after the end of the feed are found again by the next call
+        end = self.db.changes(since='now', limit=0)['last_seq']
+        result = self.db.changes(
+                since=checkpoint['last_seq'],
+                limit=1,
+                selector={'document_type': {'$in': list(document_types)}},
+                )
+        if end != checkpoint['last_seq']:
+            checkpoint['last_seq'] = end
+            self.db.save(checkpoint)
+        return len(result['results']) > 0
+
+    def run_once(self):
+        ''' dispatch one batch of changes, returns the number of changed documents '''
+        checkpoint = self._load_checkpoint()
+        selector = {'document_type': {'$in': list(self.handlers.keys())}}
+
+        result = self.db.changes(
+                since=checkpoint['last_seq'],
+                limit=self.batch_size,
+                include_docs=True,
+                selector=selector,
+                )
+
+        changed = {}
+        for change in result['results']:
+            doc = change.get('doc')
+            if change.get('deleted', False) or doc is None:
+                continue
+            changed.setdefault(doc['document_type'], []).append(_wrap(doc))
+
+        for document_type, docs in changed.items():
+            for handler in self.handlers[document_type]:
+                handler(docs)
+
+        if result['last_seq'] != checkpoint['last_seq']:
+            checkpoint['last_seq'] = result['last_seq']
+            self.db.save(checkpoint)
+
+        return len(result['results'])
+
+    def run(self):
+        ''' dispatch batches until all changes are handled, returns the number of changes '''
+        total = 0
+        while True:
+            n = self.run_once()
+            total += n
+            if n < self.batch_size:
+                break
+
+        logger.info(f'changes consumer {self.name} handled {total} changes')
+        return total
@@ -0,0 +1,140 @@
+from typing import Union, get_origin, get_args
+from functools import lru_cache
+from datetime import datetime
+from pathlib import Path
+
+from pydantic import BaseModel
+
+try:
+    from types import UnionType
+except ImportError:
+    # python < 3.10 has no X | Y annotations
+    UnionType = Union
+
+''' conversion between documents and the pydantic models without redundant work '''
+
+
+def dump_document(obj: BaseModel) -> dict:
+    ''' a json compatible dict of the model, in a single pass
+
+    equivalent to json.loads(obj.model_dump_json()), but without
+    encoding and parsing the json string
+    '''
+    return obj.model_dump(mode='json')
+
+
+def _identity(x):
+    return x
+
+
+def _optional(conv):
+    def convert(x):
+        if x is None:
+            return None
+        return conv(x)
+    return convert
+
+
+def _list_of(conv):
+    def convert(xs):
+        return list(map(conv, xs))
+    return convert
+
+
+def _datetime(x):
+    if isinstance(x, datetime):
+        return x
+    return datetime.fromisoformat(x)
+
+
+# constructing a Path costs more than validating the rest of a document,
+# paths are immutable and the same fastq paths are referenced by sequencer
+# runs and pipeline runs and read again and again, so they are interned
+_path = lru_cache(maxsize=64*1024)(Path)
+
+
+def _model(cls):
+    def convert(x):
+        if isinstance(x, cls):
+            return x
+        return construct_trusted(cls, x)
+    return convert
+
+
+def _converter(annotation):
+    ''' a function that turns the json value of a field back into its python type
+
+    only the types our documents use are converted, other values are kept as they are
+    '''
+    origin = get_origin(annotation)
+
+    if origin in (Union, UnionType):
+        args = [a for a in get_args(annotation) if a is not type(None)]
+        if len(args) == 1:
+            return _optional(_converter(args[0]))
+        # unions of several types need the validator to choose
+        raise TypeError(f'cant convert union {annotation} without validation')
+    elif origin is list:
+        args = get_args(annotation)
+        conv = _converter(args[0]) if len(args) == 1 else _identity
+        return _identity if conv is _identity else _list_of(conv)
+    elif origin is not None:
+        # dict, Literal
+        return _identity
+    elif annotation is datetime:
+        return _datetime
+    elif isinstance(annotation, type) and issubclass(annotation, Path):
+        return _path
+    elif isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return _model(annotation)
+    else:
+        return _identity
+
+
+_field_converters = {}
+
+def _field_converters_of(cls):
+    if cls not in _field_converters:
+        converters = {}
+        for name, field in cls.model_fields.items():
+            conv = _converter(field.annotation)
+            if conv is not _identity:
+                converters[name] = conv
+        required = {name for name, field in cls.model_fields.items() if field.is_required()}
+        _field_converters[cls] = (converters, required)
+    return _field_converters[cls]
+
+
+def construct_trusted(cls, d: dict):
+    ''' build the model from a document that was written by dump_document
+
+    skips the validation with model_construct, only the field types that json
+    cant represent (datetime, path, nested models) are converted back.
+    raises a ValueError if the document misses required fields
+    '''
+    converters, required = _field_converters_of(cls)
+
+    missing = required - d.keys()
+    if len(missing) > 0:
+        raise ValueError(f'document {d.get("id")} misses the fields {missing}')
+
+    values = dict(d)
+    for name, conv in converters.items():
+        if name in values:
+            values[name] = conv(values[name])
+
+    return cls.model_construct(**values)
+
+
+def load_document(cls, d: dict, trusted=True):
+    ''' build the model from a document of our database
+
+    trusted documents of the current data model version are constructed
+    without validation, all others or ones that dont fit are validated
+    '''
+    if trusted and d.get('data_model_version') == cls.model_fields['data_model_version'].default:
+        try:
+            return construct_trusted(cls, d)
+        except (TypeError, ValueError):
+            pass
+    return cls(**d)
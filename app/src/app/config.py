@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Optional, Literal
 from pathlib import Path
 from pydantic import BaseModel
 
@@ -41,12 +41,50 @@ class ConfigParams(BaseModel):
     workflow_output_dir: str
     backend: str = 'noop'
 
+    # connections per process to couchdb, kept alive between requests
+    couchdb_pool_size: int = 10
+    # seconds until a couchdb request times out
+    couchdb_timeout: float = 60.
+    # request gzip compressed responses from couchdb
+    couchdb_gzip: bool = True
+
+    # 'memory' keeps the database in the process instead of
+    # talking to couchdb, for tests and benchmarks, see app.db_memory
+    couchdb_backend: Literal['couchdb', 'memory'] = 'couchdb'
+
+    # cache documents of Db.get in each process, see app.db_cache
+    couchdb_cache: bool = False
+    couchdb_cache_entries: int = 1000
+    couchdb_cache_bytes: int = 64*1024*1024
+    # 'changes' polls the _changes feed, 'rev' checks the _rev of every hit
+    couchdb_cache_validation: Literal['changes', 'rev'] = 'changes'
+    # seconds the warm_views task follows the view indexing, the indexing
+    # continues in couchdb afterwards, but no worker waits for it
+    couchdb_warm_views_timeout: float = 30*60.
+
+    # 'offset' scans the filemaker table by record id, 'delta' only fetches
+    # the records of the examination types since the last synced date
+    filemaker_sync_mode: Literal['offset', 'delta'] = 'offset'
+    # local file of the fingerprints of the synced filemaker records,
+    # it is rebuilt from the database if it is missing, see app.fingerprints
+    filemaker_fingerprint_index: Optional[str] = '/tmp/ngs_pipeline/filemaker_fingerprints.idx'
+    # filemaker pages that are fetched ahead while one is saved
+    filemaker_prefetch_pages: int = 4
+    # seconds of a filemaker response, above it the requests are slowed down
+    filemaker_target_latency: float = 2.
+
+    # local file of the fastqs and folder mtimes of the scanned sequencer runs,
+    # unchanged run folders arent walked again, see app.sequencer_scan
+    sequencer_scan_index: Optional[str] = '/tmp/ngs_pipeline/sequencer_scan.json'
+    # seconds without changes before the watcher hands a run to the ingest
+    sequencer_watch_settle: float = 5.
+
     # local path to clc ImportExport dir
-    clc_import_export_dir: Optional[str]
+    clc_import_export_dir: Optional[str] = None
     # clc path to clc inputs (clc_serverfile format to inportexport dir)
-    clc_input_dir: Optional[str]
+    clc_input_dir: Optional[str] = None
     # clc path to where clc outputs should be stored (clc object format)
-    clc_output_dir: Optional[str]
+    clc_output_dir: Optional[str] = None
 
 
 class Config:
@@ -56,7 +94,7 @@ class Config:
     def __init__(self):
         pass
 
-    def set(self, dev: bool=False, path:Path=None):
+    def set(self, dev: bool=False, path:Path=None, overrides: Optional[dict]=None):
         if self._is_set:
             raise RuntimeError('config is already set and should not be overwritten')
 
@@ -73,6 +111,9 @@ class Config:
             with p.open('r') as f:
                 cfg = json.loads(f.read())
 
+        if overrides is not None:
+            cfg = dict(cfg, **overrides)
+
         self._params = ConfigParams(**cfg)
 
     def __contains__(self, k):
@@ -1,12 +1,39 @@
 from textwrap import indent
 import requests
 import pycouchdb as couch
+from pycouchdb.resource import Resource
 import json
+import time
+import threading
+from urllib.parse import parse_qsl
+from uuid import uuid4
+
+from celery.utils.log import get_task_logger
 
 from app.model import *
+from app.db_pool import PooledSession
+from app.db_cache import DocumentCache
+from app.codec import dump_document, load_document
+from app.db_memory import MemoryAdapter, MEMORY_COUCH, MEMORY_URL
+from app.db_bulk import BulkWriter, BulkWriteStats, BULK_WRITE_BATCH_SIZE
+from app.tasks_utils import Timeout
 
 NotFound = couch.exceptions.NotFound
 
+logger = get_task_logger(__name__)
+
+# maximum number of ids that are sent in one _all_docs request
+BULK_CHUNK_SIZE = 1000
+
+# number of rows that are fetched per request when lazily paging through a view
+VIEW_PAGE_SIZE = 1000
+
+# number of key ranges that are sent in one multiple queries request of a view
+VIEW_QUERIES_BATCH_SIZE = 100
+
+# if more documents changed since the last cache poll, the cache is cleared
+CACHE_CHANGES_LIMIT = 10000
+
 def ind(x):
     ''' hardcoded indent for convenience '''
     return indent(x, "  ")
@@ -56,7 +83,8 @@ class DesignDoc:
             design_doc_views[view.name] = view.functions()
 
         design_doc_dict = {"_id":"_design/"+self.name,
-            "views": design_doc_views
+            "views": design_doc_views,
+            "version": DESIGN_DOCS_VERSION,
             }
         return design_doc_dict
 
@@ -96,6 +124,8 @@ def setup_views(app_db):
         app_state = {
                 '_id': 'app_state',
                 'last_synced_filemaker_row':0,
+                'last_synced_filemaker_date':None,
+                'pending_examinations':0,
                 'sync_running': False
                 }
 
@@ -111,108 +141,87 @@ def setup_views(app_db):
         app_db.save(default_app_settings)
 
 
-    sequencer_map_fn = '''
-    function (doc) {
-      if(doc.document_type){
-        if(doc.document_type == 'sequencer_run')
-          emit(doc.parsed.date, doc);
-          }
-      }
-    '''
+# the views emit only small projections or null as values,
+# query them with include_docs=true when the documents are needed
+# increment the version whenever a view changes, see Db.migrate_design_docs
+DESIGN_DOCS_VERSION = 4
 
-    sample_map_fn = '''
-    function (doc) {
-      if(doc.document_type){
-        if(doc.document_type == 'sample')
-          emit(doc._id, doc);
-          }
+ddocs = []
+
+sequencer_map_fn = '''
+function (doc) {
+  if(doc.document_type){
+    if(doc.document_type == 'sequencer_run')
+      emit(doc.parsed.date, {'original_path': doc.original_path});
       }
-    '''
-    pipeline_map_fn = '''
-    function (doc) {
-      if(doc.document_type){
-        if(doc.document_type == 'pipeline_run')
-          emit(doc.created_time, doc);
-          }
+  }
+'''
+
+sample_map_fn = '''
+function (doc) {
+  if(doc.document_type){
+    if(doc.document_type == 'sample')
+      emit(doc._id, null);
       }
-    '''
+  }
+'''
 
-    filemaker_map_fn = '''
-    function (doc) {
-      if(doc.document_type){
-        if(doc.document_type == 'filemaker_record'){
-          emit([doc._id,0], 0);
-        }
-        else if(doc.document_type == 'examination'){
-          emit([doc.filemaker_record.id,1], 1);
-        }
+pipeline_map_fn = '''
+function (doc) {
+  if(doc.document_type){
+    if(doc.document_type == 'pipeline_run')
+      emit(doc.created_time, {'status': doc.status});
       }
+  }
+'''
+
+filemaker_map_fn = '''
+function (doc) {
+  if(doc.document_type){
+    if(doc.document_type == 'filemaker_record'){
+      emit([doc._id,0], 0);
     }
-    '''
-    filemaker_reduce_fn = '''
-    function (keys, values, rereduce) {
-      return sum(values);
+    else if(doc.document_type == 'examination'){
+      emit([doc.filemaker_record.id,1], 1);
     }
-    '''
-
-
-
-
-    response = app_db.save(
-        {
-            "_id": '_design/sequencer_runs', 
-            'views':
-            {
-            'all':{"map":sequencer_map_fn},
-            }
-        }
-        )
-
-    response = app_db.save(
-        {
-            "_id":'_design/samples', 
-            'views':
-                {
-                'all':{"map":sample_map_fn}
-                }
-        })
-
-    response = app_db.save(
-        {
-            "_id":'_design/pipeline_runs', 
-            'views':
-                {
-                'all':{"map":pipeline_map_fn}
-                }
-        })
-
-    response = app_db.save(
-        {
-            "_id": '_design/filemaker', 
-            'views':
-            {
-            'all':{"map":filemaker_map_fn,
-                   "reduce":filemaker_reduce_fn
-                    },
-            }
-        })
+  }
+}
+'''
+filemaker_reduce_fn = '''
+function (keys, values, rereduce) {
+  return sum(values);
+}
+'''
 
+# the runs of output folders, keyed lookups find the runs that were
+# saved before they had deterministic ids
+sequencer_runs_original_path = basic_view('original_path', 'emit(doc.original_path, null);', doctypes=['sequencer_run'])
 
-ddocs = []
+ddocs.append(DesignDoc('sequencer_runs', [View('all', sequencer_map_fn), sequencer_runs_original_path]).to_dict())
+ddocs.append(DesignDoc('samples', [View('all', sample_map_fn)]).to_dict())
+ddocs.append(DesignDoc('pipeline_runs', [View('all', pipeline_map_fn)]).to_dict())
+ddocs.append(DesignDoc('filemaker', [View('all', filemaker_map_fn, filemaker_reduce_fn)]).to_dict())
+del sequencer_map_fn, sequencer_runs_original_path, sample_map_fn, pipeline_map_fn, filemaker_map_fn, filemaker_reduce_fn
 
 x = '''
-emit(doc.started_date, doc);
+emit(doc.started_date, null);
 '''
 examinations = basic_view('examinations', x, doctypes=['examination'])
 del x
 
 x = '''
-emit(doc._id, 1);
+emit(doc._id, null);
 '''
 
 examinations_count = basic_view('examinations_count', x, reducefn='_count', doctypes=['examination'])
 del x
 
+x = '''
+emit(doc.examinationtype, null);
+'''
+examinations_types = basic_view('types', x, reducefn='_count', doctypes=['examination'])
+del x
+
 x = '''
 for(var i=0; i<doc.sequencer_runs.length; i++) {
   emit(doc.sequencer_runs[i]._id, doc._id);
@@ -223,7 +232,7 @@ del x
 
 x = '''
 if(doc.pipeline_runs.length === 0 && doc.sequencer_runs.length > 0){
-  emit(doc._id, doc);
+  emit(doc._id, null);
 }
 '''
 new_examinations = basic_view('new_examinations', x, doctypes=['examination'])
@@ -244,7 +253,7 @@ const u = [
     'RNA Sarkompanel'
 ];
 if (u.includes(doc.filemaker_record.Untersuchung)){
-    emit([doc.filemaker_record.Jahr, doc.filemaker_record.Mol_NR], doc);
+    emit([doc.filemaker_record.Jahr, doc.filemaker_record.Mol_NR], null);
 }
 '''
 examinations_mp_number = basic_view('mp_number', x, doctypes=['examination'])
@@ -253,6 +262,7 @@ del x
 examinations_ddoc = DesignDoc('examinations', [
     examinations,
     examinations_count,
+    examinations_types,
     examinations_mp_number,
     new_examinations, 
     ]).to_dict()
@@ -261,17 +271,26 @@ ddocs.append(examinations_ddoc)
 
 x = '''
 if(doc.document_type == 'examination'){
-  emit([doc.filemaker_record.Name, doc.filemaker_record.Vorname, doc.filemaker_record.GBD, doc._id], doc._id);
+  // the birthdate as iso date, filemaker records have M/D/YYYY dates
+  // with or without leading zeros, see app.parsers.birthdate_key
+  var gbd = doc.filemaker_record.GBD;
+  var m = /^([0-9]{1,2})[/]([0-9]{1,2})[/]([0-9]{4})$/.exec(gbd || '');
+  if(m){
+    gbd = m[3] + '-' + ('0' + m[1]).slice(-2) + '-' + ('0' + m[2]).slice(-2);
+    }
+  emit([doc.filemaker_record.Name, doc.filemaker_record.Vorname, gbd, doc._id], null);
   }
 if(doc.document_type == 'patient'){
-  emit([doc.names.firstname, doc.names.lastname, doc.birthdate, doc._id], doc._id);
+  // same key as the examinations, the birthdate is stored as iso date
+  var b = doc.birthdate || '';
+  emit([doc.names.lastname, doc.names.firstname, b.substr(0,10), doc._id], null);
   }
 '''
 patient_aggregation = basic_view('patient_aggregation', x)
 del x
 
 x = '''
-emit(doc._id, doc);
+emit(doc._id, null);
 '''
 patient = basic_view('patients', x, doctypes=['patient'])
 del x
@@ -280,14 +299,69 @@ patients_ddoc = DesignDoc('patients', [patient_aggregation, patient]).to_dict()
 ddocs.append(patients_ddoc)
 
 
-def _get_db_url(config):
-    user = config['couchdb_user']
-    psw = config['couchdb_psw']
+# json indexes for mango queries (_find), they are created by init_db and
+# migrate_design_docs and cover ad-hoc lookups without writing a map function
+mango_indexes = [
+    {
+        'name': 'examinations-mol-nr',
+        'fields': ['filemaker_record.Jahr', 'filemaker_record.Mol_NR'],
+        'partial_filter_selector': {'document_type': 'examination'},
+    },
+    {
+        'name': 'examinations-started-date',
+        'fields': ['started_date'],
+        'partial_filter_selector': {'document_type': 'examination'},
+    },
+    {
+        'name': 'pipeline-runs-status',
+        'fields': ['status', 'created_time'],
+        'partial_filter_selector': {'document_type': 'pipeline_run'},
+    },
+    {
+        'name': 'patient-merge-suggestions-status',
+        'fields': ['status'],
+        'partial_filter_selector': {'document_type': 'patient_merge_suggestion'},
+    },
+]
+
+
+def examination_selector(mol_nr=None, year=None, started_after=None, started_before=None):
+    ''' mango selector for examinations, uses the indexes above '''
+    selector = {'document_type': 'examination'}
+    if year is not None:
+        selector['filemaker_record.Jahr'] = year
+    if mol_nr is not None:
+        selector['filemaker_record.Mol_NR'] = mol_nr
+
+    started = {}
+    if started_after is not None:
+        started['$gte'] = started_after.isoformat()
+    if started_before is not None:
+        started['$lt'] = started_before.isoformat()
+    if len(started) > 0:
+        selector['started_date'] = started
+
+    return selector
+
+
+def _get_server_url(config):
+    ''' the db url without credentials, they are sent by the pooled session '''
     host = 'localhost'
     port = 5984
-    url = f"http://{user}:{psw}@{host}:{port}"
+    url = f"http://{host}:{port}"
     return url
 
+def _pooled_server(config, pool):
+    ''' create a pycouchdb server that sends its requests through the pool '''
+    if config['couchdb_backend'] == 'memory':
+        url = MEMORY_URL
+        pool.session.mount(url, MemoryAdapter(MEMORY_COUCH))
+    else:
+        url = _get_server_url(config)
+    server = couch.Server(url)
+    server.resource = Resource(url, session=pool.session, timeout=pool.timeout)
+    return server
+
 def map_id(doc):
     id = doc.pop('_id')
     doc['id'] = id
@@ -311,9 +385,12 @@ def unmap_id(doc):
 
 
 
-def _wrap(doc):
+def _wrap(doc, trusted=True):
     ''' if the document type is known, return a 
     datamodel or domainmodel object instead
+
+    documents from our own database are trusted and
+    constructed without validation, see app.codec
     '''
     d = map_id(doc)
     if 'document_type' not in d:
@@ -324,7 +401,31 @@ def _wrap(doc):
         return d
 
     cl = document_class_map[doctype]
-    return cl(**d)
+    return load_document(cl, d, trusted=trusted)
+
+
+class MissingDocument:
+    ''' placeholder that get_bulk returns for ids that dont exist
+    or were deleted, instead of raising NotFound
+    '''
+    def __init__(self, id, reason='not_found'):
+        self.id = id
+        self.reason = reason
+
+    def __bool__(self):
+        return False
+
+    def __eq__(self, other):
+        return isinstance(other, MissingDocument) and (self.id, self.reason) == (other.id, other.reason)
+
+    def __repr__(self):
+        return f"MissingDocument({self.id!r}, reason={self.reason!r})"
+
+
+def chunked(xs, size):
+    ''' split a list into lists of at most size elements '''
+    for i in range(0, len(xs), size):
+        yield xs[i:i+size]
 
 
 class QueryResult:
@@ -354,11 +455,89 @@ class QueryResult:
     def docs(self):
         return [self._wrap(x['doc']) for x in self.rows]
 
+    def key_docs(self):
+        return [(x['key'], self._wrap(x['doc'])) for x in self.rows]
+
     @property
     def rows(self):
         return self._rows
 
 
+class LazyQueryResult(QueryResult):
+    ''' query result that pages through the view while it is iterated
+
+    rows_fn is called for every iteration and returns a new row generator,
+    so every method call issues its own requests, use key_docs() instead of
+    zipping keys() and docs()
+    '''
+    def __init__(self, rows_fn, should_wrap=False):
+        self._rows_fn = rows_fn
+        self._should_wrap = should_wrap
+
+    def to_wrapped(self):
+        return LazyQueryResult(self._rows_fn, should_wrap=True)
+
+    def ids(self):
+        return (x['id'] for x in self.rows)
+
+    def keys(self):
+        return (x['key'] for x in self.rows)
+
+    def values(self):
+        return (self._wrap(x['value']) for x in self.rows)
+
+    def docs(self):
+        return (self._wrap(x['doc']) for x in self.rows)
+
+    def key_docs(self):
+        return ((x['key'], self._wrap(x['doc'])) for x in self.rows)
+
+    def __iter__(self):
+        return self.rows
+
+    @property
+    def rows(self):
+        return self._rows_fn()
+
+
+class FindResult(QueryResult):
+    ''' result of a mango query, the documents are in the doc field of the rows,
+    bookmark continues the query on the next page
+    '''
+    def __init__(self, rows, bookmark=None, warning=None, should_wrap=False):
+        super().__init__(rows, should_wrap=should_wrap)
+        self.bookmark = bookmark
+        self.warning = warning
+
+    def to_wrapped(self):
+        return FindResult(self.rows, self.bookmark, self.warning, should_wrap=True)
+
+    @staticmethod
+    def from_response(result):
+        rows = [{'id': d.get('_id'), 'key': d.get('_id'), 'value': None, 'doc': d} for d in result['docs']]
+        return FindResult(rows, result.get('bookmark'), result.get('warning'))
+
+
+def encode_view_params(params):
+    ''' json encode view parameters that couchdb expects as json '''
+    encoded = {}
+    for k, v in params.items():
+        if k in ('key', 'startkey', 'endkey') or isinstance(v, bool):
+            v = json.dumps(v)
+        encoded[k] = v
+    return encoded
+
+
+def split_view_name(name):
+    ''' split a view name like 'design/view?key=1' into the
+    path of the view and its (still json encoded) query parameters
+    '''
+    name, _, query = name.partition('?')
+    design, view = name.split('/', 1)
+    path = ['_design', design, '_view', view]
+    return path, dict(parse_qsl(query))
+
+
 class Db:
     '''
     class that wraps pycouchdb to extend and adapt functionality
@@ -366,12 +545,20 @@ class Db:
 
     server = None
     couchdb = None
+    pool = None
+    cache = None
+    bulk_stats = None
+    # the batches of create_examinations write from threads
+    _bulk_stats_lock = threading.Lock()
     name = 'ngs_app'
+    _initialized = False
 
     def __init__(self):
         pass
 
     def _check_con(self):
+        if self.pool is not None:
+            self.pool.check_fork()
         if not self._check_initialized():
             raise RuntimeError('trying to connect to uninitialized database')
         if self.server is None:
@@ -380,17 +567,134 @@ class Db:
             raise RuntimeError('trying to connect but Db client is None, ensure db connection was called')
 
     def _check_initialized(self):
-        return self.name in self.server
+        # the database isnt deleted while the app runs,
+        # so only ask the server until it exists once
+        if not self._initialized:
+            self._initialized = self.name in self.server
+        return self._initialized
 
     def __contains__(self, doc_id):
         return doc_id in self.couchdb
 
-    def get(self, *args, **kwargs):
+    def get(self, *args, cached=True, **kwargs):
+        ''' read a document, from the cache if it is enabled
+
+        documents that are read to be modified and saved, like the app state
+        and the checkpoints, are read with cached=False. a stale _rev from the
+        cache would make the save conflict or base it on old state
+        '''
         self._check_con()
+        # only plain lookups of the current revision are cached
+        if cached and self.cache is not None and len(args) == 1 and len(kwargs) == 0:
+            return _wrap(self._get_cached(args[0]))
         return _wrap(self.couchdb.get(*args,**kwargs))
 
-    def get_bulk(self, ids, *args, **kwargs):
-        return [self.get(i) for i in ids]
+    def enable_cache(self, max_entries=1000, max_bytes=64*1024*1024, validation='changes', changes_interval=1.):
+        ''' cache documents read by get in this process, see DocumentCache '''
+        self._check_con()
+        self.cache = DocumentCache(max_entries, max_bytes, validation, changes_interval)
+        if validation == 'changes':
+            _, result = self.couchdb.resource.get('_changes', params={'since': 'now', 'limit': 0})
+            self.cache.apply_changes([], result['last_seq'])
+
+    def disable_cache(self):
+        self.cache = None
+
+    def cache_stats(self):
+        if self.cache is None:
+            return {}
+        return self.cache.stats()
+
+    def _poll_cache_changes(self):
+        ''' invalidate the cached documents that changed in the meantime '''
+        params = {'since': self.cache.last_seq, 'limit': CACHE_CHANGES_LIMIT}
+        _, result = self.couchdb.resource.get('_changes', params=params)
+        changes = result['results']
+        if len(changes) >= CACHE_CHANGES_LIMIT:
+            self.cache.clear()
+            changes = []
+        self.cache.apply_changes([c['id'] for c in changes], result['last_seq'])
+
+    def _get_cached(self, doc_id):
+        cache = self.cache
+        if cache.validation == 'changes' and cache.poll_due():
+            self._poll_cache_changes()
+        elif cache.validation == 'rev' and doc_id in cache:
+            # the etag of a document is its quoted revision
+            try:
+                response, _ = self.couchdb.resource.head(doc_id)
+                etag = response.headers.get('ETag', '').strip('"')
+            except NotFound:
+                etag = None
+            if etag != cache.rev(doc_id):
+                cache.invalidate(doc_id)
+
+        doc = cache.get(doc_id)
+        if doc is None:
+            doc = self.couchdb.get(doc_id)
+            cache.put(doc_id, doc)
+        return doc
+
+    def _invalidate_cached(self, docs):
+        if self.cache is None:
+            return
+        for d in docs:
+            doc_id = d if isinstance(d, str) else d.get('_id')
+            if doc_id is not None:
+                self.cache.invalidate(doc_id)
+
+    def _all_docs_rows(self, ids, chunk_size=BULK_CHUNK_SIZE, include_docs=True):
+        ''' POST the ids in chunks to _all_docs '''
+        for chunk in chunked(list(ids), chunk_size):
+            rows = self.couchdb.all(keys=chunk, include_docs=json.dumps(include_docs), as_list=True)
+            for row in rows:
+                yield row
+
+    def all_docs(self, include_docs=False, **kwargs):
+        ''' read a range of _all_docs, e.g. the documents with a common id prefix '''
+        self._check_con()
+        kwargs = {k: json.dumps(v) if isinstance(v, bool) else v for k, v in kwargs.items()}
+        rows = self.couchdb.all(include_docs=json.dumps(include_docs), as_list=True, **kwargs)
+        return QueryResult(rows)
+
+    def exists_many(self, ids, chunk_size=BULK_CHUNK_SIZE):
+        ''' the subset of ids whose documents exist
+
+        one _all_docs request per chunk instead of a HEAD request per id,
+        deleted documents dont exist
+        '''
+        self._check_con()
+        existing = set()
+        for row in self._all_docs_rows(ids, chunk_size, include_docs=False):
+            if 'error' in row or row['value'].get('deleted', False):
+                continue
+            existing.add(row['id'])
+        return existing
+
+    def _get_bulk_raw(self, ids, chunk_size=BULK_CHUNK_SIZE):
+        ''' the latest unwrapped documents, None for missing or deleted ones '''
+        return [row.get('doc') for row in self._all_docs_rows(ids, chunk_size)]
+
+    def get_bulk(self, ids, chunk_size=BULK_CHUNK_SIZE):
+        ''' fetch many documents with as few requests as possible
+
+        the ids are POSTed in chunks to _all_docs?include_docs=true
+        the result has the same order as ids, missing or deleted documents
+        are returned as MissingDocument instead of raising NotFound
+        '''
+        self._check_con()
+        docs = []
+
+        for row in self._all_docs_rows(ids, chunk_size):
+            if 'error' in row:
+                docs.append(MissingDocument(row['key'], reason=row['error']))
+            elif row.get('doc') is None:
+                # deleted documents are still listed by _all_docs, but without doc
+                docs.append(MissingDocument(row['key'], reason='deleted'))
+            else:
+                docs.append(_wrap(row['doc']))
+
+        return docs
 
     def _obj_to_d(self, obj):
         ''' turn a domainmodel or datamodel object into a dict
@@ -399,9 +703,9 @@ class Db:
         # forbid directly writing _id and _rev to prevent bugs where it isnt properly mapped
 
         if isinstance(obj, BaseDocument):
-            # use json loads and model_dump_json instead of model_dump
-            # because fields like date or path will not be stringified otherwise
-            return unmap_id(json.loads(obj.model_dump_json()))
+            # dump in json mode, because fields like date or path
+            # will not be stringified otherwise
+            return unmap_id(dump_document(obj))
         elif isinstance(obj, dict):
             if '_id' in obj.keys():
                 raise RuntimeError('explicitely setting _id is not allowed, use id instead')
@@ -415,43 +719,389 @@ class Db:
         self._check_con()
         nargs = list(args)
         nargs[0] = self._obj_to_d(args[0])
-        return self.couchdb.save(*nargs,**kwargs)
+        try:
+            return self.couchdb.save(*nargs,**kwargs)
+        finally:
+            # also after a conflict, the next get has to see the current revision
+            self._invalidate_cached([nargs[0]])
 
-    def save_bulk(self, *args, **kwargs):
+    def _post_bulk_docs(self, docs):
+        ''' one _bulk_docs request, returns the result of every document
+
+        the checked resource.post would raise on the first conflicting document,
+        so only failures of the whole request are checked here
+        '''
+        resource = self.couchdb.resource
+        response, results = resource._request_response('POST', '_bulk_docs', data=json.dumps({'docs': docs}))
+        if not isinstance(results, list):
+            resource._check_result(response, results)
+        return results
+
+    def save_bulk(self, objs, batch_size=BULK_WRITE_BATCH_SIZE, merge='raise', retries=3):
+        ''' save many documents in batches of _bulk_docs requests
+
+        couchdb reports conflicts per document, the conflicting documents
+        are refetched and resolved with merge, see app.db_bulk.BulkWriter
+        returns the saved documents with their new _rev
+        raises BulkWriteError if documents couldnt be saved
+        '''
         self._check_con()
-        nargs = list(args)
-        nargs[0] = [self._obj_to_d(o) for o in args[0]]
-        return self.couchdb.save_bulk(*nargs,**kwargs)
+        docs = [self._obj_to_d(o) for o in objs]
+        for d in docs:
+            if '_id' not in d:
+                d['_id'] = uuid4().hex
+
+        writer = BulkWriter(self, batch_size=batch_size, merge=merge, retries=retries)
+        try:
+            return writer.write(docs)
+        finally:
+            self._invalidate_cached(docs)
+            with self._bulk_stats_lock:
+                if self.bulk_stats is None:
+                    self.bulk_stats = BulkWriteStats()
+                self.bulk_stats.add(writer.stats)
+
+    def bulk_write_stats(self):
+        ''' throughput of the bulk writes of the current process '''
+        if self.bulk_stats is None:
+            return BulkWriteStats().dict()
+        return self.bulk_stats.dict()
 
     def delete(self, *args, **kwargs):
         self._check_con()
+        self._invalidate_cached([args[0]])
         return self.couchdb.delete(*args,**kwargs)
 
-    def query(self, *args, fields=['value'], **kwargs):
+    def changes(self, since=0, limit=None, include_docs=False, selector=None):
+        ''' read one batch of the _changes feed
+
+        with a selector couchdb only returns the changes of matching documents
+        '''
         self._check_con()
+        params = {'since': since, 'include_docs': json.dumps(include_docs)}
+        if limit is not None:
+            params['limit'] = limit
+
+        if selector is None:
+            _, result = self.couchdb.resource.get('_changes', params=params)
+        else:
+            params['filter'] = '_selector'
+            data = json.dumps({'selector': selector})
+            _, result = self.couchdb.resource.post('_changes', params=params, data=data)
+        return result
+
+    def query(self, *args, fields=['value'], lazy=False, page_size=VIEW_PAGE_SIZE, stale=False, **kwargs):
+        ''' query a view
+
+        with lazy=True the rows arent loaded at once, instead the view is
+        paged through with page_size rows per request while iterating
+
+        with stale=True the view is read as it is and updated afterwards,
+        interactive reads then dont wait for the indexer during heavy writes
+        '''
+        self._check_con()
+        if stale:
+            kwargs['update'] = 'lazy'
+            kwargs['stable'] = True
+        if lazy:
+            name = args[0]
+            return LazyQueryResult(lambda: self._iter_view(name, page_size, **kwargs))
+
         if 'as_list' not in kwargs.keys():
             kwargs['as_list'] = True
 
+        # couchdb only understands lowercase booleans like include_docs=true
+        kwargs = {k: json.dumps(v) if isinstance(v, bool) and k != 'as_list' else v
+                for k, v in kwargs.items()}
+
         res = self.couchdb.query(*args,**kwargs)
         return QueryResult(res)
 
+    def _iter_view(self, name, page_size, **kwargs):
+        ''' page through a view with startkey/startkey_docid cursors
+
+        one row more than page_size is requested, that row is the cursor
+        for the next page. reduced views have no row ids, but the grouped
+        keys are unique, so the startkey is enough for them
+        '''
+        if 'keys' in kwargs:
+            raise RuntimeError('lazy queries with keys are not supported')
+
+        path, params = split_view_name(name)
+        params.update(encode_view_params(kwargs))
+
+        if 'key' in params:
+            params['startkey'] = params['endkey'] = params.pop('key')
+
+        limit = int(params.pop('limit')) if 'limit' in params else None
+        resource = self.couchdb.resource(*path)
+        n = 0
+
+        while True:
+            params['limit'] = page_size + 1
+            _, result = resource.get(params=params)
+            rows = result['rows']
+
+            for row in rows[:page_size]:
+                if limit is not None and n >= limit:
+                    return
+                yield row
+                n += 1
+
+            if len(rows) <= page_size:
+                return
+
+            cursor = rows[page_size]
+            params['startkey'] = json.dumps(cursor['key'])
+            if 'id' in cursor:
+                params['startkey_docid'] = cursor['id']
+            params.pop('skip', None)
+
+    def query_ranges(self, name, ranges, include_docs=False, batch_size=VIEW_QUERIES_BATCH_SIZE):
+        ''' the rows of many key ranges of a view, ranges are (startkey, endkey) pairs
+
+        the ranges are sent as multiple queries of the view, one request per
+        batch_size ranges instead of one per range.
+        the rows are returned in the order of the ranges
+        '''
+        self._check_con()
+        path, params = split_view_name(name)
+        resource = self.couchdb.resource(*path, 'queries')
+
+        rows = []
+        for batch in chunked(list(ranges), batch_size):
+            queries = [{'startkey': s, 'endkey': e, 'include_docs': include_docs} for s, e in batch]
+            _, result = resource.post(params=params, data=json.dumps({'queries': queries}))
+            for r in result['results']:
+                rows.extend(r['rows'])
+        return QueryResult(rows)
+
 
     #@staticmethod
     def init_db(self, config):
-        server = couch.Server(_get_db_url(config))
+        self.pool = PooledSession.from_config(config)
+        server = _pooled_server(config, self.pool)
         server.create(self.name)
         self.from_config(config)
         setup_views(self.couchdb)
 
         self.views = ddocs
         for doc in ddocs:
-            self.couchdb.save(doc)
+            self.couchdb.save(dict(doc))
+
+        self.create_mango_indexes()
 
 
     def view(self, viewname, value=True):
         if value==True:
             res = self.query(viewname)
-            return [x['value'] for x in res]
+            return res.values()
+
+    def _update_seq_number(self, seq):
+        ''' couchdb sequences look like "123-g1AAAA...", the number is comparable '''
+        return int(str(seq).split('-')[0])
+
+    def _trigger_index_update(self, ddoc_id):
+        ''' start updating the index of a design doc in the background
+
+        all views of a design doc share one index, so querying one view is enough.
+        update=lazy returns at once and builds the index in the background
+        '''
+        first_view = next(iter(self.couchdb.get(ddoc_id)['views']))
+        view_path = ddoc_id.split('/') + ['_view', first_view]
+        self.couchdb.resource(*view_path).get(params={'limit': 0, 'update': 'lazy'})
+        return view_path
+
+    def warm_views(self):
+        ''' trigger index updates of all design docs, e.g. after large writes,
+        so the next reader doesnt wait for the indexer
+        '''
+        self._check_con()
+        for ddoc in ddocs:
+            self._trigger_index_update(ddoc['_id'])
+
+    def indexer_progress(self):
+        ''' progress of the running view index builds of this database
+
+        returns a list of dicts with the design document, the changes indexed
+        so far, the total changes and the progress in percent, summed over shards
+        '''
+        self._check_con()
+        _, tasks = self.server.resource.get('_active_tasks')
+
+        progress = {}
+        for task in tasks:
+            if task.get('type') != 'indexer':
+                continue
+            # in clustered couchdb the database is a shard like shards/00000000-1fffffff/ngs_app.1681206311
+            database = task.get('database', '').split('/')[-1].split('.')[0]
+            if database != self.name:
+                continue
+
+            p = progress.setdefault(task['design_document'], {
+                'design_document': task['design_document'],
+                'changes_done': 0,
+                'total_changes': 0,
+                })
+            p['changes_done'] += task.get('changes_done', 0)
+            p['total_changes'] += task.get('total_changes', 0)
+
+        for p in progress.values():
+            if p['total_changes'] > 0:
+                p['progress'] = int(100 * p['changes_done'] / p['total_changes'])
+            else:
+                p['progress'] = 100
+
+        return sorted(progress.values(), key=lambda p: p['design_document'])
+
+    def _build_design_doc(self, ddoc_id, poll_interval, timeout):
+        ''' start building the index of a design doc and wait until it caught up
+        with the database
+        '''
+        target_seq = self._update_seq_number(self.couchdb.config()['update_seq'])
+        view_path = self._trigger_index_update(ddoc_id)
+
+        timer = Timeout(timeout)
+        while True:
+            _, info = self.couchdb.resource(*ddoc_id.split('/'), '_info').get()
+            view_index = info['view_index']
+            indexed_seq = self._update_seq_number(view_index['update_seq'])
+
+            logger.info(f'indexing {ddoc_id}: {indexed_seq} of {target_seq}')
+            if indexed_seq >= target_seq and not view_index.get('updater_running', False):
+                break
+            if timer.reached():
+                raise RuntimeError(f'building the index of {ddoc_id} timed out')
+            time.sleep(poll_interval)
+
+        # the index is up to date, so this returns quickly
+        self.couchdb.resource(*view_path).get(params={'limit': 0})
+
+    def migrate_design_docs(self, poll_interval=5., timeout=24*60*60):
+        ''' update the design docs to the views defined in this module
+        without stalling readers on a cold index
+
+        changed design docs are first saved under a staging name and indexed.
+        couchdb shares indexes between design docs with identical views, so
+        after swapping the views into the live design doc its index is warm.
+        returns the ids of the migrated design docs
+        '''
+        self._check_con()
+        migrated = []
+
+        for ddoc in ddocs:
+            ddoc_id = ddoc['_id']
+            try:
+                current = self.couchdb.get(ddoc_id)
+            except NotFound:
+                current = None
+
+            if current is not None and current.get('views') == ddoc['views'] \
+                    and current.get('version') == ddoc['version']:
+                continue
+
+            logger.info(f"migrating {ddoc_id} from version {current and current.get('version')} to {ddoc['version']}")
+            staging_id = ddoc_id + '_staging'
+            staging = dict(ddoc, _id=staging_id)
+            if staging_id in self.couchdb:
+                staging['_rev'] = self.couchdb.get(staging_id)['_rev']
+            staging = self.couchdb.save(staging)
+
+            self._build_design_doc(staging_id, poll_interval, timeout)
+
+            live = dict(ddoc)
+            if current is not None:
+                live['_rev'] = current['_rev']
+            self.couchdb.save(live)
+            self.couchdb.delete(staging)
+            migrated.append(ddoc_id)
+
+        # remove the index files of the replaced views
+        if len(migrated) > 0:
+            self.couchdb.cleanup()
+
+        self.create_mango_indexes()
+        return migrated
+
+    def _find_body(self, selector, fields=None, sort=None, limit=None, skip=None, bookmark=None, use_index=None):
+        body = {'selector': selector}
+        optional = {
+            'fields': fields,
+            'sort': sort,
+            'limit': limit,
+            'skip': skip,
+            'bookmark': bookmark,
+            'use_index': use_index,
+            }
+        body.update({k: v for k, v in optional.items() if v is not None})
+        return json.dumps(body)
+
+    def find(self, selector, fields=None, sort=None, limit=None, skip=None, bookmark=None, use_index=None):
+        ''' run a mango query, returns a FindResult
+
+        pass the bookmark of the previous result to get the next page
+        '''
+        self._check_con()
+        data = self._find_body(selector, fields, sort, limit, skip, bookmark, use_index)
+        _, result = self.couchdb.resource.post('_find', data=data)
+        if result.get('warning') is not None:
+            logger.warning(f"mango query {selector}: {result['warning']}")
+        return FindResult.from_response(result)
+
+    def find_lazy(self, selector, page_size=VIEW_PAGE_SIZE, **kwargs):
+        ''' like find, but pages through all matching documents with bookmarks while iterating '''
+        def rows():
+            bookmark = None
+            while True:
+                page = self.find(selector, limit=page_size, bookmark=bookmark, **kwargs)
+                yield from page.rows
+                if len(page.rows) < page_size:
+                    return
+                bookmark = page.bookmark
+
+        return LazyQueryResult(rows)
+
+    def explain(self, selector, fields=None, sort=None, limit=None, skip=None, use_index=None):
+        ''' show which index couchdb would use for a mango query '''
+        self._check_con()
+        data = self._find_body(selector, fields, sort, limit, skip, None, use_index)
+        _, result = self.couchdb.resource.post('_explain', data=data)
+        return result
+
+    def create_index(self, fields, name=None, ddoc=None, partial_filter_selector=None):
+        ''' create a json index for mango queries, existing indexes are kept '''
+        self._check_con()
+        index = {'fields': fields}
+        if partial_filter_selector is not None:
+            index['partial_filter_selector'] = partial_filter_selector
+
+        body = {'index': index, 'type': 'json'}
+        if name is not None:
+            body['name'] = name
+        if ddoc is not None:
+            body['ddoc'] = ddoc
+
+        _, result = self.couchdb.resource.post('_index', data=json.dumps(body))
+        return result
+
+    def list_indexes(self):
+        self._check_con()
+        _, result = self.couchdb.resource.get('_index')
+        return result['indexes']
+
+    def delete_index(self, ddoc, name):
+        self._check_con()
+        _, result = self.couchdb.resource.delete(['_index', ddoc, 'json', name])
+        return result
+
+    def create_mango_indexes(self):
+        for index in mango_indexes:
+            self.create_index(
+                    index['fields'],
+                    name=index['name'],
+                    ddoc='mango_' + index['name'],
+                    partial_filter_selector=index.get('partial_filter_selector'),
+                    )
 
 
     #@staticmethod
@@ -459,11 +1109,28 @@ class Db:
         if not config.is_set:
             raise RuntimeError('cant create db from config if config is not set yet')
 
-        url = _get_db_url(config)
-        self.server = couch.Server(url)
+        if self.pool is None:
+            self.pool = PooledSession.from_config(config)
+
+        self._initialized = False
+        self.server = _pooled_server(config, self.pool)
         self.couchdb = self.server.database(self.name)
+
+        if config['couchdb_cache']:
+            self.enable_cache(
+                    max_entries=config['couchdb_cache_entries'],
+                    max_bytes=config['couchdb_cache_bytes'],
+                    validation=config['couchdb_cache_validation'],
+                    )
         return Db()
 
+    def connection_stats(self):
+        ''' request and connection statistics of the current process '''
+        if self.pool is None:
+            return {}
+        self.pool.check_fork()
+        return self.pool.stats()
+
 
 def get_db_url(app):
     host = app.config['data']['couchdb_host']
@@ -0,0 +1,166 @@
+import time
+
+from celery.utils.log import get_task_logger
+
+''' batched _bulk_docs writes with per document conflict handling '''
+
+logger = get_task_logger(__name__)
+
+# number of documents that are sent in one _bulk_docs request
+BULK_WRITE_BATCH_SIZE = 500
+
+# what to do with documents that were changed by someone else in the meantime
+# 'raise': write the others and raise a BulkWriteError for the conflicts
+# 'ours': overwrite the latest revision with our document
+# 'theirs': keep the latest revision and drop our document
+# a function merge(ours, theirs) -> dict can be used instead, the result is
+# written on top of the latest revision
+MERGE_POLICIES = ['raise', 'ours', 'theirs']
+
+
+class BulkWriteError(RuntimeError):
+    ''' raised when documents of a bulk write couldnt be saved '''
+    def __init__(self, failed):
+        self.failed = failed
+        super().__init__(f'could not save {len(failed)} documents: {failed[:10]}')
+
+
+class BulkWriteStats:
+    ''' throughput counters of bulk writes '''
+    def __init__(self):
+        self.docs = 0
+        self.batches = 0
+        self.conflicts = 0
+        self.retries = 0
+        self.errors = 0
+        self.seconds = 0.
+
+    def add(self, other):
+        for k in ['docs', 'batches', 'conflicts', 'retries', 'errors', 'seconds']:
+            setattr(self, k, getattr(self, k) + getattr(other, k))
+
+    def docs_per_second(self):
+        if self.seconds == 0:
+            return 0.
+        return self.docs / self.seconds
+
+    def dict(self):
+        return {
+            'docs': self.docs,
+            'batches': self.batches,
+            'conflicts': self.conflicts,
+            'retries': self.retries,
+            'errors': self.errors,
+            'seconds': self.seconds,
+            'docs_per_second': self.docs_per_second(),
+            }
+
+
+class BulkWriter:
+    '''
+    writes documents with _bulk_docs in batches and checks the result of
+    every document, conflicting documents are refetched with their latest
+    _rev and resolved with the merge policy, then written again up to
+    retries times
+
+    db has to provide _post_bulk_docs(docs) returning the couchdb results
+    in the order of docs, and _get_bulk_raw(ids) returning the latest
+    documents or None for missing ones
+    '''
+
+    def __init__(self, db, batch_size=BULK_WRITE_BATCH_SIZE, merge='raise', retries=3):
+        if not callable(merge) and merge not in MERGE_POLICIES:
+            raise RuntimeError(f'invalid merge policy {merge}, use a function or one of {MERGE_POLICIES}')
+
+        self.db = db
+        self.batch_size = batch_size
+        self.merge = merge
+        self.retries = retries
+        self.stats = BulkWriteStats()
+
+    def _resolve(self, ours, theirs):
+        ''' the document to write instead of ours, or None to drop it '''
+        if theirs is None:
+            # deleted in the meantime, write ours as a new document
+            d = dict(ours)
+            d.pop('_rev', None)
+            return d
+
+        if self.merge == 'ours':
+            return dict(ours, _rev=theirs['_rev'])
+        elif self.merge == 'theirs':
+            return None
+        else:
+            merged = self.merge(dict(ours), dict(theirs))
+            return dict(merged, _id=theirs['_id'], _rev=theirs['_rev'])
+
+    def _write_batch(self, docs):
+        ''' write a batch and retry the conflicts
+
+        the resolved documents replace the ones in docs,
+        returns the couchdb results in order of docs
+        '''
+        results = [None] * len(docs)
+        pending = list(range(len(docs)))
+
+        for attempt in range(self.retries + 1):
+            batch_results = self.db._post_bulk_docs([docs[i] for i in pending])
+            self.stats.batches += 1
+
+            conflicts = []
+            for i, result in zip(pending, batch_results):
+                results[i] = result
+                if result.get('error') == 'conflict':
+                    conflicts.append(i)
+
+            self.stats.conflicts += len(conflicts)
+            if len(conflicts) == 0 or self.merge == 'raise' or attempt == self.retries:
+                break
+
+            latest = self.db._get_bulk_raw([docs[i]['_id'] for i in conflicts])
+            pending = []
+            for i, theirs in zip(conflicts, latest):
+                resolved = self._resolve(docs[i], theirs)
+                if resolved is None:
+                    docs[i] = theirs
+                    results[i] = {'id': theirs['_id'], 'rev': theirs['_rev']}
+                else:
+                    docs[i] = resolved
+                    pending.append(i)
+
+            if len(pending) == 0:
+                break
+            self.stats.retries += 1
+
+        return results
+
+    def write(self, docs):
+        ''' write the documents, returns the written documents with their new _rev
+
+        raises a BulkWriteError after writing all batches, if some documents
+        failed or conflicts remained
+        '''
+        docs = [dict(d) for d in docs]
+        start = time.monotonic()
+        results = []
+
+        for i in range(0, len(docs), self.batch_size):
+            batch = docs[i:i+self.batch_size]
+            results += self._write_batch(batch)
+            docs[i:i+self.batch_size] = batch
+
+        self.stats.docs += len(docs)
+        self.stats.seconds += time.monotonic() - start
+
+        failed = [r for r in results if 'error' in r]
+        self.stats.errors += len(failed)
+
+        logger.info(f'bulk wrote {len(docs)} documents at {self.stats.docs_per_second():.0f} docs/s, '
+                f'{self.stats.conflicts} conflicts, {self.stats.retries} retries, {len(failed)} failed')
+
+        if len(failed) > 0:
+            raise BulkWriteError(failed)
+
+        for d, r in zip(docs, results):
+            d['_rev'] = r['rev']
+        return docs
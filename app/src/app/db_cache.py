@@ -0,0 +1,126 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+
+''' in-process read-through cache for couchdb documents '''
+
+CACHE_VALIDATIONS = ['changes', 'rev']
+
+
+class DocumentCache:
+    '''
+    least recently used cache of raw couchdb documents keyed by their id
+
+    the documents are stored json encoded, so the size bound is exact and
+    every hit returns a fresh copy that the caller may modify
+
+    the cache itself doesnt talk to couchdb, Db validates the entries either
+    by polling the _changes feed at most every changes_interval seconds
+    (validation='changes') or by comparing the _rev of every hit with the
+    etag of a HEAD request (validation='rev')
+
+    all methods hold a lock, so threads of one process can share the cache
+    '''
+
+    def __init__(self, max_entries=1000, max_bytes=64*1024*1024, validation='changes', changes_interval=1.):
+        if validation not in CACHE_VALIDATIONS:
+            raise RuntimeError(f'invalid cache validation {validation}, use one of {CACHE_VALIDATIONS}')
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.validation = validation
+        self.changes_interval = changes_interval
+
+        self.last_seq = None
+        self.last_poll = 0.
+
+        self._lock = threading.RLock()
+        self._docs = OrderedDict()
+        self._bytes = 0
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0,
+            }
+
+    def __contains__(self, doc_id):
+        with self._lock:
+            return doc_id in self._docs
+
+    def __len__(self):
+        with self._lock:
+            return len(self._docs)
+
+    def get(self, doc_id):
+        ''' return a copy of the cached document or None '''
+        with self._lock:
+            if doc_id not in self._docs:
+                self._stats['misses'] += 1
+                return None
+
+            self._docs.move_to_end(doc_id)
+            self._stats['hits'] += 1
+            _, data = self._docs[doc_id]
+        return json.loads(data)
+
+    def rev(self, doc_id):
+        ''' the revision of a cached document without copying it, or None '''
+        with self._lock:
+            if doc_id not in self._docs:
+                return None
+            rev, _ = self._docs[doc_id]
+            return rev
+
+    def put(self, doc_id, doc):
+        data = json.dumps(doc)
+
+        with self._lock:
+            self._remove(doc_id)
+            if len(data) > self.max_bytes:
+                return
+
+            self._docs[doc_id] = (doc.get('_rev'), data)
+            self._bytes += len(data)
+
+            while len(self._docs) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, data) = self._docs.popitem(last=False)
+                self._bytes -= len(data)
+                self._stats['evictions'] += 1
+
+    def _remove(self, doc_id):
+        if doc_id in self._docs:
+            _, data = self._docs.pop(doc_id)
+            self._bytes -= len(data)
+            return True
+        return False
+
+    def invalidate(self, doc_id):
+        with self._lock:
+            if self._remove(doc_id):
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._stats['invalidations'] += len(self._docs)
+            self._docs.clear()
+            self._bytes = 0
+
+    def poll_due(self):
+        return time.monotonic() - self.last_poll >= self.changes_interval
+
+    def apply_changes(self, changed_ids, last_seq):
+        ''' invalidate the documents that changed since the last poll '''
+        with self._lock:
+            for doc_id in changed_ids:
+                self.invalidate(doc_id)
+            self.last_seq = last_seq
+            self.last_poll = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['entries'] = len(self._docs)
+            s['bytes'] = self._bytes
+        return s
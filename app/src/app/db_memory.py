@@ -0,0 +1,937 @@
+import re
+import json
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from hashlib import md5
+from urllib.parse import urlsplit, unquote, parse_qsl
+from uuid import uuid4
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+''' in-process stand-in for the subset of couchdb that Db uses '''
+
+# requests only prepares http urls, so the memory backend has a http url
+# that is routed to the MemoryAdapter instead of the network
+MEMORY_URL = 'http://couchdb.memory'
+
+# the design docs version the python views below are equivalent to,
+# see app.db.DESIGN_DOCS_VERSION
+PYTHON_VIEWS_VERSION = 4
+
+# parameters of view and _all_docs queries that are json encoded
+JSON_PARAMS = ['key', 'keys', 'startkey', 'endkey', 'start_key', 'end_key']
+BOOL_PARAMS = ['include_docs', 'descending', 'reduce', 'group', 'inclusive_end', 'stable', 'update_seq']
+
+# default page size of mango queries
+FIND_LIMIT = 25
+
+
+class CouchError(Exception):
+    ''' turned into a couchdb error response '''
+    def __init__(self, status, error, reason):
+        self.status = status
+        self.error = error
+        self.reason = reason
+        super().__init__(f'{status} {error}: {reason}')
+
+
+def not_found(reason='missing'):
+    return CouchError(404, 'not_found', reason)
+
+def conflict():
+    return CouchError(409, 'conflict', 'Document update conflict.')
+
+def bad_request(reason):
+    return CouchError(400, 'bad_request', reason)
+
+
+def collate(x):
+    ''' sort key of a json value in couchdb view collation order
+
+    null < false < true < numbers < strings < arrays < objects, strings are
+    compared by code point instead of the unicode collation algorithm of couchdb
+    '''
+    if x is None:
+        return (0,)
+    elif x is False:
+        return (1,)
+    elif x is True:
+        return (2,)
+    elif isinstance(x, (int, float)):
+        return (3, x)
+    elif isinstance(x, str):
+        return (4, x)
+    elif isinstance(x, list):
+        return (5, tuple(collate(v) for v in x))
+    elif isinstance(x, dict):
+        return (6, tuple((k, collate(v)) for k, v in x.items()))
+    raise bad_request(f'cant collate {x!r}')
+
+
+# python equivalents of the javascript map functions of app.db.ddocs
+# couchdb skips a document if its map function raises, e.g. when a field
+# is null, the views skip them by raising KeyError, TypeError or AttributeError
+
+def _live(doc, doctypes=None):
+    ''' the conditions that gen_map_fn_str adds to the map functions '''
+    if doc.get('deleted'):
+        return False
+    return doctypes is None or doc.get('document_type') in doctypes
+
+
+def _sequencer_runs_all(doc):
+    if doc.get('document_type') == 'sequencer_run':
+        yield doc['parsed'].get('date'), {'original_path': doc.get('original_path')}
+
+def _sequencer_runs_original_path(doc):
+    if _live(doc, ['sequencer_run']):
+        yield doc.get('original_path'), None
+
+def _samples_all(doc):
+    if doc.get('document_type') == 'sample':
+        yield doc['_id'], None
+
+def _pipeline_runs_all(doc):
+    if doc.get('document_type') == 'pipeline_run':
+        yield doc.get('created_time'), {'status': doc.get('status')}
+
+def _filemaker_all(doc):
+    if doc.get('document_type') == 'filemaker_record':
+        yield [doc['_id'], 0], 0
+    elif doc.get('document_type') == 'examination':
+        yield [doc['filemaker_record'].get('id'), 1], 1
+
+def _examinations_examinations(doc):
+    if _live(doc, ['examination']):
+        yield doc.get('started_date'), None
+
+def _examinations_count(doc):
+    if _live(doc, ['examination']):
+        yield doc['_id'], None
+
+def _examinations_types(doc):
+    if _live(doc, ['examination']):
+        yield doc.get('examinationtype'), None
+
+_mp_number_examination_types = [
+    'DNA Lungenpanel Qiagen - kein nNGM Fall',
+    'DNA Panel ONCOHS',
+    'DNA PANEL ONCOHS (Mamma)',
+    'DNA PANEL ONCOHS (Melanom)',
+    'DNA PANEL ONCOHS (Colon)',
+    'DNA PANEL ONCOHS (GIST)',
+    'DNA PANEL Multimodel PanCancer DNA',
+    'DNA PANEL Multimodel PanCancer RNA',
+    'NNGM Lunge Qiagen',
+    'RNA Fusion Lunge',
+    'RNA Sarkompanel',
+    ]
+
+def _examinations_mp_number(doc):
+    if _live(doc, ['examination']):
+        record = doc['filemaker_record']
+        if record.get('Untersuchung') in _mp_number_examination_types:
+            yield [record.get('Jahr'), record.get('Mol_NR')], None
+
+def _examinations_new_examinations(doc):
+    if _live(doc, ['examination']):
+        if len(doc['pipeline_runs']) == 0 and len(doc['sequencer_runs']) > 0:
+            yield doc['_id'], None
+
+_FILEMAKER_DATE = re.compile('([0-9]{1,2})/([0-9]{1,2})/([0-9]{4})')
+
+def _patients_patient_aggregation(doc):
+    if not _live(doc):
+        return
+    if doc.get('document_type') == 'examination':
+        record = doc['filemaker_record']
+        gbd = record.get('GBD')
+        m = _FILEMAKER_DATE.fullmatch(gbd or '')
+        if m:
+            gbd = f'{m[3]}-{int(m[1]):02d}-{int(m[2]):02d}'
+        yield [record.get('Name'), record.get('Vorname'), gbd, doc['_id']], None
+    if doc.get('document_type') == 'patient':
+        b = doc.get('birthdate') or ''
+        yield [doc['names'].get('lastname'), doc['names'].get('firstname'), b[0:10], doc['_id']], None
+
+def _patients_patients(doc):
+    if _live(doc, ['patient']):
+        yield doc['_id'], None
+
+
+def _sum(keys, values, rereduce):
+    return sum(values)
+
+def _count(keys, values, rereduce):
+    if rereduce:
+        return sum(values)
+    return len(values)
+
+builtin_reduce_fns = {
+    '_sum': _sum,
+    '_count': _count,
+    }
+
+# (design doc name, view name) -> (map function, reduce function)
+python_views = {
+    ('sequencer_runs', 'all'): (_sequencer_runs_all, None),
+    ('sequencer_runs', 'original_path'): (_sequencer_runs_original_path, None),
+    ('samples', 'all'): (_samples_all, None),
+    ('pipeline_runs', 'all'): (_pipeline_runs_all, None),
+    # function (keys, values, rereduce) { return sum(values); }
+    ('filemaker', 'all'): (_filemaker_all, _sum),
+    ('examinations', 'examinations'): (_examinations_examinations, None),
+    ('examinations', 'examinations_count'): (_examinations_count, '_count'),
+    ('examinations', 'types'): (_examinations_types, '_count'),
+    ('examinations', 'mp_number'): (_examinations_mp_number, None),
+    ('examinations', 'new_examinations'): (_examinations_new_examinations, None),
+    ('patients', 'patient_aggregation'): (_patients_patient_aggregation, None),
+    ('patients', 'patients'): (_patients_patients, None),
+    }
+
+
+def _design_name(ddoc_id):
+    ''' the design doc name without prefix, staging copies use the live views '''
+    name = ddoc_id[len('_design/'):]
+    if name.endswith('_staging'):
+        name = name[:-len('_staging')]
+    return name
+
+
+def get_field(doc, field):
+    ''' the value of a dotted mango field and whether it exists '''
+    value = doc
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None, False
+        value = value[part]
+    return value, True
+
+
+def _json_type(x):
+    if x is None:
+        return 'null'
+    elif isinstance(x, bool):
+        return 'boolean'
+    elif isinstance(x, (int, float)):
+        return 'number'
+    elif isinstance(x, str):
+        return 'string'
+    elif isinstance(x, list):
+        return 'array'
+    return 'object'
+
+
+def _match_operator(op, arg, value, exists):
+    if op == '$exists':
+        return exists == arg
+    if not exists:
+        return op in ('$ne', '$nin', '$not')
+
+    if op == '$eq':
+        return collate(value) == collate(arg)
+    elif op == '$ne':
+        return collate(value) != collate(arg)
+    elif op == '$gt':
+        return collate(value) > collate(arg)
+    elif op == '$gte':
+        return collate(value) >= collate(arg)
+    elif op == '$lt':
+        return collate(value) < collate(arg)
+    elif op == '$lte':
+        return collate(value) <= collate(arg)
+    elif op == '$in':
+        return any(collate(value) == collate(a) for a in arg)
+    elif op == '$nin':
+        return all(collate(value) != collate(a) for a in arg)
+    elif op == '$type':
+        return _json_type(value) == arg
+    elif op == '$size':
+        return isinstance(value, list) and len(value) == arg
+    elif op == '$not':
+        return not _match_condition(arg, value, exists)
+    elif op == '$all':
+        return isinstance(value, list) and all(any(collate(v) == collate(a) for v in value) for a in arg)
+    elif op == '$elemMatch':
+        return isinstance(value, list) and any(_match_condition(arg, v, True) for v in value)
+    elif op == '$allMatch':
+        return isinstance(value, list) and all(_match_condition(arg, v, True) for v in value)
+    raise bad_request(f'unsupported mango operator {op}')
+
+
+def _match_condition(cond, value, exists):
+    if isinstance(cond, dict) and len(cond) > 0 and all(k.startswith('$') for k in cond):
+        return all(_match_operator(op, arg, value, exists) for op, arg in cond.items())
+    if isinstance(cond, dict) and not isinstance(value, dict):
+        return False
+    if isinstance(cond, dict):
+        # subfields like {'filemaker_record': {'Jahr': 2023}}
+        return match_selector(cond, value)
+    return exists and collate(value) == collate(cond)
+
+
+def match_selector(selector, doc):
+    ''' whether the document matches the mango selector '''
+    for field, cond in selector.items():
+        if field == '$and':
+            ok = all(match_selector(s, doc) for s in cond)
+        elif field == '$or':
+            ok = any(match_selector(s, doc) for s in cond)
+        elif field == '$nor':
+            ok = not any(match_selector(s, doc) for s in cond)
+        elif field == '$not':
+            ok = not match_selector(cond, doc)
+        else:
+            value, exists = get_field(doc, field)
+            ok = _match_condition(cond, value, exists)
+        if not ok:
+            return False
+    return True
+
+
+def _selector_fields(selector):
+    fields = set()
+    for field, cond in selector.items():
+        if field in ('$and', '$or', '$nor'):
+            for s in cond:
+                fields |= _selector_fields(s)
+        elif not field.startswith('$'):
+            fields.add(field)
+    return fields
+
+
+def _project(doc, fields):
+    ''' the document reduced to the dotted fields of a mango query '''
+    out = {}
+    for field in fields:
+        value, exists = get_field(doc, field)
+        if not exists:
+            continue
+        target = out
+        parts = field.split('.')
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return out
+
+
+class ViewIndex:
+    ''' the rows of one view, updated incrementally from the sequence of the database '''
+    def __init__(self, mapfn, reducefn):
+        self.mapfn = mapfn
+        self.reducefn = builtin_reduce_fns.get(reducefn, reducefn)
+        self.seq = 0
+        self.emitted = {}
+        self._rows = None
+
+    def update(self, db):
+        for doc_id, seq in reversed(db.seqs.items()):
+            if seq <= self.seq:
+                break
+            self._reindex(doc_id, db.docs[doc_id])
+        self.seq = db.seq
+
+    def _reindex(self, doc_id, entry):
+        self.emitted.pop(doc_id, None)
+        self._rows = None
+        if entry['deleted'] or doc_id.startswith('_design/'):
+            return
+        try:
+            rows = [(k, v) for k, v in self.mapfn(entry['doc'])]
+        except (KeyError, TypeError, AttributeError, IndexError):
+            return
+        if len(rows) > 0:
+            self.emitted[doc_id] = rows
+
+    def rows(self):
+        ''' all rows sorted by key and id, with the collation keys and ids for bisecting '''
+        if self._rows is None:
+            rows = [(collate(k), doc_id, k, v) for doc_id, kvs in self.emitted.items() for k, v in kvs]
+            rows.sort(key=lambda r: (r[0], r[1]))
+            self._rows = (
+                    [r[0] for r in rows],
+                    [r[1] for r in rows],
+                    [{'id': r[1], 'key': r[2], 'value': r[3]} for r in rows],
+                    )
+        return self._rows
+
+
+def _lower(cks, ids, ck, docid, inclusive):
+    ''' index of the first row after the lower bound '''
+    if docid is None:
+        return bisect_left(cks, ck) if inclusive else bisect_right(cks, ck)
+    i = bisect_left(cks, ck)
+    while i < len(cks) and cks[i] == ck and (ids[i] < docid or (not inclusive and ids[i] == docid)):
+        i += 1
+    return i
+
+
+def _upper(cks, ids, ck, docid, inclusive):
+    ''' index after the last row before the upper bound '''
+    if docid is None:
+        return bisect_right(cks, ck) if inclusive else bisect_left(cks, ck)
+    i = bisect_left(cks, ck)
+    while i < len(cks) and cks[i] == ck and (ids[i] < docid or (inclusive and ids[i] == docid)):
+        i += 1
+    return i
+
+
+def select_range(cks, ids, params):
+    ''' start and end index of the rows in the key range of the query '''
+    startkey = params.get('startkey', params.get('start_key'))
+    endkey = params.get('endkey', params.get('end_key'))
+    inclusive_end = params.get('inclusive_end', True)
+    descending = params.get('descending', False)
+
+    lo, hi = 0, len(cks)
+    if 'key' in params:
+        startkey = endkey = params['key']
+        inclusive_end = True
+
+    if descending:
+        startkey, endkey = endkey, startkey
+        start_docid, end_docid = params.get('endkey_docid'), params.get('startkey_docid')
+        if startkey is not None or 'key' in params:
+            lo = _lower(cks, ids, collate(startkey), start_docid, inclusive_end)
+        if endkey is not None or 'key' in params:
+            hi = _upper(cks, ids, collate(endkey), end_docid, True)
+    else:
+        start_docid, end_docid = params.get('startkey_docid'), params.get('endkey_docid')
+        if startkey is not None or 'key' in params:
+            lo = _lower(cks, ids, collate(startkey), start_docid, True)
+        if endkey is not None or 'key' in params:
+            hi = _upper(cks, ids, collate(endkey), end_docid, inclusive_end)
+
+    return lo, max(lo, hi)
+
+
+def _skip_limit(rows, params):
+    skip = params.get('skip', 0)
+    limit = params.get('limit')
+    if limit is None:
+        return rows[skip:]
+    return rows[skip:skip+limit]
+
+
+class MemoryDatabase:
+    ''' documents with revisions, a sequence of changes and view indexes '''
+    def __init__(self, name):
+        self.name = name
+        # id -> {'rev', 'doc', 'deleted'}
+        self.docs = {}
+        # id -> seq of the last change, ordered by seq
+        self.seqs = OrderedDict()
+        self.seq = 0
+        self.indexes = {}
+        self.mango_indexes = OrderedDict()
+
+    def seq_str(self, seq=None):
+        return f'{self.seq if seq is None else seq}-memory'
+
+    # documents
+
+    def get(self, doc_id):
+        entry = self.docs.get(doc_id)
+        if entry is None:
+            raise not_found('missing')
+        if entry['deleted']:
+            raise not_found('deleted')
+        return entry['doc']
+
+    def put(self, doc):
+        ''' save a document if its _rev is the latest, returns the new rev '''
+        doc_id = doc.get('_id')
+        if doc_id is None:
+            doc_id = doc['_id'] = uuid4().hex
+        if not isinstance(doc_id, str) or doc_id == '':
+            raise bad_request('invalid document id')
+
+        entry = self.docs.get(doc_id)
+        rev = doc.get('_rev')
+        if entry is None:
+            if rev is not None:
+                raise conflict()
+            n = 0
+        elif entry['deleted']:
+            if rev is not None and rev != entry['rev']:
+                raise conflict()
+            n = int(entry['rev'].split('-')[0])
+        else:
+            if rev != entry['rev']:
+                raise conflict()
+            n = int(entry['rev'].split('-')[0])
+
+        deleted = bool(doc.get('_deleted', False))
+        body = {k: v for k, v in doc.items() if k not in ('_rev', '_deleted')}
+        new_rev = f'{n+1}-' + md5(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()
+
+        if deleted:
+            stored = {'_id': doc_id, '_rev': new_rev, '_deleted': True}
+        else:
+            stored = dict(body, _rev=new_rev)
+
+        self.docs[doc_id] = {'rev': new_rev, 'doc': stored, 'deleted': deleted}
+        self.seq += 1
+        self.seqs.pop(doc_id, None)
+        self.seqs[doc_id] = self.seq
+        return new_rev
+
+    def delete(self, doc_id, rev):
+        self.get(doc_id)
+        return self.put({'_id': doc_id, '_rev': rev, '_deleted': True})
+
+    def bulk_docs(self, docs):
+        results = []
+        for doc in docs:
+            try:
+                rev = self.put(doc)
+                results.append({'ok': True, 'id': doc['_id'], 'rev': rev})
+            except CouchError as e:
+                results.append({'id': doc.get('_id'), 'error': e.error, 'reason': e.reason})
+        return results
+
+    def info(self):
+        live = sum(1 for e in self.docs.values() if not e['deleted'])
+        return {
+            'db_name': self.name,
+            'doc_count': live,
+            'doc_del_count': len(self.docs) - live,
+            'update_seq': self.seq_str(),
+            'purge_seq': 0,
+            'compact_running': False,
+            'instance_start_time': '0',
+            }
+
+    # _all_docs
+
+    def _all_docs_row(self, doc_id, include_docs):
+        entry = self.docs.get(doc_id)
+        if entry is None:
+            return {'key': doc_id, 'error': 'not_found'}
+        row = {'id': doc_id, 'key': doc_id, 'value': {'rev': entry['rev']}}
+        if entry['deleted']:
+            row['value']['deleted'] = True
+        if include_docs:
+            row['doc'] = None if entry['deleted'] else entry['doc']
+        return row
+
+    def all_docs(self, params):
+        include_docs = params.get('include_docs', False)
+        if 'keys' in params:
+            rows = [self._all_docs_row(k, include_docs) for k in params['keys']]
+            return {'total_rows': len(self.docs), 'offset': 0, 'rows': _skip_limit(rows, params)}
+
+        ids = sorted(doc_id for doc_id, e in self.docs.items() if not e['deleted'])
+        cks = [(4, doc_id) for doc_id in ids]
+        lo, hi = select_range(cks, ids, params)
+        selected = ids[lo:hi]
+        if params.get('descending', False):
+            selected.reverse()
+        rows = [self._all_docs_row(doc_id, include_docs) for doc_id in _skip_limit(selected, params)]
+        return {'total_rows': len(ids), 'offset': lo + params.get('skip', 0), 'rows': rows}
+
+    # views
+
+    def _design_views(self, ddoc_id):
+        ''' the view indexes of a design doc, all views share the update state '''
+        ddoc = self.get(ddoc_id)
+        name = _design_name(ddoc_id)
+        if ddoc.get('version') != PYTHON_VIEWS_VERSION:
+            raise CouchError(500, 'memory_backend', f'the python views of {ddoc_id} are for version {PYTHON_VIEWS_VERSION}, not {ddoc.get("version")}')
+
+        views = {}
+        for view_name, fns in ddoc.get('views', {}).items():
+            key = (name, view_name)
+            if key not in python_views:
+                raise CouchError(500, 'memory_backend', f'view {name}/{view_name} has no python equivalent')
+            mapfn, reducefn = python_views[key]
+            if 'reduce' not in fns:
+                reducefn = None
+            # staging and live design docs with the same views share their index like in couchdb
+            index_key = (key, json.dumps(fns, sort_keys=True))
+            if index_key not in self.indexes:
+                self.indexes[index_key] = ViewIndex(mapfn, reducefn)
+            views[view_name] = self.indexes[index_key]
+        return views
+
+    def update_views(self, ddoc_id):
+        for index in self._design_views(ddoc_id).values():
+            index.update(self)
+
+    def design_info(self, ddoc_id):
+        views = self._design_views(ddoc_id)
+        seq = min((index.seq for index in views.values()), default=self.seq)
+        return {
+            'name': _design_name(ddoc_id),
+            'view_index': {
+                'update_seq': self.seq_str(seq),
+                'updater_running': False,
+                'language': 'python',
+                },
+            }
+
+    def query_view(self, ddoc_id, view_name, params):
+        views = self._design_views(ddoc_id)
+        if view_name not in views:
+            raise not_found('missing_named_view')
+        index = views[view_name]
+
+        update = params.get('update', 'true')
+        if update == 'true':
+            self.update_views(ddoc_id)
+
+        cks, ids, rows = index.rows()
+        reduce = params.get('reduce', index.reducefn is not None)
+        if reduce and index.reducefn is None:
+            raise CouchError(400, 'query_parse_error', 'Reduce is invalid for map-only views.')
+
+        if 'keys' in params:
+            selected = []
+            for key in params['keys']:
+                lo, hi = select_range(cks, ids, {'key': key})
+                selected.append(rows[lo:hi])
+            offset = 0
+        else:
+            lo, hi = select_range(cks, ids, params)
+            selected = [rows[lo:hi]]
+            offset = lo
+        if params.get('descending', False):
+            selected = [list(reversed(s)) for s in selected]
+
+        if reduce:
+            result = {'rows': _skip_limit(self._reduce(index, selected, params), params)}
+        else:
+            out = _skip_limit([r for s in selected for r in s], params)
+            if params.get('include_docs', False):
+                out = [dict(r, doc=self._doc_or_none(r['id'])) for r in out]
+            result = {'total_rows': len(rows), 'offset': offset + params.get('skip', 0), 'rows': out}
+
+        if update == 'lazy':
+            self.update_views(ddoc_id)
+        return result
+
+    def _doc_or_none(self, doc_id):
+        entry = self.docs.get(doc_id)
+        if entry is None or entry['deleted']:
+            return None
+        return entry['doc']
+
+    def _reduce(self, index, selected, params):
+        group_level = params.get('group_level')
+        if params.get('group', False):
+            group_level = 'exact'
+        if group_level is None:
+            if 'keys' in params:
+                raise CouchError(400, 'query_parse_error', 'Multi-key fetches for reduce views must use `group=true`')
+            rows = [r for s in selected for r in s]
+            if len(rows) == 0:
+                return []
+            return [{'key': None, 'value': index.reducefn([[r['key'], r['id']] for r in rows], [r['value'] for r in rows], False)}]
+
+        out = []
+        for s in selected:
+            groups = OrderedDict()
+            for r in s:
+                key = r['key']
+                if group_level != 'exact' and isinstance(key, list):
+                    key = key[:int(group_level)]
+                groups.setdefault(json.dumps(key), (key, []))[1].append(r)
+            for key, rs in groups.values():
+                value = index.reducefn([[r['key'], r['id']] for r in rs], [r['value'] for r in rs], False)
+                out.append({'key': key, 'value': value})
+        return out
+
+    # _changes
+
+    def changes(self, params, selector=None):
+        since = params.get('since', 0)
+        since = self.seq if since == 'now' else int(str(since).split('-')[0])
+        limit = params.get('limit')
+        include_docs = params.get('include_docs', False)
+
+        results = []
+        for doc_id, seq in self.seqs.items():
+            if seq <= since:
+                continue
+            entry = self.docs[doc_id]
+            if selector is not None and not match_selector(selector, entry['doc']):
+                continue
+            change = {'seq': self.seq_str(seq), 'id': doc_id, 'changes': [{'rev': entry['rev']}]}
+            if entry['deleted']:
+                change['deleted'] = True
+            if include_docs:
+                change['doc'] = entry['doc']
+            results.append(change)
+            if limit is not None and len(results) >= limit:
+                break
+
+        if limit is not None and len(results) > 0:
+            last_seq = results[-1]['seq']
+        else:
+            last_seq = self.seq_str()
+        return {'results': results, 'last_seq': last_seq, 'pending': 0}
+
+    # mango
+
+    def _choose_index(self, body):
+        ''' the json index couchdb would use, partial indexes only with use_index '''
+        fields = _selector_fields(body['selector'])
+        use_index = body.get('use_index')
+        if isinstance(use_index, list):
+            use_index = use_index[-1] if len(use_index) > 0 else None
+        for (ddoc, name), index in self.mango_indexes.items():
+            if use_index is not None and use_index not in (ddoc, ddoc[len('_design/'):], name):
+                continue
+            if 'partial_filter_selector' in index['def'] and use_index is None:
+                continue
+            index_fields = [next(iter(f)) for f in index['def']['fields']]
+            if all(f in fields for f in index_fields):
+                return index
+        return None
+
+    def find(self, body):
+        selector = body.get('selector')
+        if not isinstance(selector, dict):
+            raise bad_request('missing selector')
+
+        docs = [e['doc'] for doc_id, e in sorted(self.docs.items())
+                if not e['deleted'] and not doc_id.startswith('_design/') and match_selector(selector, e['doc'])]
+
+        for s in reversed(body.get('sort', [])):
+            field, direction = (s, 'asc') if isinstance(s, str) else next(iter(s.items()))
+            docs.sort(key=lambda d: collate(get_field(d, field)[0]), reverse=direction == 'desc')
+
+        skip = body.get('skip', 0)
+        if body.get('bookmark') not in (None, 'nil'):
+            skip += int(body['bookmark'])
+        limit = body.get('limit', FIND_LIMIT)
+        docs = docs[skip:skip+limit]
+
+        if 'fields' in body:
+            docs = [_project(d, body['fields']) for d in docs]
+
+        result = {'docs': docs, 'bookmark': str(skip + len(docs))}
+        if self._choose_index(body) is None:
+            result['warning'] = 'No matching index found, create an index to optimize query time.'
+        return result
+
+    def explain(self, body):
+        index = self._choose_index(body)
+        if index is None:
+            index = {'ddoc': None, 'name': '_all_docs', 'type': 'special', 'def': {'fields': [{'_id': 'asc'}]}}
+        return {
+            'dbname': self.name,
+            'index': index,
+            'selector': body.get('selector'),
+            'opts': {k: v for k, v in body.items() if k != 'selector'},
+            'limit': body.get('limit', FIND_LIMIT),
+            'skip': body.get('skip', 0),
+            'fields': body.get('fields', 'all_fields'),
+            }
+
+    def create_index(self, body):
+        index = body.get('index', {})
+        if 'fields' not in index:
+            raise bad_request('missing index fields')
+        fields = [{f: 'asc'} if isinstance(f, str) else f for f in index['fields']]
+        definition = {'fields': fields}
+        if 'partial_filter_selector' in index:
+            definition['partial_filter_selector'] = index['partial_filter_selector']
+
+        name = body.get('name') or md5(json.dumps(definition, sort_keys=True).encode('utf-8')).hexdigest()
+        ddoc = '_design/' + body.get('ddoc', name)
+        existing = self.mango_indexes.get((ddoc, name))
+        if existing is not None and existing['def'] == definition:
+            return {'result': 'exists', 'id': ddoc, 'name': name}
+
+        self.mango_indexes[(ddoc, name)] = {'ddoc': ddoc, 'name': name, 'type': 'json', 'partitioned': False, 'def': definition}
+        return {'result': 'created', 'id': ddoc, 'name': name}
+
+    def list_indexes(self):
+        indexes = [{'ddoc': None, 'name': '_all_docs', 'type': 'special', 'def': {'fields': [{'_id': 'asc'}]}}]
+        indexes += list(self.mango_indexes.values())
+        return {'total_rows': len(indexes), 'indexes': indexes}
+
+    def delete_index(self, ddoc, name):
+        if not ddoc.startswith('_design/'):
+            ddoc = '_design/' + ddoc
+        if (ddoc, name) not in self.mango_indexes:
+            raise not_found('Index not found')
+        del self.mango_indexes[(ddoc, name)]
+        return {'ok': True}
+
+
+class MemoryCouch:
+    ''' the databases of an in-memory couchdb server '''
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.databases = {}
+
+    def reset(self):
+        with self.lock:
+            self.databases = {}
+
+    def database(self, name):
+        if name not in self.databases:
+            raise not_found('Database does not exist.')
+        return self.databases[name]
+
+    def handle(self, method, path, params, body):
+        ''' dispatch a request to the databases, returns (status, headers, result) '''
+        with self.lock:
+            return self._handle(method, path, params, body)
+
+    def _handle(self, method, path, params, body):
+        if len(path) == 0:
+            return 200, {}, {'couchdb': 'Welcome', 'version': 'memory'}
+        elif path[0] == '_all_dbs':
+            return 200, {}, sorted(self.databases)
+        elif path[0] == '_active_tasks':
+            # indexes are built synchronously
+            return 200, {}, []
+        elif path[0] == '_up':
+            return 200, {}, {'status': 'ok'}
+        elif path[0].startswith('_'):
+            raise bad_request(f'unsupported endpoint {path[0]}')
+
+        name, rest = path[0], path[1:]
+        if len(rest) == 0:
+            return self._handle_database(method, name)
+
+        db = self.database(name)
+        if rest[0] == '_design' and len(rest) >= 2:
+            rest = ['_design/' + rest[1]] + rest[2:]
+
+        endpoint = rest[0]
+        if endpoint == '_all_docs':
+            if body is not None and 'keys' in body:
+                params['keys'] = body['keys']
+            return 200, {}, db.all_docs(params)
+        elif endpoint == '_bulk_docs':
+            return 201, {}, db.bulk_docs(body['docs'])
+        elif endpoint == '_changes':
+            selector = None
+            if params.get('filter') == '_selector':
+                selector = body['selector']
+            return 200, {}, db.changes(params, selector)
+        elif endpoint == '_find':
+            return 200, {}, db.find(body)
+        elif endpoint == '_explain':
+            return 200, {}, db.explain(body)
+        elif endpoint == '_index':
+            if method == 'GET':
+                return 200, {}, db.list_indexes()
+            elif method == 'POST':
+                return 200, {}, db.create_index(body)
+            elif method == 'DELETE' and len(rest) == 4:
+                return 200, {}, db.delete_index(rest[1], rest[3])
+        elif endpoint in ('_view_cleanup', '_compact', '_ensure_full_commit'):
+            return 202, {}, {'ok': True}
+        elif endpoint.startswith('_design/') and len(rest) == 3 and rest[1] == '_view':
+            if body is not None and 'keys' in body:
+                params['keys'] = body['keys']
+            return 200, {}, db.query_view(endpoint, rest[2], params)
+        elif endpoint.startswith('_design/') and len(rest) == 4 and rest[1] == '_view' and rest[3] == 'queries':
+            return 200, {}, {'results': [db.query_view(endpoint, rest[2], dict(params, **q)) for q in body['queries']]}
+        elif endpoint.startswith('_design/') and len(rest) == 2 and rest[1] == '_info':
+            return 200, {}, db.design_info(endpoint)
+        elif len(rest) == 1 and (not endpoint.startswith('_') or endpoint.startswith('_design/')):
+            return self._handle_document(method, db, endpoint, params, body)
+
+        raise bad_request(f'unsupported request {method} {"/".join(path)}')
+
+    def _handle_database(self, method, name):
+        if method == 'PUT':
+            if name in self.databases:
+                raise CouchError(412, 'file_exists', 'The database could not be created, the file already exists.')
+            self.databases[name] = MemoryDatabase(name)
+            return 201, {}, {'ok': True}
+        elif method == 'DELETE':
+            self.database(name)
+            del self.databases[name]
+            return 200, {}, {'ok': True}
+        elif method in ('GET', 'HEAD'):
+            return 200, {}, self.database(name).info()
+        raise bad_request(f'unsupported method {method}')
+
+    def _handle_document(self, method, db, doc_id, params, body):
+        if method in ('GET', 'HEAD'):
+            doc = db.get(doc_id)
+            return 200, {'ETag': f'"{doc["_rev"]}"'}, doc
+        elif method == 'PUT':
+            doc = dict(body, _id=doc_id)
+            if 'rev' in params:
+                doc['_rev'] = params['rev']
+            rev = db.put(doc)
+            return 201, {'ETag': f'"{rev}"'}, {'ok': True, 'id': doc_id, 'rev': rev}
+        elif method == 'DELETE':
+            rev = db.delete(doc_id, params.get('rev'))
+            return 200, {'ETag': f'"{rev}"'}, {'ok': True, 'id': doc_id, 'rev': rev}
+        raise bad_request(f'unsupported method {method}')
+
+
+def _parse_params(query):
+    params = {}
+    for k, v in parse_qsl(query, keep_blank_values=True):
+        if k in JSON_PARAMS:
+            v = json.loads(v)
+        elif k in BOOL_PARAMS:
+            v = v == 'true'
+        elif k in ('limit', 'skip', 'group_level'):
+            v = int(v)
+        elif k == 'stale':
+            # deprecated form of update=false
+            k, v = 'update', 'false'
+        params[k] = v
+    return params
+
+
+class MemoryAdapter(BaseAdapter):
+    '''
+    requests transport adapter that answers couchdb requests from a MemoryCouch
+
+    mounted on the session of a PooledSession, Db and pycouchdb work
+    unchanged and every request still goes through requests, so benchmarks
+    measure the whole client side without network and couchdb
+    '''
+
+    def __init__(self, couch):
+        super().__init__()
+        self.couch = couch
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        url = urlsplit(request.url)
+        path = [unquote(p) for p in url.path.split('/') if p != '']
+        params = _parse_params(url.query)
+
+        body = request.body
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        body = json.loads(body) if body else None
+
+        try:
+            status, headers, result = self.couch.handle(request.method, path, params, body)
+        except CouchError as e:
+            status, headers, result = e.status, {}, {'error': e.error, 'reason': e.reason}
+
+        response = requests.Response()
+        response.status_code = status
+        response.reason = 'OK' if status < 400 else result.get('error')
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        response._content = b'' if request.method == 'HEAD' else json.dumps(result).encode('utf-8')
+        response.headers = CaseInsensitiveDict(headers)
+        response.headers['Content-Type'] = 'application/json'
+        response.headers['Content-Length'] = str(len(response._content))
+        return response
+
+    def close(self):
+        pass
+
+
+# the server of the memory backend, shared by all Db objects of the process
+MEMORY_COUCH = MemoryCouch()
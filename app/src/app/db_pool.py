@@ -0,0 +1,134 @@
+import os
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+''' pooled keep-alive http sessions for the couchdb layer '''
+
+
+class PooledSession:
+    '''
+    wraps a requests session with a connection pool of configurable size
+
+    the module level DB object is created before gunicorn and celery fork
+    their worker processes, connections that were opened in the parent
+    must not be reused by the children, because they would share a socket.
+    therefore the adapters are remounted whenever the process id changed.
+
+    the session may be shared by threads, requests' pools are thread safe
+    and the statistics counters are updated under a lock.
+    '''
+
+    def __init__(self, user=None, psw=None, pool_size=10, timeout=60., gzip=True):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.gzip = gzip
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip' if gzip else 'identity',
+            })
+
+        if user is not None:
+            self.session.auth = (user, psw)
+
+        self.session.hooks['response'].append(self._count_response)
+        self._reset_stats()
+        self._mount_adapters()
+        self.forks = 0
+
+    @staticmethod
+    def from_config(config):
+        return PooledSession(
+                user=config['couchdb_user'],
+                psw=config['couchdb_psw'],
+                pool_size=config['couchdb_pool_size'],
+                timeout=config['couchdb_timeout'],
+                gzip=config['couchdb_gzip'],
+                )
+
+    def _mount_adapters(self):
+        self.pid = os.getpid()
+        self.adapters = []
+        for prefix in ['http://', 'https://']:
+            adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.pool_size,
+                    pool_block=False,
+                    )
+            self.session.mount(prefix, adapter)
+            self.adapters.append(adapter)
+
+    def _reset_stats(self):
+        # a new lock, a forked child must not inherit a held one
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'errors': 0,
+            'bytes_received': 0,
+            'request_seconds': 0.,
+            }
+
+    def _add_stat(self, key, value):
+        with self._stats_lock:
+            self._stats[key] += value
+
+    def _count_response(self, response, *args, **kwargs):
+        with self._stats_lock:
+            self._stats['requests'] += 1
+            if response.status_code >= 400:
+                self._stats['errors'] += 1
+            self._stats['request_seconds'] += response.elapsed.total_seconds()
+        self._count_body(response)
+
+    def _count_body(self, response):
+        ''' count the bytes of the body while it is read, couchdb sends
+        _changes, _all_docs and views chunked, without Content-Length
+        '''
+        if response._content is not False:
+            # read already, like by the memory backend
+            self._add_stat('bytes_received', len(response._content or b''))
+            return
+
+        raw = response.raw
+        if raw is None or not hasattr(raw, 'stream'):
+            return
+        stream = raw.stream
+
+        def counted_stream(*args, **kwargs):
+            for chunk in stream(*args, **kwargs):
+                self._add_stat('bytes_received', len(chunk))
+                yield chunk
+        raw.stream = counted_stream
+
+    def check_fork(self):
+        ''' drop the inherited connections if we are running in a forked child '''
+        if os.getpid() != self.pid:
+            # dont close the old adapters, closing would shut down
+            # the sockets which the parent process still uses
+            self._mount_adapters()
+            self._reset_stats()
+            self.forks += 1
+
+    def connections_opened(self):
+        ''' number of tcp connections the pools of this process opened '''
+        n = 0
+        for adapter in self.adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                n += pools[key].num_connections
+        return n
+
+    def stats(self):
+        ''' connection statistics of the current process '''
+        with self._stats_lock:
+            s = dict(self._stats)
+        s['pid'] = self.pid
+        s['forks'] = self.forks
+        s['pool_size'] = self.pool_size
+        s['connections_opened'] = self.connections_opened()
+        return s
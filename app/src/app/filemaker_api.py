@@ -1,21 +1,228 @@
 import datetime
 import json
+import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from pathlib import Path
 from math import ceil
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from celery.utils.log import get_task_logger
 from app.model import filemaker_examination_types
+from app.json_stream import iter_json_array
+
+logger = get_task_logger(__name__)
+
+# pages that are requested ahead of the page that is being processed
+FILEMAKER_PREFETCH_PAGES = 4
+
+# bytes that are read at once from a streamed response
+STREAM_CHUNK_BYTES = 64*1024
+
+# times a failed page request is repeated
+FILEMAKER_PAGE_RETRIES = 2
+
+# message code of filemaker when a request has no results
+FILEMAKER_NO_RECORDS_MATCH = '401'
+
+# message code of filemaker when the token of the session isnt valid anymore
+FILEMAKER_INVALID_TOKEN = '952'
+
+
+def _message_code(response):
+    try:
+        return response.json()['messages'][0]['code']
+    except (ValueError, KeyError, IndexError):
+        return None
+
+
+def new_records_query(day, month, year, examination_types=filemaker_examination_types, field='Zeitstempel'):
+    ''' _find requests for the records of the examination types from the date on '''
+    return [
+        {field: f">={int(month)}/{int(day)}/{int(year)}",
+            'Untersuchung': f'="{u}"'}
+        for u in examination_types
+        ]
+
+
+class RateController:
+    '''
+    adapts the pause between the starts of filemaker requests to the server
+
+    the pause grows by step while responses are slower than target_latency
+    and doubles on errors, fast responses shrink it again by step,
+    so a busy server gets fewer requests and an idle one is not slowed down.
+    safe to share between threads
+    '''
+
+    def __init__(self, delay=0., min_delay=0., max_delay=30., target_latency=2., step=0.25):
+        self.delay = max(delay, min_delay)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.target_latency = target_latency
+        self.step = step
+
+        self.requests = 0
+        self.errors = 0
+        self.latency = 0.
+        self._next_start = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        ''' block until the next request may start '''
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.delay
+        if start > now:
+            time.sleep(start - now)
+
+    def record(self, latency, error=False):
+        ''' adapt the pause to the latency in seconds and the outcome of a request '''
+        with self._lock:
+            self.requests += 1
+            self.latency += latency
+            if error:
+                self.errors += 1
+                self.delay = max(self.delay * 2, self.step)
+            elif latency > self.target_latency:
+                self.delay += self.step
+            else:
+                self.delay -= self.step
+            self.delay = min(self.max_delay, max(self.min_delay, self.delay))
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'mean_latency': self.latency / self.requests if self.requests > 0 else 0.,
+            'delay': self.delay,
+            }
+
+
+class RecordStream:
+    '''
+    the records of a streamed filemaker response, decoded one by one
+    while iterating, so a page is never held in memory as a whole.
+    can be iterated once, count is the number of records read so far
+    '''
+
+    def __init__(self, response):
+        self.response = response
+        self.count = 0
+
+    def __iter__(self):
+        try:
+            for record in iter_json_array(self.response.iter_content(STREAM_CHUNK_BYTES), ['response', 'data']):
+                self.count += 1
+                yield record
+        finally:
+            self.close()
+
+    def close(self):
+        ''' release the connection, also if the records werent read to the end '''
+        self.response.close()
+
+
+def close_page(response):
+    ''' close the stream of a streamed page, a no-op for other pages '''
+    data = response.get('data') if isinstance(response, dict) else None
+    if isinstance(data, RecordStream):
+        data.close()
+
+
+def _close_fetched_page(future):
+    if not future.cancelled() and future.exception() is None:
+        close_page(future.result())
+
+
+def page_size(response):
+    ''' the number of records of a page, streamed pages count the records that were read '''
+    data = response['data']
+    if isinstance(data, RecordStream):
+        return data.count
+    return len(data)
+
+
+def _fetch_page(get_page, offset, limit, rate, retries):
+    ''' a page, failed requests are retried after the pause of the rate controller '''
+    for attempt in range(retries + 1):
+        rate.wait()
+        start = time.monotonic()
+        try:
+            response = get_page(offset=offset, limit=limit)
+        except Exception as e:
+            rate.record(time.monotonic() - start, error=True)
+            if attempt == retries:
+                raise
+            logger.warning(f'retrying filemaker page at offset {offset} after error: {e}')
+        else:
+            rate.record(time.monotonic() - start)
+            return response
+
+
+def iter_pages(get_page, offset, limit=1000, prefetch=FILEMAKER_PREFETCH_PAGES, rate=None, retries=FILEMAKER_PAGE_RETRIES):
+    '''
+    yields (offset, response) of the pages get_page(offset=, limit=) from offset on,
+    strictly in order
+
+    the next prefetch pages are requested on a bounded thread pool while the
+    caller processes the current one. ends after the first page with less
+    than limit records, streamed pages have to be consumed before the next
+    page is taken. a page that still fails after retries raises its
+    error when that page is reached, pages after it are dropped
+    '''
+    if rate is None:
+        rate = RateController()
+
+    pool = ThreadPoolExecutor(max_workers=max(1, prefetch), thread_name_prefix='filemaker_prefetch')
+    pending = []
+    next_offset = offset
+    response = None
+    try:
+        while True:
+            while len(pending) < max(1, prefetch):
+                pending.append((next_offset, pool.submit(_fetch_page, get_page, next_offset, limit, rate, retries)))
+                next_offset += limit
+
+            page_offset, future = pending.pop(0)
+            response = future.result()
+            yield page_offset, response
+
+            if page_size(response) < limit:
+                return
+    finally:
+        # the pages after the last or a failed one arent needed, their
+        # streams are closed so the pooled connections are released, also
+        # the ones of pages that are still being fetched once they arrive
+        if response is not None:
+            close_page(response)
+        for _, future in pending:
+            if not future.cancel():
+                future.add_done_callback(_close_fetched_page)
+        pool.shutdown(wait=False)
 
 
 class Filemaker:
-    def __init__(self, server, user, psw, table_name=None, layout=None):
+    '''
+    client of the filemaker data api
+
+    all requests share a keep-alive session, so the tls handshake and the
+    login happen once per sync instead of once per page. filemaker limits
+    the number of open sessions, use it as a context manager to log out
+    '''
+    def __init__(self, server, user, psw, table_name=None, layout=None, pool_size=FILEMAKER_PREFETCH_PAGES, timeout=60., scheme='https'):
         self.server = server
         self.user = user
         self.psw = psw
+        self.timeout = timeout
 
         # todo, this is sadly needed with the current settings
         self.ssl_verify = False
 
-        self.fm_baseurl = f"https://{self.server}/fmi/data/v1/databases"
+        # http is only for local stand-ins, see app.filemaker_standin
+        self.fm_baseurl = f"{scheme}://{self.server}/fmi/data/v1/databases"
 
         # use fixed table name and layout for simplicity
         if table_name is None:
@@ -30,108 +237,177 @@ class Filemaker:
 
         self.session_url = f"{self.fm_baseurl}/{self.table_name}/sessions"
 
-        self._token_ttl = datetime.timedelta(14*1/(24*60)) # in days, around 14 minutes
+        # filemaker tokens expire 15 minutes after their last use
+        self._token_ttl = datetime.timedelta(minutes=14)
 
         self._token = None
+        self._token_timestamp = None
+        self.logins = 0
+        # prefetching threads share the token
+        self._token_lock = threading.Lock()
+
+        self.session = requests.Session()
+        self.session.verify = self.ssl_verify
+        self.session.headers.update({'Content-Type': 'application/json'})
+        # one kept alive connection for each prefetching thread
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
     @staticmethod
     def from_config(config):
         fm = Filemaker(
                 config['filemaker_server'], 
                 config['filemaker_user'], 
-                config['filemaker_psw'])
+                config['filemaker_psw'],
+                pool_size=config['filemaker_prefetch_pages'])
         return fm
 
     def _get_new_token(self):
-        r = requests.post(
+        r = self.session.post(
                 self.session_url, 
                 auth=(self.user,self.psw), 
-                verify=self.ssl_verify,
-                headers={'Content-Type': 'application/json'})
+                timeout=self.timeout)
 
         r.raise_for_status()
+        self.logins += 1
         self._token_timestamp = datetime.datetime.now()
         return r.json()['response']['token']
 
     @property
     def token(self):
-        ''' gets a filemaker auth token, and caches it for 14 minutes
-        filemaker tokens expire after 15 minutes
+        ''' gets a filemaker auth token, and renews it before it expires
+        filemaker tokens expire 15 minutes after the last request, every
+        request with the token postpones the renewal
         '''
-        if self._token is None:
-            self._token = self._get_new_token()
-        elif datetime.datetime.now() > self._token_timestamp + self._token_ttl:
-            self._token = self._get_new_token()
+        with self._token_lock:
+            if self._token is None:
+                self._token = self._get_new_token()
+            elif datetime.datetime.now() > self._token_timestamp + self._token_ttl:
+                self._token = self._get_new_token()
 
-        return self._token
+            return self._token
 
+    def _invalidate_token(self, token):
+        ''' forget a token that filemaker rejected, unless another thread replaced it already,
+        and log out of its session, in case filemaker still keeps it
+        '''
+        with self._token_lock:
+            if self._token != token:
+                return
+            self._token = None
+        try:
+            self._delete_session(token)
+        except requests.RequestException as e:
+            logger.debug(f'cant logout of the rejected filemaker session: {e}')
+
+    def _delete_session(self, token):
+        r = self.session.delete(f'{self.session_url}/{token}', timeout=self.timeout)
+        r.raise_for_status()
 
     def logout(self):
         ''' explicitely logout of a session, instead of letting it expire after 15 minutes '''
-        if self._token is not None:
-            url = f'{self.session_url}/sessions/{self._token}'
-            r = requests.delete(
-                    url,
-                    verify=self.ssl_verify
-                    )
-            r.raise_for_status()
-            self._token = None
-                
+        with self._token_lock:
+            token, self._token = self._token, None
+        if token is not None:
+            self._delete_session(token)
+
+    def close(self):
+        try:
+            self.logout()
+        except requests.RequestException as e:
+            # the session expires on its own after 15 minutes
+            logger.warning(f'cant logout of filemaker: {e}')
+        self.session.close()
 
     def __enter__(self):
         ''' automatically logs in when self.token is accessed '''
-        pass
-
-    def __exit__(self):
-        self.logout()
-
-    def _get(self, url) -> dict:
-        r = requests.get(
-                url, 
-                verify=self.ssl_verify,
-                headers={'Content-Type': 'application/json',
-                    "Authorization": f"Bearer {self.token}"}
-                    )
-        r.raise_for_status()
-        return r.json()['response']
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _request(self, method, url, stream=False, **kwargs) -> dict:
+        ''' a request with the token, logs in again once if filemaker rejected the token
+
+        with stream=True only the headers are read, the records are
+        returned as a RecordStream that decodes them while iterating
+        '''
+        for attempt in range(2):
+            token = self.token
+            r = self.session.request(
+                    method,
+                    url,
+                    headers={"Authorization": f"Bearer {token}"},
+                    timeout=self.timeout,
+                    stream=stream,
+                    **kwargs)
+            if r.status_code != 401 or attempt == 1 or _message_code(r) != FILEMAKER_INVALID_TOKEN:
+                break
+            # e.g. filemaker was restarted or closed the session
+            r.close()
+            self._invalidate_token(token)
 
-    def _post(self, url, data) -> dict:
-        r = requests.get(
-                url, 
-                data=data,
-                verify=self.ssl_verify,
-                headers={'Content-Type': 'application/json',
-                    "Authorization": f"Bearer {self.token}"}
-                    )
         r.raise_for_status()
+        with self._token_lock:
+            if self._token == token:
+                self._token_timestamp = datetime.datetime.now()
+        if stream:
+            return {'data': RecordStream(r)}
         return r.json()['response']
 
+    def _get(self, url, stream=False) -> dict:
+        return self._request('GET', url, stream=stream)
+
+    def _post(self, url, data, stream=False) -> dict:
+        return self._request('POST', url, stream=stream, data=data)
+
+    def iter_records(self, offset, limit=1000, prefetch=FILEMAKER_PREFETCH_PAGES, rate=None, stream=False):
+        ''' pipelined get_all_records of all pages from offset on, see iter_pages '''
+        return iter_pages(partial(self.get_all_records, stream=stream), offset, limit, prefetch, rate)
+
     def get_highest_recordid(self):
         raise NotImplemented()
         url = f'{self.fm_baseurl}/{self.table_name}/layouts/{self.layout}/_find'
 
 
-    def get_all_records(self, offset, limit=1000) -> dict:
+    def get_all_records(self, offset, limit=1000, stream=False) -> dict:
         ''' bulk gets record in creation order and paginated 
         note that filemaker records are sorted by their recordid, but 
         not all recordids are consecutive, so record 406 might follow record 400
+
+        with stream=True, data is a RecordStream instead of a list
         '''
         if offset <=0:
             raise RuntimeError("invalid record offset, offsets start with 1")
         if limit <= 0:
             raise RuntimeError("invalid record limit, limits must be at least >= 1")
         url = f'{self.fm_baseurl}/{self.table_name}/layouts/{self.layout}/records?_limit={limit}&_offset={offset}'
-        return self._get(url)
+        try:
+            return self._get(url, stream=stream)
+        except requests.HTTPError as e:
+            # filemaker answers an offset after the last record with an error
+            if _message_code(e.response) == FILEMAKER_NO_RECORDS_MATCH:
+                return {'data': []}
+            raise
 
-    def find_records(self, layout=None):
-        raise NotImplemented()
-        if layout is None:
-            layout='Leistungserfassung'
+    def find_records(self, query, offset=1, limit=1000, sort=None, stream=False) -> dict:
+        ''' records matching the _find query, a list of or-ed requests like
+        [{"Zeitstempel": ">=10/18/2022"}], paginated like get_all_records
+        '''
+        if offset <=0:
+            raise RuntimeError("invalid record offset, offsets start with 1")
         url = f'{self.fm_baseurl}/{self.table_name}/layouts/{self.layout}/_find'
-        data = json.dumps({"query":[{"Zeitstempel":">=10/18/2022"}],
-                    "limit":100
-                    })
-        return self._post(url, data)
+        body = {"query": query, "offset": offset, "limit": limit}
+        if sort is not None:
+            body["sort"] = sort
+        try:
+            return self._post(url, json.dumps(body), stream=stream)
+        except requests.HTTPError as e:
+            # filemaker answers an empty result with an error
+            if _message_code(e.response) == FILEMAKER_NO_RECORDS_MATCH:
+                return {'data': []}
+            raise
 
     def find_mp_record(self, token, mp_number,limit=10):
         raise NotImplemented()
@@ -141,15 +417,12 @@ class Filemaker:
                     })
         return self._post(url, data)
 
-    def get_new_records_by_date(self, day, month, year, examination_types=filemaker_examination_types, limit=1000):
-        raise NotImplemented()
-        url = f'{self.fm_baseurl}/{self.table_name}/layouts/{self.layout}/_find'
-
-        data = json.dumps({"query":[
-            {"Zeitstempel":f">={int(month)}/{(day)}/{(year)}", 
-                'Untersuchung':f'="{u}"'}
-            for u in examination_types
-            ],
-            "limit":limit
-            })
-        return self._post(url,data)
+    def get_new_records_by_date(self, day, month, year, examination_types=filemaker_examination_types, limit=1000, offset=1, field='Zeitstempel', stream=False):
+        ''' records of the examination types from the date on, oldest first '''
+        return self.find_records(
+                new_records_query(day, month, year, examination_types, field),
+                offset=offset,
+                limit=limit,
+                sort=[{"fieldName": field, "sortOrder": "ascend"}],
+                stream=stream,
+                )
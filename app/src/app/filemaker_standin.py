@@ -0,0 +1,234 @@
+import time
+import random
+import threading
+import json
+from uuid import uuid4
+
+from flask import Flask, request, jsonify
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from app.parsers import parse_date
+
+''' a local stand-in of the filemaker data api for load tests and benchmarks
+
+serves deterministic synthetic Leistungserfassung rows through the endpoints
+that app.filemaker_api uses: sessions, paginated records and _find.
+latency and errors can be injected to see how the sync copes with a slow
+or overloaded server
+'''
+
+EXAMINATION_TYPES = ['DNA Panel ONCOHS', 'RNA Sarkompanel', 'BRAF Ex11']
+
+# filemaker message codes
+CODE_OK = '0'
+CODE_NO_RECORDS_MATCH = '401'
+CODE_INVALID_TOKEN = '952'
+CODE_HOST_CAPACITY = '812'
+
+
+def synthetic_record(i, patients, seed=0):
+    ''' the record with recordId i+1, the same for the same arguments '''
+    rng = random.Random(f'{seed}-{i}')
+    p = rng.randrange(patients)
+    return {
+        'fieldData': {
+            'Zeitstempel': f'{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/2023',
+            'Mol_NR': i,
+            'Jahr': 2023,
+            'Untersuchung': rng.choice(EXAMINATION_TYPES),
+            'Name': f'Name{p}',
+            'Vorname': f'Vorname{p}',
+            'GBD': f'{p % 12 + 1:02d}/{p % 28 + 1:02d}/{1930 + p % 80}',
+            'Geschlecht': 'M' if p % 2 else 'W',
+            'Befunder': 'X',
+            },
+        'portalData': {},
+        'recordId': str(i + 1),
+        'modId': '1',
+        }
+
+
+def _matches(value, criterion):
+    ''' the subset of the filemaker find syntax that we use '''
+    if criterion.startswith('=='):
+        return str(value) == criterion[2:].strip('"')
+    elif criterion.startswith('='):
+        return str(value) == criterion[1:].strip('"')
+    elif criterion.startswith('>='):
+        return parse_date(value) >= parse_date(criterion[2:])
+    elif criterion.startswith('<='):
+        return parse_date(value) <= parse_date(criterion[2:])
+    else:
+        return criterion in str(value)
+
+
+class FilemakerStandin:
+    '''
+    the synthetic table of n records and the behaviour of the server
+
+    latency is the seconds every request takes, error_rate the fraction of
+    requests that fail with a 500 like an overloaded filemaker server
+    '''
+
+    def __init__(self, n=100000, patients=20000, seed=0, latency=0., error_rate=0.,
+            user='user', psw='psw', database='molpatho_Leistungserfassung', layout='Leistungserfassung'):
+        self.n = n
+        self.patients = patients
+        self.seed = seed
+        self.latency = latency
+        self.error_rate = error_rate
+        self.user = user
+        self.psw = psw
+        self.database = database
+        self.layout = layout
+
+        self.tokens = set()
+        self.requests = 0
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self._columns = {}
+        self._finds = {}
+        self._lock = threading.Lock()
+
+    def record(self, i):
+        return synthetic_record(i, self.patients, self.seed)
+
+    def _column(self, field):
+        ''' the values of a field of all records, for evaluating finds '''
+        if field not in self._columns:
+            self._columns[field] = [self.record(i)['fieldData'][field] for i in range(self.n)]
+        return self._columns[field]
+
+    def find(self, query, sort=None):
+        ''' indexes of the records that match any of the requests of the query
+
+        the table doesnt change, so the results are kept for the following pages
+        '''
+        key = json.dumps([query, sort], sort_keys=True)
+        with self._lock:
+            if key in self._finds:
+                return self._finds[key]
+
+            columns = {field: self._column(field) for q in query for field in q}
+            found = [i for i in range(self.n)
+                    if any(all(_matches(columns[f][i], c) for f, c in q.items()) for q in query)]
+
+            for s in reversed(sort or []):
+                column = self._column(s['fieldName'])
+                sort_key = (lambda i: parse_date(column[i])) if s['fieldName'] == 'Zeitstempel' else (lambda i: column[i])
+                found.sort(key=sort_key, reverse=s.get('sortOrder') == 'descend')
+            self._finds[key] = found
+        return found
+
+    def _fail(self):
+        ''' the injected latency and errors of a request '''
+        with self._lock:
+            self.requests += 1
+            fail = self._rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return fail
+
+    def app(self):
+        return create_filemaker_app(self)
+
+
+def _response(response, code=CODE_OK, message='OK', status=200):
+    return jsonify({'response': response, 'messages': [{'code': code, 'message': message}]}), status
+
+
+def _page(standin, indexes, offset, limit):
+    data = [standin.record(i) for i in indexes[offset-1:offset-1+limit]]
+    if len(data) == 0:
+        return _response({}, CODE_NO_RECORDS_MATCH, 'No records match the request', 500)
+    return _response({
+        'dataInfo': {
+            'database': standin.database,
+            'layout': standin.layout,
+            'totalRecordCount': standin.n,
+            'foundCount': len(indexes),
+            'returnedCount': len(data),
+            },
+        'data': data,
+        })
+
+
+def create_filemaker_app(standin):
+    app = Flask(__name__)
+    base = '/fmi/data/v1/databases/<database>'
+
+    def check():
+        ''' the error response of a failing or unauthorized request, or None '''
+        if standin._fail():
+            return _response({}, CODE_HOST_CAPACITY, "Exceeded host's capacity", 500)
+        auth = request.headers.get('Authorization', '')
+        if auth[len('Bearer '):] not in standin.tokens:
+            return _response({}, CODE_INVALID_TOKEN, 'Invalid FileMaker Data API token (*)', 401)
+        return None
+
+    @app.route(f'{base}/sessions', methods=['POST'])
+    def login(database):
+        if standin._fail():
+            return _response({}, CODE_HOST_CAPACITY, "Exceeded host's capacity", 500)
+        auth = request.authorization
+        if auth is None or auth.username != standin.user or auth.password != standin.psw:
+            return _response({}, '212', 'Invalid user account and/or password; please try again', 401)
+        token = uuid4().hex
+        with standin._lock:
+            standin.tokens.add(token)
+        return _response({'token': token})
+
+    @app.route(f'{base}/sessions/<token>', methods=['DELETE'])
+    def logout(database, token):
+        with standin._lock:
+            standin.tokens.discard(token)
+        return _response({})
+
+    @app.route(f'{base}/layouts/<layout>/records', methods=['GET'])
+    def records(database, layout):
+        error = check()
+        if error is not None:
+            return error
+        offset = int(request.args.get('_offset', 1))
+        limit = int(request.args.get('_limit', 100))
+        return _page(standin, range(standin.n), offset, limit)
+
+    @app.route(f'{base}/layouts/<layout>/_find', methods=['POST'])
+    def find(database, layout):
+        error = check()
+        if error is not None:
+            return error
+        body = request.get_json(force=True)
+        indexes = standin.find(body['query'], body.get('sort'))
+        return _page(standin, indexes, int(body.get('offset', 1)), int(body.get('limit', 100)))
+
+    return app
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    ''' a benchmark makes too many requests to log each '''
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class StandinServer:
+    ''' runs the stand-in on a local port in a background thread '''
+
+    def __init__(self, standin, host='127.0.0.1', port=0):
+        self.standin = standin
+        self.server = make_server(host, port, standin.app(), threaded=True, request_handler=_QuietRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        return f'{self.server.host}:{self.server.port}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.thread.join()
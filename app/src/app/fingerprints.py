@@ -0,0 +1,211 @@
+import os
+import re
+import json
+import unicodedata
+from hashlib import sha256
+
+from celery.utils.log import get_task_logger
+
+''' canonical fingerprints of filemaker records and a local index of the synced ones '''
+
+logger = get_task_logger(__name__)
+
+# the prefix of the ids of filemaker record documents, old and new ones
+FILEMAKER_RECORD_PREFIX = 'filemaker_record_row_'
+
+# keys of a stored filemaker record document that arent filemaker fields
+DOCUMENT_KEYS = {'_id', '_rev', 'id', 'document_type'}
+
+# bytes of a sha256 digest that the index keeps, enough to never collide
+# for the size of our table, but half the size
+INDEX_DIGEST_BYTES = 16
+INDEX_VERSION = 2
+
+# documents read at once when the index is built or caught up
+INDEX_BATCH_SIZE = 1000
+
+# ids of documents that were synced before the recordId ids, the suffix is
+# the hash of the whole record, see app.tasks_impl.get_filemaker_id
+_LEGACY_ID = re.compile('[0-9a-f]{64}')
+
+
+def _normalize(value):
+    ''' the same value however filemaker formatted it '''
+    if isinstance(value, str):
+        return unicodedata.normalize('NFC', value).strip()
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def record_fingerprint(field_data: dict) -> str:
+    ''' the hex sha256 of the canonical json of the field data of a record
+
+    keys are sorted and the values normalized, so the fingerprint doesnt
+    change with the field order or with whitespace around values. the
+    recordId and modId are not part of it, so the fingerprint of a stored
+    record document is the one of the record it was made from
+    '''
+    canonical = {k: _normalize(v) for k, v in field_data.items() if k not in DOCUMENT_KEYS}
+    data = json.dumps(canonical, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return sha256(data.encode('utf-8')).hexdigest()
+
+
+def row_fingerprint(record_id, fingerprint: str) -> str:
+    ''' the fingerprint of a filemaker row, of its recordId and the fingerprint
+    of its field data. rows with the same content are different rows, a row
+    whose content changed gets a new fingerprint
+    '''
+    return sha256(f'{record_id}:{fingerprint}'.encode('utf-8')).hexdigest()
+
+
+def document_fingerprint(doc):
+    ''' the index fingerprint of a stored record document and whether it has a
+    legacy id, None for ids of neither kind
+
+    documents with the recordId as id have the row fingerprint, the legacy
+    ones their id hash, it is the same for the same record
+    '''
+    suffix = doc['_id'][len(FILEMAKER_RECORD_PREFIX):]
+    if suffix.isdigit():
+        return row_fingerprint(suffix, record_fingerprint(doc)), False
+    if _LEGACY_ID.fullmatch(suffix):
+        return suffix, True
+    return None, False
+
+
+class FingerprintIndex:
+    '''
+    the fingerprints of all filemaker record documents, for deciding which
+    records of a page are new without asking couchdb
+
+    the fingerprints are a sorted array of truncated digests, persisted as
+    one file together with the sequence of the _changes feed it reflects.
+    opening it catches up with the changes of other workers, a deleted record
+    document makes it rebuild from the database
+
+    legacy_ids tells if documents with legacy ids were indexed, only then
+    the records have to be looked up by their legacy id hash too
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.seq = 0
+        self.legacy_ids = False
+        self._sorted = b''
+        self._added = set()
+
+    def __len__(self):
+        return len(self._sorted) // INDEX_DIGEST_BYTES + len(self._added)
+
+    @staticmethod
+    def _key(fingerprint):
+        return bytes.fromhex(fingerprint)[:INDEX_DIGEST_BYTES]
+
+    def _in_sorted(self, key):
+        n = len(self._sorted) // INDEX_DIGEST_BYTES
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k = self._sorted[mid*INDEX_DIGEST_BYTES:(mid+1)*INDEX_DIGEST_BYTES]
+            if k < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < n and self._sorted[lo*INDEX_DIGEST_BYTES:(lo+1)*INDEX_DIGEST_BYTES] == key
+
+    def __contains__(self, fingerprint):
+        key = self._key(fingerprint)
+        return key in self._added or self._in_sorted(key)
+
+    def add(self, fingerprint):
+        self._added.add(self._key(fingerprint))
+
+    def add_document(self, doc):
+        fingerprint, legacy = document_fingerprint(doc)
+        if fingerprint is None:
+            logger.warning(f"ignoring the filemaker record document with the unknown id {doc['_id']}")
+            return
+        self.add(fingerprint)
+        self.legacy_ids = self.legacy_ids or legacy
+
+    def _keys(self):
+        return {self._sorted[i:i+INDEX_DIGEST_BYTES] for i in range(0, len(self._sorted), INDEX_DIGEST_BYTES)}
+
+    def compact(self):
+        ''' merge the added fingerprints into the sorted array '''
+        if len(self._added) > 0:
+            self._sorted = b''.join(sorted(self._keys() | self._added))
+            self._added = set()
+
+    def save(self):
+        ''' write the index atomically, a no-op for indexes without path '''
+        if self.path is None:
+            return
+        self.compact()
+        header = {'version': INDEX_VERSION, 'seq': self.seq, 'digest_bytes': INDEX_DIGEST_BYTES, 'legacy_ids': self.legacy_ids}
+        tmp = f'{self.path}.tmp'
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            f.write(self._sorted)
+        os.replace(tmp, self.path)
+
+    def _load(self):
+        ''' read the file, returns False if it is missing or of another format '''
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        with open(self.path, 'rb') as f:
+            header = json.loads(f.readline())
+            if header.get('version') != INDEX_VERSION or header.get('digest_bytes') != INDEX_DIGEST_BYTES:
+                return False
+            self._sorted = f.read()
+        self.seq = header['seq']
+        self.legacy_ids = header['legacy_ids']
+        self._added = set()
+        return True
+
+    def build(self, db):
+        ''' read the fingerprints of all filemaker record documents '''
+        _, result = db.couchdb.resource.get('_changes', params={'since': 'now', 'limit': 0})
+        self.seq = result['last_seq']
+        self.legacy_ids = False
+        self._sorted = b''
+        self._added = set()
+
+        startkey = FILEMAKER_RECORD_PREFIX
+        while True:
+            rows = db.all_docs(include_docs=True, startkey=startkey, endkey=FILEMAKER_RECORD_PREFIX + '\ufff0',
+                    limit=INDEX_BATCH_SIZE + 1).rows
+            for row in rows[:INDEX_BATCH_SIZE]:
+                self.add_document(row['doc'])
+            if len(rows) <= INDEX_BATCH_SIZE:
+                break
+            startkey = rows[-1]['id']
+
+        self.compact()
+        logger.info(f'built the filemaker fingerprint index of {len(self)} records')
+
+    def catch_up(self, db):
+        ''' add the records that were saved since the index was written,
+        returns False if records were deleted and the index has to be rebuilt
+        '''
+        selector = {'_id': {'$gt': FILEMAKER_RECORD_PREFIX, '$lt': FILEMAKER_RECORD_PREFIX + '\ufff0'}}
+        while True:
+            result = db.changes(since=self.seq, limit=INDEX_BATCH_SIZE, include_docs=True, selector=selector)
+            for change in result['results']:
+                if change.get('deleted', False):
+                    return False
+                self.add_document(change['doc'])
+            self.seq = result['last_seq']
+            if len(result['results']) < INDEX_BATCH_SIZE:
+                return True
+
+    @staticmethod
+    def open(db, path=None):
+        ''' the up to date index of the database, kept in the file at path if given '''
+        index = FingerprintIndex(path)
+        if not (index._load() and index.catch_up(db)):
+            index.build(db)
+        index.save()
+        return index
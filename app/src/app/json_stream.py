@@ -0,0 +1,112 @@
+import json
+import codecs
+
+''' incremental decoding of the items of a large json array
+
+the array is found by its key path and its items are decoded one by one
+from the chunks, so only the current item and one chunk are held in memory
+'''
+
+_decoder = json.JSONDecoder()
+
+_WHITESPACE = ' \t\n\r'
+
+
+class _Buffer:
+    ''' the decoded text of the chunks that is not consumed yet '''
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+        self.exhausted = False
+
+    def more(self):
+        ''' append the next chunk, returns False at the end of the chunks '''
+        if self.exhausted:
+            return False
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self.exhausted = True
+            self.text = self.text[self.pos:] + self._utf8.decode(b'', final=True)
+            self.pos = 0
+            return False
+
+        if isinstance(chunk, bytes):
+            chunk = self._utf8.decode(chunk)
+        # drop the consumed text, so the buffer doesnt grow with the document
+        self.text = self.text[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        ''' the next character that isnt whitespace, without consuming it '''
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.more():
+                raise ValueError('unexpected end of the json document')
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError(f'expected {c!r} at {self.text[self.pos:self.pos+20]!r}')
+        self.pos += 1
+
+    def value(self):
+        ''' decode the next json value
+
+        numbers and literals at the end of the buffer might continue
+        in the next chunk, so a value is only taken if something follows it
+        '''
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+                if end < len(self.text) or self.exhausted:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.exhausted:
+                    raise
+            self.more()
+
+
+def iter_json_array(chunks, path):
+    '''
+    yields the items of the array at the key path, like
+    json.loads(b''.join(chunks))[path[0]][path[1]]...
+
+    chunks are bytes or str, the keys before the array are decoded and
+    skipped, everything after the array is not read
+    '''
+    buf = _Buffer(chunks)
+
+    for key in path:
+        buf.expect('{')
+        while True:
+            if buf.peek() == '}':
+                raise KeyError(key)
+            k = buf.value()
+            buf.expect(':')
+            if k == key:
+                break
+            # skip the value of another key
+            buf.value()
+            if buf.peek() == ',':
+                buf.pos += 1
+
+    buf.expect('[')
+    if buf.peek() == ']':
+        return
+    while True:
+        yield buf.value()
+        c = buf.peek()
+        buf.pos += 1
+        if c == ']':
+            return
+        elif c != ',':
+            raise ValueError(f'expected , or ] after an array item, not {c!r}')
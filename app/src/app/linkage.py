@@ -0,0 +1,306 @@
+import re
+import unicodedata
+from zlib import crc32
+from datetime import datetime
+from itertools import combinations
+from functools import lru_cache
+
+import numpy as np
+
+from celery.utils.log import get_task_logger
+
+from app.model import PatientMergeSuggestion
+
+''' record linkage of patients whose names or birthdates are written differently
+
+the patients/patient_aggregation view groups the examinations by their exact
+name and birthdate, so spelling variants, transliterated umlauts and changed
+names become separate patients. linkage finds the pairs of patients that are
+probably the same person and queues them for review:
+
+blocking: every patient is put into a few blocks by phonetic name keys and
+    the birthdate, only patients that share a block are compared. the number
+    of comparisons grows with the number of patients, not with its square
+scoring: names are compared as trigram bit vectors and birthdates by their
+    components, for all candidate pairs at once with numpy
+review: pairs above the threshold become PatientMergeSuggestion documents,
+    merging the patients of an accepted suggestion is done by hand
+'''
+
+logger = get_task_logger(__name__)
+
+# umlauts are written like this in passports and by people without a german keyboard
+TRANSLITERATIONS = {'ä': 'ae', 'ö': 'oe', 'ü': 'ue', 'ß': 'ss'}
+
+# size of the bit vectors the trigrams of a name are hashed into
+TRIGRAM_BITS = 256
+_WORDS = TRIGRAM_BITS // 64
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# bigger blocks, like a very common name without birthdate, dont tell
+# patients apart and all their pairs would be compared, so they are skipped
+MAX_BLOCK_SIZE = 100
+
+# the score is the weighted sum of the similarities, minus the penalty
+# if the genders differ. a changed lastname still scores 0.7
+WEIGHTS = {'lastname': 0.3, 'firstname': 0.35, 'birthdate': 0.35}
+GENDER_PENALTY = 0.1
+SUGGESTION_THRESHOLD = 0.7
+
+# candidate pairs that are scored at once, bounds the memory of the arrays
+SCORE_BATCH_SIZE = 100000
+
+
+def normalize_name(name):
+    ''' lowercase ascii words, umlauts are transliterated and other accents dropped '''
+    name = (name or '').lower()
+    for k, v in TRANSLITERATIONS.items():
+        name = name.replace(k, v)
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return ' '.join(re.findall('[a-z]+', name))
+
+
+def _cologne_code(s, i):
+    c = s[i]
+    prev = s[i-1] if i > 0 else ''
+    nxt = s[i+1] if i+1 < len(s) else ''
+
+    if c in 'aeijouy':
+        return '0'
+    elif c == 'b':
+        return '1'
+    elif c == 'p':
+        return '3' if nxt == 'h' else '1'
+    elif c in 'dt':
+        return '8' if nxt in ('c', 's', 'z') else '2'
+    elif c in 'fvw':
+        return '3'
+    elif c in 'gkq':
+        return '4'
+    elif c == 'c':
+        if i == 0:
+            return '4' if nxt in ('a', 'h', 'k', 'l', 'o', 'q', 'r', 'u', 'x') else '8'
+        if prev in ('s', 'z') or nxt not in ('a', 'h', 'k', 'o', 'q', 'u', 'x'):
+            return '8'
+        return '4'
+    elif c == 'x':
+        return '8' if prev in ('c', 'k', 'q') else '48'
+    elif c == 'l':
+        return '5'
+    elif c in 'mn':
+        return '6'
+    elif c == 'r':
+        return '7'
+    elif c in 'sz':
+        return '8'
+    # h and everything else
+    return ''
+
+
+def cologne_phonetic(name):
+    ''' the koelner phonetik of a normalized name, german names that sound
+    the same have the same code, like meier, mayer and maier
+    '''
+    s = name.replace(' ', '')
+    codes = ''.join(_cologne_code(s, i) for i in range(len(s)))
+
+    collapsed = [c for i, c in enumerate(codes) if i == 0 or c != codes[i-1]]
+    return ''.join(c for i, c in enumerate(collapsed) if i == 0 or c != '0')
+
+
+def trigram_bits(name):
+    ''' the trigrams of the padded name hashed into an int of TRIGRAM_BITS bits '''
+    if name == '':
+        return 0
+    padded = f'  {name} '
+    bits = 0
+    for i in range(len(padded) - 2):
+        bits |= 1 << (crc32(padded[i:i+3].encode('utf-8')) % TRIGRAM_BITS)
+    return bits
+
+
+def _bit_array(bits):
+    ''' the bit vectors as array of shape (n, _WORDS) '''
+    mask = (1 << 64) - 1
+    return np.array([[(b >> (64*w)) & mask for w in range(_WORDS)] for b in bits], dtype=np.uint64).reshape(-1, _WORDS)
+
+
+def _popcount(a):
+    return _POPCOUNT[a.view(np.uint8)].reshape(len(a), -1).sum(axis=1)
+
+
+def _jaccard(a, b):
+    union = _popcount(a | b)
+    return np.where(union > 0, _popcount(a & b) / np.maximum(union, 1), 0.)
+
+
+@lru_cache(maxsize=65536)
+def _name_features(name):
+    ''' the normalized name, its phonetic code and trigram bits,
+    cached because many patients have common first and last names
+    '''
+    normalized = normalize_name(name)
+    return normalized, cologne_phonetic(normalized), trigram_bits(normalized)
+
+
+class PatientFeatures:
+    ''' the normalized names, blocking keys and comparison arrays of patients '''
+
+    def __init__(self, patients):
+        self.ids = []
+        self.keys = []
+        lastnames, firstnames, birthdates, genders = [], [], [], []
+
+        for p in patients:
+            _, last, last_bits = _name_features(p.names.get('lastname'))
+            _, first, first_bits = _name_features(p.names.get('firstname'))
+            b = p.birthdate
+            self.ids.append(p.id)
+            self.keys.append(blocking_keys(last, first, b))
+            lastnames.append(last_bits)
+            firstnames.append(first_bits)
+            birthdates.append((b.year, b.month, b.day) if b is not None else (0, 0, 0))
+            genders.append(p.gender or '')
+
+        self.lastname = _bit_array(lastnames)
+        self.firstname = _bit_array(firstnames)
+        self.birthdate = np.array(birthdates, dtype=np.int32).reshape(-1, 3)
+        self.gender = np.array(genders, dtype=str)
+        self.gender_known = np.array([g != '' for g in genders], dtype=bool)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def blocking_keys(last, first, birthdate):
+    ''' the blocks of a patient by the phonetic codes of its names,
+    patients that share a block are compared
+
+    a misspelled lastname shares the block of the firstname and the birthdate
+    and the other way round, a wrong birthdate the block of both names
+    '''
+    b = birthdate.date().isoformat() if birthdate is not None else ''
+    keys = []
+    if last != '':
+        keys.append(('lastname', last, b))
+    if first != '':
+        keys.append(('firstname', first, b))
+    if last != '' and first != '':
+        keys.append(('names', last, first))
+    return keys
+
+
+def candidate_pairs(features, max_block_size=MAX_BLOCK_SIZE):
+    ''' index arrays i < j of the patients that share a block '''
+    blocks = {}
+    for i, keys in enumerate(features.keys):
+        for k in keys:
+            blocks.setdefault(k, []).append(i)
+
+    pairs = set()
+    skipped = 0
+    for members in blocks.values():
+        if len(members) > max_block_size:
+            skipped += 1
+            continue
+        pairs.update(combinations(members, 2))
+
+    if skipped > 0:
+        logger.warning(f'skipped {skipped} blocks of more than {max_block_size} patients')
+
+    pairs = np.array(sorted(pairs), dtype=np.int64).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def score_pairs(features, i, j):
+    ''' the scores and the similarities of the pairs of patients i[k], j[k] '''
+    bi, bj = features.birthdate[i], features.birthdate[j]
+    equal = (bi == bj).sum(axis=1)
+    swapped = (bi[:, 0] == bj[:, 0]) & (bi[:, 1] == bj[:, 2]) & (bi[:, 2] == bj[:, 1])
+    unknown = (bi[:, 0] == 0) | (bj[:, 0] == 0)
+    # a typo in one component or swapped day and month are half a match
+    birthdate = np.where(unknown, 0.5, np.where(equal == 3, 1., np.where((equal == 2) | swapped, 0.5, 0.)))
+
+    similarities = {
+        'lastname': _jaccard(features.lastname[i], features.lastname[j]),
+        'firstname': _jaccard(features.firstname[i], features.firstname[j]),
+        'birthdate': birthdate,
+        }
+    score = sum(WEIGHTS[k] * s for k, s in similarities.items())
+
+    gender_differs = features.gender_known[i] & features.gender_known[j] & (features.gender[i] != features.gender[j])
+    score = score - GENDER_PENALTY * gender_differs
+    return score, similarities
+
+
+def find_duplicates(patients, threshold=SUGGESTION_THRESHOLD, max_block_size=MAX_BLOCK_SIZE):
+    ''' the pairs of patients that are probably the same person,
+    as list of (patient_id, patient_id, score, similarities) sorted by score
+    '''
+    features = PatientFeatures(patients)
+    i, j = candidate_pairs(features, max_block_size)
+    logger.info(f'comparing {len(i)} candidate pairs of {len(features)} patients')
+
+    duplicates = []
+    for start in range(0, len(i), SCORE_BATCH_SIZE):
+        bi, bj = i[start:start+SCORE_BATCH_SIZE], j[start:start+SCORE_BATCH_SIZE]
+        score, similarities = score_pairs(features, bi, bj)
+        for k in np.nonzero(score >= threshold)[0]:
+            duplicates.append((
+                features.ids[bi[k]],
+                features.ids[bj[k]],
+                round(float(score[k]), 3),
+                {name: round(float(s[k]), 3) for name, s in similarities.items()},
+                ))
+
+    duplicates.sort(key=lambda d: d[2], reverse=True)
+    return duplicates
+
+
+def suggestion_id(patient_a, patient_b):
+    ''' the same for both orders of the patients, so a pair is suggested only once '''
+    a, b = sorted([patient_a, patient_b])
+    return f'patient_merge_suggestion_{a}_{b}'
+
+
+def suggest_patient_merges(db, threshold=SUGGESTION_THRESHOLD, max_block_size=MAX_BLOCK_SIZE):
+    ''' queue the probable duplicates of all patients for review, returns the new suggestions
+
+    pairs that were suggested before keep their suggestion and its review status
+    '''
+    patients = db.query('patients/patients', include_docs=True, lazy=True).to_wrapped().docs()
+    duplicates = find_duplicates(patients, threshold, max_block_size)
+
+    now = datetime.now()
+    suggestions = [
+        PatientMergeSuggestion(
+            id=suggestion_id(a, b),
+            patients=sorted([a, b]),
+            score=score,
+            similarities=similarities,
+            created_time=now,
+            ) for a, b, score, similarities in duplicates]
+
+    existing = db.exists_many([s.id for s in suggestions])
+    new = [s for s in suggestions if s.id not in existing]
+    if len(new) > 0:
+        db.save_bulk(new)
+
+    logger.info(f'found {len(suggestions)} probable duplicate patients, {len(new)} new merge suggestions')
+    return new
+
+
+def merge_suggestions(db, status='open'):
+    ''' the suggestions with the review status, the most probable first '''
+    selector = {'document_type': 'patient_merge_suggestion', 'status': status}
+    suggestions = list(db.find_lazy(selector).to_wrapped().docs())
+    return sorted(suggestions, key=lambda s: s.score, reverse=True)
+
+
+def review_merge_suggestion(db, suggestion_id, accept):
+    ''' accept or reject a suggestion, returns the updated suggestion '''
+    suggestion = db.get(suggestion_id, cached=False)
+    reviewed = suggestion.model_copy(update={'status': 'accepted' if accept else 'rejected'})
+    db.save(reviewed)
+    return reviewed
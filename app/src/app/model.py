@@ -65,8 +65,15 @@ class BaseDocument(BaseModel):
 
 
 class PipelineLogs(BaseModel):
+    ''' the last lines of the logs, the whole logs are stored
+    in PipelineLogChunk documents, see app.pipeline_logs
+    '''
     stdout: str
     stderr: str
+    stdout_bytes: int = 0
+    stderr_bytes: int = 0
+    stdout_chunks: int = 0
+    stderr_chunks: int = 0
 
 
 class PipelineRun(BaseDocument):
@@ -79,6 +86,17 @@ class PipelineRun(BaseDocument):
     logs: PipelineLogs
 
 
+class PipelineLogChunk(BaseDocument):
+    ''' a piece of the stdout or stderr of a pipeline run,
+    starting at the byte offset in the log
+    '''
+    document_type: str = 'pipeline_log_chunk'
+    pipeline_run: str
+    stream: Literal['stdout', 'stderr']
+    offset: int
+    data: str
+
+
 class SequencerRun(BaseDocument):
     document_type: str = 'sequencer_run'
     original_path: Path
@@ -141,6 +159,16 @@ class Patient(Person):
     birthdate: Optional[datetime]
     gender: str
 
+class PatientMergeSuggestion(BaseDocument):
+    ''' two patients that are probably the same person, see app.linkage '''
+    document_type: str = 'patient_merge_suggestion'
+    patients: List[str]
+    score: float
+    # similarity of the compared fields, between 0 and 1
+    similarities: dict[str,float]
+    status: Literal['open', 'accepted', 'rejected'] = 'open'
+    created_time: datetime
+
 class Pathologist(Person):
     short_name: str
 
@@ -153,8 +181,10 @@ class Result(BaseModel):
 document_class_map = {
         'sequencer_run': SequencerRun, 
         'pipeline_run': PipelineRun, 
+        'pipeline_log_chunk': PipelineLogChunk,
         'examination': Examination, 
-        'patient': Patient
+        'patient': Patient,
+        'patient_merge_suggestion': PatientMergeSuggestion,
         }
 
 
@@ -180,7 +210,8 @@ class Sequencer:
     def scan_output_files(self):
         pass
 
-class Examination:
+# not named Examination, that would shadow the Examination document above
+class ExaminationActor:
     def __init__(self, *args, **kwargs):
         pass
 
@@ -36,3 +36,13 @@ def parse_miseq_run_name(name):
 
 def parse_date(datestr):
     return datetime.strptime(datestr, '%m/%d/%Y')
+
+
+def birthdate_key(datestr):
+    ''' the iso date of a filemaker date with or without leading zeros,
+    strings that arent dates are returned as they are
+    '''
+    try:
+        return parse_date(datestr).date().isoformat()
+    except (TypeError, ValueError):
+        return datestr
@@ -0,0 +1,168 @@
+import codecs
+import time
+
+from app.model import PipelineLogChunk
+
+''' append-only storage of the stdout and stderr of pipeline runs '''
+
+# maximum bytes of log data in one chunk document
+LOG_CHUNK_BYTES = 64*1024
+
+# characters of the end of the logs that the pipeline run document keeps
+LOG_TAIL_CHARS = 4*1024
+
+LOG_STREAMS = ['stdout', 'stderr']
+
+
+def log_chunk_id(pipeline_run_id, stream, offset):
+    ''' the zero padded offset makes _all_docs return the chunks in order '''
+    return f'pipeline_log_{pipeline_run_id}_{stream}_{offset:012d}'
+
+
+def _chunk_id_prefix(pipeline_run_id, stream):
+    return f'pipeline_log_{pipeline_run_id}_{stream}_'
+
+
+def split_utf8(data: bytes, size: int):
+    ''' split utf-8 encoded bytes into pieces of at most size bytes
+    without cutting through a character
+    '''
+    pieces = []
+    while len(data) > size:
+        end = size
+        # continuation bytes look like 0b10xxxxxx
+        while end > 0 and data[end] & 0xC0 == 0x80:
+            end -= 1
+        pieces.append(data[:end])
+        data = data[end:]
+    if len(data) > 0:
+        pieces.append(data)
+    return pieces
+
+
+class LogAppender:
+    '''
+    copies the new output of a growing log file into chunk documents
+
+    every poll only reads the file from the last position, so the work is
+    linear in the log size. the chunk documents are never changed, the
+    pipeline run keeps only the tail of the log and the counters
+
+    offsets count the utf-8 bytes of the stored log, invalid bytes
+    of the file are stored as replacement characters
+    '''
+
+    def __init__(self, db, pipeline_run_id, stream, f):
+        if stream not in LOG_STREAMS:
+            raise RuntimeError(f'invalid log stream {stream}, use one of {LOG_STREAMS}')
+
+        self.db = db
+        self.pipeline_run_id = pipeline_run_id
+        self.stream = stream
+        self.f = f
+        # position in the file
+        self.position = 0
+        # bytes of the stored log, it is the offset of the next chunk
+        self.offset = 0
+        self.chunks = 0
+        self.tail = ''
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def poll(self, final=False):
+        ''' store the output that was written since the last poll,
+        returns the number of new chunk documents
+
+        a multi byte character that is only partly written yet is stored by
+        the next poll, with final=True the incomplete bytes are stored anyway
+        '''
+        self.f.seek(self.position)
+        data = self.f.read()
+        self.position += len(data)
+
+        text = self._decoder.decode(data, final=final)
+        if len(text) == 0:
+            return 0
+
+        chunks = []
+        for piece in split_utf8(text.encode('utf-8'), LOG_CHUNK_BYTES):
+            chunks.append(PipelineLogChunk(
+                id=log_chunk_id(self.pipeline_run_id, self.stream, self.offset),
+                pipeline_run=self.pipeline_run_id,
+                stream=self.stream,
+                offset=self.offset,
+                data=piece.decode('utf-8'),
+                ))
+            self.offset += len(piece)
+
+        self.db.save_bulk(chunks)
+        self.chunks += len(chunks)
+        self.tail = (self.tail + text)[-LOG_TAIL_CHARS:]
+        return len(chunks)
+
+    def update_logs(self, logs):
+        ''' write the tail and the counters into the PipelineLogs of the run '''
+        setattr(logs, self.stream, self.tail)
+        setattr(logs, f'{self.stream}_bytes', self.offset)
+        setattr(logs, f'{self.stream}_chunks', self.chunks)
+
+
+def log_chunks(db, pipeline_run_id, stream, start=0):
+    ''' the chunks of a log in order, beginning with the chunk that contains the byte offset start '''
+    prefix = _chunk_id_prefix(pipeline_run_id, stream)
+
+    startkey = prefix
+    if start > 0:
+        # the last chunk that begins before start
+        first = db.all_docs(startkey=log_chunk_id(pipeline_run_id, stream, start), endkey=prefix, descending=True, limit=1)
+        if len(first.ids()) > 0:
+            startkey = first.ids()[0]
+
+    return db.all_docs(startkey=startkey, endkey=prefix + '\ufff0', include_docs=True).to_wrapped().docs()
+
+
+def read_log(db, pipeline_run_id, stream, start=0):
+    ''' the log of a pipeline run from the byte offset start '''
+    chunks = log_chunks(db, pipeline_run_id, stream, start)
+    if len(chunks) == 0:
+        return ''
+    data = ''.join(c.data for c in chunks).encode('utf-8')
+    skip = max(0, start - chunks[0].offset)
+    return data[skip:].decode('utf-8', errors='ignore')
+
+
+# statuses of pipeline runs whose logs dont grow anymore
+FINISHED_STATUSES = ['error', 'aborted', 'successful']
+
+
+def follow_log(db, pipeline_run_id, stream, start=0, poll_interval=1, timeout=None, sleep=time.sleep):
+    ''' yields (offset, text) for every new piece of the log from the byte
+    offset start, offset is the byte offset after text
+
+    only the small pipeline run document is fetched while nothing changes,
+    the chunks are read once they exist. ends when the run is finished and
+    its log is read completely, or after timeout seconds.
+    yields (offset, None) on polls without new data, so callers can keep
+    their connection alive
+    '''
+    offset = start
+    begin = time.monotonic()
+    while True:
+        run = db.get(pipeline_run_id)
+        size = getattr(run.logs, f'{stream}_bytes')
+
+        if size > offset:
+            text = read_log(db, pipeline_run_id, stream, start=offset)
+            # the chunks up to size exist, the bytes of a character that
+            # start cut through are dropped by read_log
+            offset = max(offset + len(text.encode('utf-8')), size)
+            yield offset, text
+        elif run.status in FINISHED_STATUSES:
+            return
+        else:
+            yield offset, None
+
+        if timeout is not None and time.monotonic() - begin >= timeout:
+            return
+
+        if size <= offset and run.status not in FINISHED_STATUSES:
+            sleep(poll_interval)
@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import errno
+import fcntl
+import select
+import struct
+import ctypes
+import ctypes.util
+from pathlib import Path
+from fnmatch import fnmatch
+from contextlib import contextmanager
+
+from celery.utils.log import get_task_logger
+
+''' incremental scanning of the sequencer output folder
+
+the scan index keeps the fastqs of every run folder together with the inode
+and mtimes of all folders of the run. a folder only gets a new mtime when
+entries are added, removed or renamed in it, so a run whose folders kept
+their mtimes has no new fastqs and isnt walked again. fastqs that appear
+later, also in new folders like another Alignment_* folder, change the mtime
+of a folder of the run. checking a run costs a stat per folder, not a listing
+
+the watcher uses inotify to hand new and changed runs to the ingest right
+away instead of at the next poll. inotify only sees changes made through
+the local kernel, on network storage the polling has to stay
+'''
+
+logger = get_task_logger(__name__)
+
+SCAN_INDEX_VERSION = 2
+
+FASTQ_PATTERN = '*.fastq.gz'
+
+# files that illumina sequencers and analysis software write into a run folder when they are done
+RUN_COMPLETE_MARKERS = {'RTAComplete.txt', 'CopyComplete.txt', 'CompletedJobInfo.xml'}
+
+
+def _dir_signature(path):
+    ''' the inode and mtime of a folder, None if it doesnt exist anymore '''
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_ino, st.st_mtime_ns]
+
+
+def scan_run(run_path):
+    ''' the sorted fastqs of a run folder and the signatures of all its folders
+
+    the signature of a folder is taken before it is listed, so entries that
+    are added while scanning change the signature and are found by the next scan
+    '''
+    fastqs = []
+    signature = {}
+    stack = [str(run_path)]
+    while len(stack) > 0:
+        folder = stack.pop()
+        sig = _dir_signature(folder)
+        if sig is None:
+            continue
+        signature[folder] = sig
+        try:
+            entries = list(os.scandir(folder))
+        except FileNotFoundError:
+            continue
+        for e in entries:
+            if e.is_dir(follow_symlinks=False):
+                stack.append(e.path)
+            elif fnmatch(e.name, FASTQ_PATTERN):
+                fastqs.append(e.path)
+    return sorted(fastqs), dict(sorted(signature.items()))
+
+
+class ScanIndex:
+    '''
+    run folder -> the signatures of its folders and its fastqs
+
+    persisted as a json file, a missing or unreadable file gives an empty
+    index, then every run is scanned and compared with the database once
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.runs = {}
+
+    def __contains__(self, run_path):
+        return str(run_path) in self.runs
+
+    def fastqs(self, run_path):
+        return self.runs[str(run_path)]['fastqs']
+
+    def changed(self, run_path):
+        ''' True if the run is unknown or one of its folders changed since it was scanned '''
+        entry = self.runs.get(str(run_path))
+        if entry is None:
+            return True
+        return any(_dir_signature(d) != sig for d, sig in entry['dirs'].items())
+
+    def update(self, run_path, fastqs, signature):
+        ''' remember the fastqs and folder signatures of a run, see scan_run '''
+        fastqs = sorted(str(f) for f in fastqs)
+        self.runs[str(run_path)] = {'dirs': signature, 'fastqs': fastqs}
+
+    def forget_missing(self, run_paths):
+        ''' drop the runs that arent in run_paths anymore '''
+        keep = {str(r) for r in run_paths}
+        self.runs = {r: e for r, e in self.runs.items() if r in keep}
+
+    def save(self):
+        ''' write the index atomically, a no-op for indexes without path '''
+        if self.path is None:
+            return
+        tmp = f'{self.path}.tmp'
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(tmp, 'w') as f:
+            json.dump({'version': SCAN_INDEX_VERSION, 'runs': self.runs}, f)
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def load(path=None):
+        index = ScanIndex(path)
+        if path is None or not os.path.exists(path):
+            return index
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except ValueError as e:
+            logger.warning(f'ignoring the unreadable sequencer scan index {path}: {e}')
+            return index
+        if data.get('version') == SCAN_INDEX_VERSION:
+            index.runs = data['runs']
+        return index
+
+
+@contextmanager
+def scan_lock(path):
+    ''' only one process of the host scans with the index at path at a time '''
+    if path is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f'{path}.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# inotify constants of <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    ''' the inotify api of the linux kernel, through ctypes '''
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), str(path))
+        return wd
+
+    def read(self, timeout=None):
+        ''' the events as (wd, mask, cookie, name), waits at most timeout seconds for them '''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return []
+        try:
+            data = os.read(self.fd, 64*1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, pos)
+            pos += _EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos+length].rstrip(b'\0'))
+            pos += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# events in the output folder and in the folders of new runs the watcher reacts to
+WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE
+
+
+class SequencerWatcher:
+    '''
+    calls on_runs with the run folders that got new fastqs or completion
+    markers, once settle seconds passed without further events for them
+
+    run folders that are created or moved into the output folder while
+    watching are watched recursively. older runs are left to the polling,
+    watching the whole archive would need more watches than the kernel allows
+    '''
+
+    def __init__(self, root, on_runs, settle=5., inotify=None):
+        self.root = Path(root)
+        self.on_runs = on_runs
+        self.settle = settle
+        self.inotify = inotify if inotify is not None else Inotify()
+        self.watches = {}
+        self.pending = {}
+
+    def _watch(self, path):
+        try:
+            wd = self.inotify.add_watch(path, WATCH_MASK)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                logger.error(f'cant watch {path}, raise fs.inotify.max_user_watches')
+            else:
+                logger.warning(f'cant watch {path}: {e}')
+            return
+        self.watches[wd] = Path(path)
+
+    def _watch_tree(self, path):
+        ''' watch a folder and its subfolders, files that were written before the watch are found by the scan '''
+        for dirpath, _, _ in os.walk(path):
+            self._watch(dirpath)
+
+    def _run_of(self, path):
+        return self.root / path.relative_to(self.root).parts[0]
+
+    def handle(self, events, now=None):
+        ''' update the watches and the pending runs with a batch of events '''
+        now = time.monotonic() if now is None else now
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                logger.warning('inotify queue overflowed, events were lost until the next poll')
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            folder = self.watches.get(wd)
+            if folder is None or name == '':
+                continue
+            path = folder / name
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path)
+                    if folder == self.root or mask & IN_MOVED_TO:
+                        self.pending[self._run_of(path)] = now
+            elif folder != self.root and (name.endswith('.fastq.gz') or name in RUN_COMPLETE_MARKERS):
+                self.pending[self._run_of(path)] = now
+
+    def settled(self, now=None):
+        ''' remove and return the pending runs without events for settle seconds '''
+        now = time.monotonic() if now is None else now
+        runs = sorted(r for r, t in self.pending.items() if now - t >= self.settle)
+        for r in runs:
+            del self.pending[r]
+        return runs
+
+    def run(self, timeout=None):
+        ''' watch until timeout seconds passed, forever if it is None '''
+        self._watch(self.root)
+        begin = time.monotonic()
+        while timeout is None or time.monotonic() - begin < timeout:
+            self.handle(self.inotify.read(timeout=min(1., self.settle)))
+            runs = self.settled()
+            if len(runs) > 0:
+                logger.info(f'sequencer runs changed: {runs}')
+                self.on_runs([str(r) for r in runs])
@@ -1,18 +1,20 @@
 from celery import Celery, chain, group
-rom celery.utils.log import get_task_logger
+from celery.utils.log import get_task_logger
 from celery.contrib.abortable import AbortableTask
 
-from app.tasks_utils import Schedule
+from app.tasks_utils import Schedule, Timeout
 from app.model import filemaker_examination_types
-from app.tasks_impl import (run_app_schedule_impl, start_workflow_impl, processor,
-    retrieve_new_filemaker_data_incremental, create_examinations, aggregate_patients, 
-    poll_sequencer_output, collect_work, get_samples_of_examination)
+from app.tasks_impl import (start_workflow_impl, processor,
+    retrieve_new_filemaker_data_incremental, retrieve_new_filemaker_data_delta, create_examinations, aggregate_patients, 
+    poll_sequencer_output, collect_work, get_samples_of_examination, sync_changes)
 
 from app.db import DB
 from app.config import CONFIG
-from app.filemaker_api import Filemaker
+from app.filemaker_api import Filemaker, RateController
+from app.fingerprints import FingerprintIndex
 #import app.app
 from functools import wraps
+from time import sleep
 
 logger = get_task_logger(__name__)
 
@@ -32,18 +34,57 @@ def setup_periodic_tasks(sender, **kwargs):
     sender.add_periodic_task(10.0, sig, name='check for dynamically scheduled tasks')
 
 
+@mq.task
+def warm_views(poll_interval=10., timeout=None):
+    ''' update the view indexes in the background and log their progress,
+    for at most timeout seconds, couchdb_warm_views_timeout if None
+    '''
+    if timeout is None:
+        timeout = CONFIG['couchdb_warm_views_timeout']
+    deadline = Timeout(timeout)
+
+    db.warm_views()
+    while True:
+        progress = db.indexer_progress()
+        if len(progress) == 0:
+            break
+        for p in progress:
+            logger.info(f"indexing {p['design_document']}: {p['progress']}%")
+        if deadline.reached():
+            logger.warning(f'stopped following the view indexing after {timeout} seconds, it is still running')
+            break
+        sleep(poll_interval)
+
+
 @mq.task
 def sync_couchdb_to_filemaker():
-    filemaker = Filemaker.from_config(CONFIG)
-    retrieve_new_filemaker_data_incremental(filemaker, processor, backoff_time=5)
-    create_examinations()
-    aggregate_patients()
+    rate = RateController(target_latency=CONFIG['filemaker_target_latency'])
+    # logs out afterwards, filemaker limits the open sessions
+    if CONFIG['filemaker_sync_mode'] == 'delta':
+        retrieve = retrieve_new_filemaker_data_delta
+    else:
+        retrieve = retrieve_new_filemaker_data_incremental
+    index = FingerprintIndex.open(db, CONFIG['filemaker_fingerprint_index'])
+    with Filemaker.from_config(CONFIG) as filemaker:
+        batches = retrieve(filemaker, processor,
+                prefetch=CONFIG['filemaker_prefetch_pages'], rate=rate, stream=True, index=index)
+    if batches > 0:
+        # build the indexes of the new records before anyone reads them
+        warm_views.apply_async()
+    sync_changes()
 
 
 @mq.task
 def sync_sequencer_output():
     poll_sequencer_output()
 
+
+@mq.task
+def sync_sequencer_runs(runs):
+    ''' ingest the run folders that the sequencer watcher reported '''
+    poll_sequencer_output(runs=runs)
+
+
 @mq.task(bind=True, base=AbortableTask)
 def start_workflow_single(self, args):
     return_code = start_single_workflow(self.is_aborted, args)
@@ -68,12 +109,12 @@ def start_pipeline(*args):
 
     panel_types = set()
 
-    for e in db.query('examinations/types').to_wrapped().values():
-        panel_types.add(e.examinationtype)
+    for examinationtype in db.query('examinations/types?group=true').keys():
+        panel_types.add(examinationtype)
 
     sync_couchdb_to_filemaker()
     sync_sequencer_output()
-    groups = collect_work()
+    groups = collect_work(incremental=True)
     work = {}
 
     for panel in panel_types:
@@ -1,24 +1,32 @@
 from typing import Optional, Literal, List
 
-from time import sleep
+from time import sleep, monotonic
 from itertools import count, groupby
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, date
+from functools import partial
 from uuid import uuid4
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 from celery.utils.log import get_task_logger
 
-from more_itertools import flatten
+from more_itertools import flatten, chunked
 
-from app.parsers import parse_fastq_name, parse_miseq_run_name, parse_date
+from app.parsers import parse_fastq_name, parse_miseq_run_name, parse_date, birthdate_key
 from app.model import SequencerRun, PipelineRun, Examination, Patient, filemaker_examination_types, document_class_map, BaseDocument, panel_types
 from app.tasks_utils import Timeout 
+from app.fingerprints import FingerprintIndex, record_fingerprint, row_fingerprint, FILEMAKER_RECORD_PREFIX
+from app.filemaker_api import RateController, iter_pages, page_size, FILEMAKER_PREFETCH_PAGES
 from app.workflow_backends import workflow_backend_execute
 
-from app.db import DB
+from app.db import DB, MissingDocument, NotFound
+from app.db_bulk import BULK_WRITE_BATCH_SIZE
+from app.changes import ChangesConsumer
+from app.sequencer_scan import ScanIndex, scan_lock, scan_run
 from app.config import CONFIG
 
+import os
 import json
 from hashlib import sha256
 
@@ -32,72 +40,181 @@ def build_obj(obj: dict) -> BaseDocument:
     return data_obj
 
 def get_filemaker_id(filemaker_record):
+    ''' the id hash of records that were synced before the recordId ids,
+    it depends on the field order, see record_fingerprint
+    '''
     bi = str(json.dumps(filemaker_record)).encode('utf-8')
     dig = fid = sha256(bi).hexdigest()
     return dig
 
+def filemaker_record_doc_id(filemaker_record):
+    return f"{FILEMAKER_RECORD_PREFIX}{filemaker_record['recordId']}"
+
+def filemaker_row_fingerprint(filemaker_record):
+    return row_fingerprint(filemaker_record['recordId'], record_fingerprint(filemaker_record['fieldData']))
+
 def processor(record: dict) -> dict:
     d = record['fieldData']
-    fid = get_filemaker_id(record)
-    d['id'] = f"filemaker_record_row_{fid}"
+    d['id'] = filemaker_record_doc_id(record)
     d['document_type'] = 'filemaker_record'
     return d
 
 
-def retrieve_new_filemaker_data_incremental(filemaker, processor, backoff_time=5):
+# filemaker records that are deduplicated and saved together, bounds the
+# memory of a sync independently of the filemaker page size
+FILEMAKER_SAVE_BATCH_SIZE = 200
+
+def _save_new_filemaker_records(records, processor, index, on_batch=None):
+    '''
+    save the new and changed records, the ones that arent in the fingerprint
+    index yet, in batches while iterating records, on_batch(batch) is called
+    before a batch is processed. returns the number of records and of new records
+    '''
+    count = 0
+    new_count = 0
+    for batch in chunked(records, FILEMAKER_SAVE_BATCH_SIZE):
+        count += len(batch)
+        if on_batch is not None:
+            on_batch(batch)
+
+        # the fingerprint is computed once, the index knows the records
+        # that are saved already, the ones with legacy ids by their id hash
+        new_records = {}
+        for r in batch:
+            fingerprint = filemaker_row_fingerprint(r)
+            if fingerprint in index or (index.legacy_ids and get_filemaker_id(r) in index):
+                continue
+            new_records[fingerprint] = r
+        new_count += len(new_records)
+
+        # a changed record replaces the document of its row
+        DB.save_bulk([processor(r) for r in new_records.values()], merge='ours')
+        for fingerprint in new_records:
+            index.add(fingerprint)
+    return count, new_count
+
+def retrieve_new_filemaker_data_incremental(filemaker, processor, index, backoff_time=0, prefetch=FILEMAKER_PREFETCH_PAGES, rate=None, stream=False):
     '''
     iterate through the highest filemaker records according to recordid and appstate
     do so in 1000 record batches
 
+    the next prefetch batches are fetched while the current one is saved,
+    backoff_time is the minimal pause between filemaker requests, the
+    rate controller makes it longer while filemaker is slow or fails.
+    with stream=True the records are decoded one by one from the responses.
+    new and changed records are recognized with the FingerprintIndex index,
+    open it once per sync with FingerprintIndex.open and the persisted file
+
     if there are less records in filemaker than the couchdb, raise an error
-    iteratively save the new latest record id
+    iteratively save the new latest record id, strictly in order
     '''
     timeout = Timeout(2*60*60) # 2h in seconds
 
-    app_state = DB.get('app_state')
+    if rate is None:
+        rate = RateController(delay=backoff_time, min_delay=backoff_time)
+
+    app_state = DB.get('app_state', cached=False)
     last_synced_row = int(app_state['last_synced_filemaker_row'])
 
     batch_size = 1000
+    batches_done = 0
 
-    for batches_done in count():
-        try:
-            # backoff for a few seconds
-            sleep(backoff_time)
+    def check_size(response, batch):
+        if page_size(response) > batch_size:
+            raise RuntimeError(f'filemaker returned too many records for request {batch}')
+
+    get_page = partial(filemaker.get_all_records, stream=True) if stream else filemaker.get_all_records
 
-            app_state = DB.get('app_state')
+    try:
+        for offset, response in iter_pages(get_page, last_synced_row + 1, batch_size, prefetch, rate):
+            app_state = DB.get('app_state', cached=False)
             last_synced_row = int(app_state['last_synced_filemaker_row'])
-            offset = last_synced_row + 1
+            if offset != last_synced_row + 1:
+                # the checkpoint only moves forward batch by batch
+                raise RuntimeError(f'the checkpoint moved to {last_synced_row} in the meantime, expected {offset - 1}')
+
+            count, new_count = _save_new_filemaker_records(response['data'], processor, index, partial(check_size, response))
+            logger.debug(f"retrieved {count} filemaker_rows after row {last_synced_row}, {count - new_count} were saved already")
+
+            # the checkpoint is only advanced after all records were saved
+            app_state['last_synced_filemaker_row'] += count
+            DB.save(app_state)
+            batches_done += 1
+
+            if timeout.reached():
+                raise RuntimeError('database sync timed out, it took too long in total')
+
+    except Exception as e:
+        logger.warning(f'cant export batch {batches_done} or database timed out with error: {e}')
 
-            # this might fail, if e.g. the offset+limit > the amount of records in filemaker
-            response = filemaker.get_all_records(offset=offset, limit=batch_size)
+    index.save()
+    logger.info(f'filemaker requests: {rate.stats()}')
+    return batches_done
 
-            records = list(response['data'])
-            if len(records) > batch_size:
-                raise RuntimeError(f'filemaker returned too many records for request {records}')
 
-            logger.debug(f"retrieved {len(records)} filemaker_rows")
-            logger.debug(f"last_synced_row_was {last_synced_row} and record id was {records[0]['recordId']}")
+# high-water mark of the delta sync, if none was stored yet
+FILEMAKER_DELTA_START = '1970-01-01'
 
-            # only add new filemaker records, based on their id
-            new_records = list(filter(
-                lambda r: get_filemaker_id(r) not in db, 
-                records
-                ))
+def _newest_record_date(records, field):
+    dates = []
+    for r in records:
+        try:
+            dates.append(parse_date(r['fieldData'][field]))
+        except (KeyError, TypeError, ValueError):
+            pass
+    return max(dates, default=None)
 
-            num_dupes = len(records) - len(new_records) 
-            logger.warning(f"not saving {num_dupes}")
+def retrieve_new_filemaker_data_delta(filemaker, processor, index, backoff_time=0, prefetch=FILEMAKER_PREFETCH_PAGES, rate=None, field='Zeitstempel', stream=False):
+    '''
+    fetch only the records of the examination types that are dated on or
+    after the high-water mark, with the filemaker _find endpoint instead of
+    scanning the whole table by offset
+
+    the mark is the newest date of the synced records, it is advanced page
+    by page, the pages are sorted by date. filemaker dates have no time of
+    day, so the day of the mark is fetched again, the records that were
+    saved already are skipped by the fingerprint index
+    '''
+    timeout = Timeout(2*60*60) # 2h in seconds
 
-            app_state['last_synced_filemaker_row'] += len(records)
-            newdocs = list(map(processor, new_records)) + [app_state]
-            DB.save_bulk(newdocs)
+    if rate is None:
+        rate = RateController(delay=backoff_time, min_delay=backoff_time)
+
+    app_state = DB.get('app_state', cached=False)
+    since = date.fromisoformat(app_state.get('last_synced_filemaker_date') or FILEMAKER_DELTA_START)
+    get_page = partial(filemaker.get_new_records_by_date, since.day, since.month, since.year, field=field)
+    if stream:
+        get_page = partial(get_page, stream=True)
+
+    batch_size = 1000
+    batches_done = 0
+    new_total = 0
+
+    try:
+        for offset, response in iter_pages(get_page, 1, batch_size, prefetch, rate):
+            newest = []
+            # the processor changes the records, so the dates are read before
+            track_newest = lambda batch: newest.append(_newest_record_date(batch, field))
+            count, new_count = _save_new_filemaker_records(response['data'], processor, index, track_newest)
+            new_total += new_count
+            newest = max([d for d in newest if d is not None], default=None)
+
+            app_state = DB.get('app_state', cached=False)
+            mark = app_state.get('last_synced_filemaker_date') or FILEMAKER_DELTA_START
+            # the mark never moves backwards
+            if newest is not None and newest.date().isoformat() > mark:
+                app_state['last_synced_filemaker_date'] = newest.date().isoformat()
+                DB.save(app_state)
+            batches_done += 1
 
             if timeout.reached():
                 raise RuntimeError('database sync timed out, it took too long in total')
 
-        except Exception as e:
-            logger.warning(f'cant export batch {batches_done} or database timed out with error: {e}')
-            break
+    except Exception as e:
+        logger.warning(f'cant export delta batch {batches_done} or database timed out with error: {e}')
 
+    index.save()
+    logger.info(f'filemaker delta sync since {since.isoformat()} saved {new_total} new records, requests: {rate.stats()}')
     return batches_done
 
 
@@ -114,7 +231,36 @@ def exam_from_filemaker_record(filemaker_record):
             )
     return exam
 
-def create_examinations():
+# filemaker records whose examinations are created together
+EXAMINATION_BATCH_SIZE = 500
+
+def _records_without_examination(batch_size, counts):
+    ''' yields batches of the ids of filemaker records that have no examination,
+    counts the records with several examinations in counts['duplicates']
+    '''
+    # page through the grouped records instead of loading all of them,
+    # creating an examination only adds to the group that was already read
+    batch = []
+    for p in db.query('filemaker/all?group_level=1&', lazy=True):
+        if p['value'] == 0:
+            batch.append(p['key'][0])
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        elif p['value'] > 1:
+            counts['duplicates'] += 1
+    if len(batch) > 0:
+        yield batch
+
+def _create_examinations_batch(ids):
+    ''' fetch the filemaker records and save their examinations, with a request each '''
+    records = [r for r in db.get_bulk(ids) if not isinstance(r, MissingDocument)]
+    exams = [exam_from_filemaker_record(r) for r in records]
+    if len(exams) > 0:
+        db.save_bulk(exams)
+    return len(exams)
+
+def create_examinations(batch_size=EXAMINATION_BATCH_SIZE, workers=1):
     '''
     scan through all filemaker records and create an exam document
     for all filemaker records that didnt have one
@@ -122,28 +268,42 @@ def create_examinations():
     collect errors where duplicate examination exist
     
     examination records contain the original filemaker records
+
+    the records are fetched and the examinations saved in batches of
+    batch_size, with workers > 1 several batches are written at once
+    by threads while the view is read on. the threads share the db
+    connection pool and document cache, which are thread safe.
+    returns the number of created examinations
     '''
     logger.info('creating examinations')
+    start = monotonic()
 
-    new_records = []
-    duplicate_examinations = []
-    for p in db.query('filemaker/all?group_level=1&').rows:
-        if p['value'] == 1:
-            continue
-        elif p['value'] < 1:
-            new_records.append(p['key'][0])
-        else:
-            duplicate_examinations.append(p['key'][0])
+    created = 0
+    counts = {'duplicates': 0}
+    batches = _records_without_examination(batch_size, counts)
 
-    logger.info('finished grouping filemaker records, starting creating examinations')
+    if workers <= 1:
+        for ids in batches:
+            created += _create_examinations_batch(ids)
+            logger.info(f'created {created} examinations and continuing')
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+            for ids in batches:
+                # at most two batches per worker are read ahead
+                if len(pending) >= 2*workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    created += sum(f.result() for f in done)
+                    logger.info(f'created {created} examinations and continuing')
+                pending.add(pool.submit(_create_examinations_batch, ids))
+            created += sum(f.result() for f in pending)
 
-    for i, p in enumerate(new_records):
-        filemaker_record = db.get(p)
-        exam = exam_from_filemaker_record(filemaker_record)
-        db.save(exam)
+    seconds = monotonic() - start
+    logger.info(f'created {created} examinations in {seconds:.1f}s, {created / max(seconds, 1e-9):.0f} examinations/s')
 
-        if i % 1000==0:
-            logger.info(f'created {i} examinations and continuing')
+    if counts['duplicates'] > 0:
+        logger.warning(f'found {counts["duplicates"]} filemaker records with multiple examinations')
+    return created
 
 
 def get_names(examination):
@@ -160,11 +320,11 @@ def patient_from_exams(examinations: [Examination]) -> Patient :
     sorted_exams = sorted(examinations, key=lambda e: e.started_date)
     names = list(map(get_names, sorted_exams))[-1]
 
-    if len({e.filemaker_record['GBD'] for e in examinations}) != 1:
+    if len({birthdate_key(e.filemaker_record['GBD']) for e in examinations}) != 1:
         logger.error(f'examination group {examinations} has multiple birthdates')
 
     try:
-        birthdate = datetime.strptime(examinations[0].filemaker_record['GBD'], '%m/%d/%Y')
+        birthdate = parse_date(examinations[0].filemaker_record['GBD'])
     except Exception as e:
         logger.error(f'error during parsing of birthdate {e}')
         raise e
@@ -185,75 +345,174 @@ def patient_from_exams(examinations: [Examination]) -> Patient :
     return patient
 
 
-def aggregate_patients():
+def aggregate_patients(incremental=False):
     ''' scan through all examination documents and group
     them by [name, birthdate] (see the patients/patient_aggregation view)
     create a patient document for every group
 
     link the patient and exam documents by their id's
+
+    with incremental=True only the groups of the examinations that changed
+    since the last aggregation are aggregated again, see patient_changes
     '''
+    consumer = patient_changes()
+    if incremental:
+        return consumer.run()
+
     logger.info('aggregating patients')
-    result = db.query('patients/patient_aggregation?include_docs=true').to_wrapped()
-    kvs = zip(result.keys(), result.docs())
-    logger.info('grouping examinations for patient aggregation')
+    # the changes that happen during the scan are aggregated again by the next incremental run
+    last_seq = db.changes(since='now', limit=0)['last_seq']
 
+    result = db.query('patients/patient_aggregation?include_docs=true', lazy=True).to_wrapped()
+    saved = _save_patients(_aggregate_groups(result.key_docs()))
+
+    consumer.skip_to(last_seq)
+    logger.info(f'aggregated patients, saved {saved} new or updated patients')
+    return saved
+
+
+def _aggregate_groups(key_docs):
+    ''' yields the new and updated patients of the (key, doc) rows of the patient aggregation view '''
     # group based on the first few parts of the key, as specified in the view
     def groupfn(kv):
         k, _ = kv
         return k[0:-1]
 
-    for i, (key, group) in enumerate(groupby(kvs, key=groupfn)):
+    for i, (key, group) in enumerate(groupby(key_docs, key=groupfn)):
         grouped_docs = [x[1] for x in group]
-
-        patient_objs = list(filter(
-            lambda o: o.document_type == 'patient',
-            grouped_docs
-            ))
-
-        examinations = list(filter(
-            lambda d: d.document_type == 'examination',
-            grouped_docs
-            ))
-
-        examination_ids = [e.id for e in examinations]
-
-        logger.debug(patient_objs)
-        logger.debug(examinations)
-        logger.debug(examination_ids)
-
-        if len(patient_objs) > 1:
-            raise RuntimeError(f'too many patient objects for examination group: {g}')
-        elif len(patient_objs) == 1:
-            # found a patient, update patient examinations if there is a mismatch
-            pd = patient_objs[0]
-
-            if pd.examinations != examination_ids:
-                updated_patient = pd.model_dump()
-                updated_patient['examinations'] = examination_ids
-                p = Patient(**updated_patient)
-                db.save(p)
-        else:
-            # no patient exists for the examinations
-            try:
-                patient = patient_from_exams(examinations)
-                db.save(patient)
-            except ValueError as e:
-                logger.error(e)
-            except Exception as e:
-                logger.error(e)
-                raise e
+        patient = aggregate_patient_group(key, grouped_docs)
+        if patient is not None:
+            yield patient
 
         if i % 100 == 0:
             logger.info(f'aggregated {i} patients, continuing')
 
 
+# aggregated patients that are saved together, only a batch of them is held in memory
+PATIENT_SAVE_BATCH_SIZE = BULK_WRITE_BATCH_SIZE
+
+def _save_patients(patients):
+    ''' save the patients while they are aggregated, returns their number '''
+    saved = 0
+    for batch in chunked(patients, PATIENT_SAVE_BATCH_SIZE):
+        db.save_bulk(batch)
+        saved += len(batch)
+    return saved
+
+
+def aggregate_patient_group(key, grouped_docs):
+    ''' the created or updated patient of a group of examination and patient documents
+    that share the same [name, firstname, birthdate] key,
+    None if the patient is up to date or cant be created
+    '''
+    patient_objs = list(filter(
+        lambda o: o.document_type == 'patient',
+        grouped_docs
+        ))
+
+    examinations = list(filter(
+        lambda d: d.document_type == 'examination',
+        grouped_docs
+        ))
+
+    examination_ids = [e.id for e in examinations]
+
+    logger.debug(patient_objs)
+    logger.debug(examinations)
+    logger.debug(examination_ids)
+
+    if len(patient_objs) > 1:
+        raise RuntimeError(f'too many patient objects for examination group: {key}')
+    elif len(patient_objs) == 1:
+        # found a patient, update patient examinations if there is a mismatch
+        pd = patient_objs[0]
+
+        if pd.examinations != examination_ids:
+            updated_patient = pd.model_dump()
+            updated_patient['examinations'] = examination_ids
+            return Patient(**updated_patient)
+    else:
+        # no patient exists for the examinations
+        try:
+            return patient_from_exams(examinations)
+        except ValueError as e:
+            logger.error(e)
+        except Exception as e:
+            logger.error(e)
+            raise e
+    return None
+
+
+def patient_group_key(examination):
+    ''' the key prefix of the examination in the patients/patient_aggregation view '''
+    r = examination.filemaker_record
+    return (r['Name'], r['Vorname'], birthdate_key(r['GBD']))
+
+
+def link_patients_of_examinations(examinations):
+    ''' aggregate only the patient groups of the given examinations
+
+    the key ranges of the groups are read with batched queries of the view
+    and the patients are saved with bulk saves
+    '''
+    group_keys = sorted({patient_group_key(e) for e in examinations})
+
+    result = db.query_ranges('patients/patient_aggregation',
+            [(list(key), list(key) + [{}]) for key in group_keys],
+            include_docs=True,
+            ).to_wrapped()
+    saved = _save_patients(_aggregate_groups(result.key_docs()))
+
+    logger.info(f'linked patients of {len(group_keys)} examination groups, saved {saved} patients')
+    return saved
+
+
+def create_examinations_of_records(filemaker_records):
+    ''' create the examinations of new filemaker records,
+    skip records that already have an examination
+    '''
+    keys = [[r['id'], 1] for r in filemaker_records]
+    result = db.query('filemaker/all', keys=keys, reduce='false')
+    examined = {k[0] for k in result.keys()}
+
+    exams = [
+        exam_from_filemaker_record(r)
+        for r in filemaker_records
+        if r['id'] not in examined
+        ]
+
+    if len(exams) > 0:
+        db.save_bulk(exams)
+    logger.info(f'created {len(exams)} examinations from changed filemaker records')
+
+
+def examination_changes():
+    consumer = ChangesConsumer(db, 'create_examinations')
+    consumer.register('filemaker_record', create_examinations_of_records)
+    return consumer
+
+
+def patient_changes():
+    consumer = ChangesConsumer(db, 'link_patients')
+    consumer.register('examination', link_patients_of_examinations)
+    return consumer
+
+
+def sync_changes():
+    ''' create examinations and link patients only for the
+    documents that changed since the last sync
+    '''
+    examination_changes().run()
+    patient_changes().run()
+
 
 def get_mp_number_from_path(p):
     d = parse_fastq_name(Path(p).name)
     return d['sample_name']
 
 
-def get_examination_of_sample(sample_path, missing_ok=False):
+def sample_examination_key(sample_path):
+    ''' the [year, mp number] key of the examination of a sample in the examinations/mp_number view '''
     mp_number_with_year = get_mp_number_from_path(str(sample_path))
     mp_number, mp_y = mp_number_with_year.split('-')
     
@@ -262,18 +521,23 @@ def get_examination_of_sample(sample_path, missing_ok=False):
     else:
         mp_year = 2000 + int(mp_y)
 
+    return [mp_year, int(mp_number)]
+
+
+def get_examination_of_sample(sample_path, missing_ok=False):
+    mp_year, mp_number = sample_examination_key(sample_path)
     logger.info(f'mp_number {mp_number} mp_year {mp_year}')
 
     try:
-        examinations = db.query(f'examinations/mp_number?key=[{mp_year},{mp_number}]').to_wrapped().values()
-    except db.NotFound:
+        examinations = db.query(f'examinations/mp_number?key=[{mp_year},{mp_number}]', include_docs=True).to_wrapped().docs()
+    except NotFound:
         logger.info(f'no examination of sample {sample_path} found')
         examinations = [None]
 
     if missing_ok == False and len(examinations) == 0:
-        raise RuntimeError(f"no examination found for sample: {sample}")
+        raise RuntimeError(f"no examination found for sample: {sample_path}")
     elif len(examinations) >= 2:
-        raise RuntimeError(f"multiple examinations found for sample: {sample} examinations: {examinations}")
+        raise RuntimeError(f"multiple examinations found for sample: {sample_path} examinations: {examinations}")
     elif missing_ok == True and len(examinations) == 0:
         logger.info(f'exam for sample_path {sample_path} missing')
         return None
@@ -282,6 +546,40 @@ def get_examination_of_sample(sample_path, missing_ok=False):
         return examination
 
 
+def get_examinations_of_samples(sample_paths):
+    ''' sample path -> its examination, or None if it has none
+
+    the sample names are parsed once and every [year, mp number] key is
+    looked up once, R1 and R2 of a sample share it. all keys are resolved
+    with one keys query of the examinations/mp_number view.
+    samples without mp number or with multiple examinations are logged and left out
+    '''
+    sample_keys = {}
+    for s in sample_paths:
+        try:
+            sample_keys[s] = tuple(sample_examination_key(s))
+        except Exception as e:
+            logger.error(f'examination could not be obtained for sample: {s} due to: {e}')
+
+    found = {}
+    keys = sorted(set(sample_keys.values()))
+    if len(keys) > 0:
+        result = db.query('examinations/mp_number', keys=[list(k) for k in keys], include_docs=True).to_wrapped()
+        for key, examination in result.key_docs():
+            found.setdefault(tuple(key), []).append(examination)
+
+    examinations = {}
+    for s, key in sample_keys.items():
+        exams = found.get(key, [])
+        if len(exams) >= 2:
+            logger.error(f'multiple examinations found for sample: {s} examinations: {[e.id for e in exams]}')
+            continue
+        examinations[s] = exams[0] if len(exams) == 1 else None
+
+    logger.info(f'resolved {len(sample_keys)} samples with {len(keys)} mp numbers')
+    return examinations
+
+
 def get_mp_number_from_filemaker_record(rec):
     mpnr = str(int(rec['Mol_NR'])) + '-' + str(rec['Jahr'])[-2:]
     return mpnr
@@ -293,9 +591,10 @@ def get_samples_of_examination(examination):
         ex_mpnr = get_mp_number_from_filemaker_record(examination.filemaker_record)
         
         sample_candidates = []
-        for srid in examination.sequencer_runs:
-            if srid in db:
-                sample_candidates += db.get(srid).outputs
+        # missing sequencer runs are falsy MissingDocuments
+        for sequencer_run in db.get_bulk(examination.sequencer_runs):
+            if sequencer_run:
+                sample_candidates += sequencer_run.outputs
 
         for sa in sample_candidates:
             if get_mp_number_from_path(sa) == ex_mpnr:
@@ -323,6 +622,36 @@ def check_years_match(sequencer_run, samples):
         raise RuntimeError(f'sequencer run name has a different year than its output samples with sample year: {sample_years} and run year {run_year}')
 
 
+def merge_examination_links(ours: dict, theirs: dict) -> dict:
+    ''' resolve a bulk write conflict of an examination by keeping
+    the latest document and the sequencer and pipeline run links of both
+    '''
+    merged = dict(theirs)
+    for k in ['sequencer_runs', 'pipeline_runs']:
+        if k not in theirs and k not in ours:
+            continue
+        links = list(theirs.get(k, []))
+        links += [x for x in ours.get(k, []) if x not in links]
+        merged[k] = links
+    return merged
+
+
+def merge_sequencer_run_outputs(ours: dict, theirs: dict) -> dict:
+    ''' resolve a bulk write conflict of a sequencer run by keeping
+    the latest document and the outputs of both
+    '''
+    merged = dict(theirs)
+    merged['outputs'] = sorted(set(theirs.get('outputs', [])) | set(ours.get('outputs', [])))
+    return merged
+
+
+def merge_sequencer_run_links(ours: dict, theirs: dict) -> dict:
+    ''' the merge of the bulk saves of a sequencer run and its linked examinations '''
+    if theirs.get('document_type') == 'sequencer_run':
+        return merge_sequencer_run_outputs(ours, theirs)
+    return merge_examination_links(ours, theirs)
+
+
 def link_examinations_to_sequencer_run(examinations: [Examination], seq_run_id: str):
     new_exams = []
     logger.info(f"linking {len(examinations)} to {seq_run_id}")
@@ -342,70 +671,131 @@ def link_examinations_to_sequencer_run(examinations: [Examination], seq_run_id:
 
 
 
-def poll_sequencer_output():
-    ''' ingest sequencer data from filepath
+def sequencer_run_id(run_path):
+    ''' deterministic id of the sequencer run of an output folder, so the
+    existence of runs can be checked by id
     '''
+    return 'sequencer_run_' + sha256(str(run_path).encode('utf-8')).hexdigest()
 
-    # first, sync db with miseq output data
-    db_sequencer_runs = db.query('sequencer_runs/all').to_wrapped().values()
-    db_sequencer_paths = [str(r.original_path) for r in db_sequencer_runs]
 
-    fs_miseq_output_path = Path(CONFIG['miseq_output_folder'])
-    fs_miseq_output_runs = [fs_miseq_output_path / x for x in fs_miseq_output_path.iterdir()]
+def poll_sequencer_output(runs=None):
+    ''' ingest sequencer data from filepath
 
-    sequencer_runs = []
+    only the run folders that are new or changed since the last poll are
+    walked, see app.sequencer_scan. runs limits the poll to these run folders,
+    like the ones the watcher reported
+    '''
+    index_path = CONFIG['sequencer_scan_index']
+    with scan_lock(index_path):
+        index = ScanIndex.load(index_path)
+
+        # first, sync db with miseq output data
+        fs_miseq_output_path = Path(CONFIG['miseq_output_folder'])
+        if runs is None:
+            fs_miseq_output_runs = [Path(e.path) for e in os.scandir(fs_miseq_output_path) if e.is_dir()]
+            index.forget_missing(fs_miseq_output_runs)
+        else:
+            fs_miseq_output_runs = [Path(r) for r in runs if Path(r).is_dir()]
+
+        changed = [r for r in fs_miseq_output_runs if index.changed(r)]
+        unindexed = [r for r in changed if r not in index]
+
+        # runs that are in the database but not in the index, like after the
+        # index file was lost, are compared with their documents instead of
+        # ingested again. runs that were created before they had deterministic
+        # ids are found by path
+        known = {}
+        if len(unindexed) > 0:
+            db_runs = [run for run in db.get_bulk([sequencer_run_id(r) for r in unindexed]) if run]
+            legacy = [str(r) for r in unindexed if str(r) not in {str(run.original_path) for run in db_runs}]
+            if len(legacy) > 0:
+                db_runs += db.query('sequencer_runs/original_path', keys=legacy, include_docs=True).to_wrapped().docs()
+            known = {str(run.original_path): sorted(str(o) for o in run.outputs) for run in db_runs}
+
+        for run_name in changed:
+            outputs, signature = scan_run(run_name)
+            if run_name in index:
+                previous = index.fastqs(run_name)
+            elif str(run_name) in known:
+                previous = known[str(run_name)]
+            else:
+                ingest_sequencer_run(run_name, outputs)
+                index.update(run_name, outputs, signature)
+                continue
+
+            if outputs != previous:
+                update_sequencer_run_outputs(run_name, outputs, previous)
+            index.update(run_name, outputs, signature)
+
+        index.save()
+    logger.info(f'polled {len(fs_miseq_output_runs)} sequencer runs, walked {len(changed)} changed ones')
+    return len(changed)
+
+
+def link_sample_examinations(outputs):
+    ''' the examinations of the samples, each once '''
+    examinations = {}
+    for s, x in get_examinations_of_samples(outputs).items():
+        logger.info(f'the examination for sample {s} is {x}')
+        if x is not None:
+            examinations[x.id] = x
+    return list(examinations.values())
+
+
+def ingest_sequencer_run(run_name, outputs):
+    ''' save the sequencer run of a new run folder and link the examinations of its samples '''
+    try:
+        parsed = parse_miseq_run_name(run_name.name)
+        dirty=False
+    except RuntimeError as e:
+        parsed = {}
+        dirty=True
+
+    # run folder name doesnt adhere to illumina naming convention
+    # because it has been renamed or manually copied
+    # we save the parsed information too, so we can efficiently query the runs
+
+    sequencer_run = SequencerRun(
+            map_id=False,
+            id=sequencer_run_id(run_name),
+            original_path=str(run_name),
+            name_dirty=str(dirty),
+            parsed=parsed,
+            state='successful',
+            indexed_time=datetime.now(),
+            outputs=outputs
+            )
 
-    for run_name in fs_miseq_output_runs:
-        try:
-            parsed = parse_miseq_run_name(run_name.name)
-            dirty=False
-        except RuntimeError as e:
-            parsed = {}
-            dirty=True
+    try:
+        check_years_match(sequencer_run, outputs)
+    except Exception as e:
+        logger.error(f'sequencer run year could not be checked due to error: {e}')
 
-        outputs = list(sorted(Path(run_name).rglob('*.fastq.gz')))
+    examinations = link_sample_examinations(outputs)
+    logger.info(f'examinations for sequencer run are {examinations}')
+    new_exams = link_examinations_to_sequencer_run(examinations, sequencer_run.id)
+    logger.info(f'new exams: {new_exams}')
 
-        # run folder name doesnt adhere to illumina naming convention
-        # because it has been renamed or manually copied
-        # we save the parsed information too, so we can efficiently query the runs
+    # this validates the fields
+    db.save_bulk([sequencer_run] + new_exams, merge=merge_sequencer_run_links)
 
-        # skip creating sequencer run if it already exists
-        if str(run_name) in db_sequencer_paths:
-            continue
 
-        sequencer_run = SequencerRun(
-                map_id=False,
-                id=str(uuid4()),
-                original_path=str(run_name),
-                name_dirty=str(dirty),
-                parsed=parsed,
-                state='successful',
-                indexed_time=datetime.now(),
-                outputs=outputs
-                )
+def update_sequencer_run_outputs(run_name, outputs, previous_outputs):
+    ''' save the fastqs that were added to a known run folder and link their examinations '''
+    try:
+        sequencer_run = db.get(sequencer_run_id(run_name), cached=False)
+    except NotFound:
+        # the run was ingested before it had a deterministic id
+        logger.warning(f'sequencer run of {run_name} changed, but its document has no deterministic id')
+        return
+
+    sequencer_run = sequencer_run.model_copy(update={'outputs': [Path(o) for o in outputs], 'indexed_time': datetime.now()})
+    new_outputs = sorted(set(outputs) - set(previous_outputs))
+    examinations = link_sample_examinations(new_outputs)
+    new_exams = link_examinations_to_sequencer_run(examinations, sequencer_run.id)
+    logger.info(f'sequencer run {run_name} has {len(new_outputs)} new outputs, new exams: {new_exams}')
+    db.save_bulk([sequencer_run] + new_exams, merge=merge_sequencer_run_links)
 
-        try:
-            check_years_match(sequencer_run, outputs)
-        except Exception as e:
-            logger.error(f'sequencer run year could not be checked due to error: {e}')
-
-        examinations = []
-        for s in outputs:
-            logger.info(f'af {s}')
-            try:
-                x = get_examination_of_sample(s, missing_ok=True)
-                logger.info(f'the examination for sample {s} is {x}')
-                if x is not None:
-                    examinations.append(x)
-            except Exception as e:
-                logger.error(f'examination could not be obtained for sample: {s} due to: {e}')
-
-        logger.info(f'examinations for sequencer run are {examinations}')
-        new_exams = link_examinations_to_sequencer_run(examinations, sequencer_run.id)
-        logger.info(f'new exams: {new_exams}')
-
-        # this validates the fields
-        db.save_bulk([sequencer_run] + new_exams)
 
 def search_fastqs(ids):
     raise NotImplemented()
@@ -454,6 +844,11 @@ def start_workflow_impl(
     logger.debug(examinations)
     examinations = db.get_bulk(examinations)
 
+    missing = [e.id for e in examinations if isinstance(e, MissingDocument)]
+    if len(missing) > 0:
+        logger.error(f'cant start pipeline run, examinations {missing} are missing')
+        return
+
     if panel_type == 'invalid':
         logger.warning('info, panel type invalid skipping')
         return
@@ -483,7 +878,7 @@ def start_workflow_impl(
         new_ex_docs.append(Examination(**d))
 
     db.save(pipeline_run)
-    db.save_bulk(new_ex_docs)
+    db.save_bulk(new_ex_docs, merge=merge_examination_links)
 
     # pass is_aborted function to backend for stopping
     workflow_backend_execute(pipeline_run, is_aborted, backend)
@@ -537,8 +932,27 @@ def group_examinations_by_type(examinations):
     return groups
 
 
-def collect_work():
-    new_examinations = db.query('examinations/new_examinations').to_wrapped().values()
-    print(len(new_examinations))
+def collect_work(incremental=False):
+    ''' group the examinations that need a pipeline run by their type
+
+    the examinations/new_examinations view decides which examinations need a
+    run. incremental uses the _changes feed only as trigger, the view is read
+    if examinations changed since the last call or the last call found some,
+    so examinations whose run failed to start are collected again
+    '''
+    if incremental:
+        changed = ChangesConsumer(db, 'collect_work').advance(['examination'])
+        if not changed and db.get('app_state', cached=False).get('pending_examinations', 0) == 0:
+            logger.info('no examinations changed since the last collection')
+            return {}
+
+    new_examinations = db.query('examinations/new_examinations', include_docs=True).to_wrapped().docs()
+
+    if incremental:
+        app_state = db.get('app_state', cached=False)
+        app_state['pending_examinations'] = len(new_examinations)
+        db.save(app_state)
+
+    logger.info(f'collected {len(new_examinations)} new examinations')
     groups = group_examinations_by_type(new_examinations)
     return groups
@@ -14,7 +14,7 @@ class Schedule:
         self.db = db
 
     def acquire_lock(self):
-        app_state = self.db.get('app_state')
+        app_state = self.db.get('app_state', cached=False)
         if app_state['sync_running'] == True:
             logger.debug('sync already running')
             raise RuntimeError()
@@ -24,7 +24,7 @@ class Schedule:
             self.db.save(app_state)
 
     def release_lock(self):
-        app_state = self.db.get('app_state')
+        app_state = self.db.get('app_state', cached=False)
         #app_state['sync_running'] = False
         self.db.save(app_state)
 
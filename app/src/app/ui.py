@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from flask import Flask, render_template, request, redirect, g, current_app, Blueprint
+from flask import Flask, render_template, request, redirect, g, current_app, Blueprint, Response, stream_with_context, abort
 from werkzeug.utils import secure_filename
 
 from app.constants import *
@@ -9,10 +9,17 @@ from app.model import panel_types, SequencerInputSample, Examination, Patient
 
 from app.tasks import start_pipeline, sync_couchdb_to_filemaker, sync_sequencer_output, mq, start_workflow
 from app.db import DB
+from app.pipeline_logs import LOG_STREAMS, FINISHED_STATUSES, follow_log
 
 import pycouchdb as couch
 import json
 
+# seconds between the polls of a followed pipeline log
+LOG_STREAM_POLL_INTERVAL = 2
+# seconds after which a log stream is closed, the browser reconnects with
+# the Last-Event-ID, so a stream doesnt block a web worker forever
+LOG_STREAM_TIMEOUT = 300
+
 APP_VERSION = '0.0.1'
 PIPELINE_VERSION = APP_VERSION
 UPLOAD_FOLDER = '/tmp/uploads'
@@ -23,16 +30,17 @@ db = DB
 
 def _get_pipeline_dashboard_html():
     progress = 0
-    pipeline_runs = db.query('pipeline_runs/all').values()
+    # read stale views, so the dashboard doesnt wait while the indexer catches up
+    pipeline_runs = db.query('pipeline_runs/all', include_docs=True, stale=True).docs()
 
     dn = datetime.now()
     for pr in pipeline_runs:
         pr['age'] = dn - datetime.fromisoformat(pr['created_time'])
     
-    sequencer_runs = db.query('sequencer_runs/all?limit10&descending=true').values()
+    sequencer_runs = db.query('sequencer_runs/all?limit=10&descending=true', include_docs=True, stale=True).docs()
 
-    examinations = db.query('examinations/examinations?limit=10&skip=10&descending=true').values()
-    patients = db.query('patients/patients?limit=10&skip=10&descending=true').values()
+    examinations = db.query('examinations/examinations?limit=10&skip=10&descending=true', include_docs=True, stale=True).docs()
+    patients = db.query('patients/patients?limit=10&skip=10&descending=true', include_docs=True, stale=True).docs()
 
     settings = db.get('app_settings')
     pipeline_schedule = settings['schedule']
@@ -40,7 +48,9 @@ def _get_pipeline_dashboard_html():
 
     pipeline_status = 'online'
 
-    number_examinations_res = db.query('examinations/examinations_count', as_list=True)
+    indexer_progress = db.indexer_progress()
+
+    number_examinations_res = db.query('examinations/examinations_count', as_list=True, stale=True)
     if len(number_examinations_res.rows) != 1:
         current_app.logger.error('error fetching examinations_count, no query result rows, check if there are any examinations documents')
         number_examinations = 'unknown'
@@ -56,6 +66,7 @@ def _get_pipeline_dashboard_html():
             patients=patients,
             pipeline_version=PIPELINE_VERSION,
             pipeline_progress=progress,
+            indexer_progress=indexer_progress,
             pipeline_status=f'{pipeline_status}',
             pipeline_autorun=autorun,
             pipeline_schedule=pipeline_schedule,
@@ -83,6 +94,48 @@ def raw_document_view(document_id):
     ds = doc.model_dump_json(indent=2)
     return render_template('raw_db_document.html', doc=doc, ds=ds)
 
+def _log_events(pipeline_run_id, stream, offset):
+    ''' server-sent events of the new log data, the event id is the byte offset after the data '''
+    # milliseconds the browser waits before reconnecting
+    yield f'retry: {LOG_STREAM_POLL_INTERVAL*1000}\n\n'
+    for offset, text in follow_log(db, pipeline_run_id, stream, offset,
+            poll_interval=LOG_STREAM_POLL_INTERVAL, timeout=LOG_STREAM_TIMEOUT):
+        if text is None:
+            # comment line, keeps proxies from closing the idle connection
+            yield ': keepalive\n\n'
+        else:
+            data = json.dumps({'stream': stream, 'offset': offset, 'text': text})
+            yield f'id: {offset}\ndata: {data}\n\n'
+
+    if db.get(pipeline_run_id).status in FINISHED_STATUSES:
+        # tells the browser not to reconnect
+        yield f'id: {offset}\nevent: end\ndata: {{}}\n\n'
+
+@admin.route("/pipeline_logs/<pipeline_run_id>/<stream>", methods=['GET'])
+def pipeline_log_stream(pipeline_run_id, stream):
+    ''' follows the stdout or stderr of a pipeline run as server-sent events
+    from the byte offset ?offset=, or the Last-Event-ID of a reconnecting browser
+
+    only new log data is sent, the data of an event is json like
+    {"stream": "stdout", "offset": 1234, "text": "..."}
+    '''
+    if stream not in LOG_STREAMS:
+        abort(404)
+    try:
+        db.get(pipeline_run_id)
+    except couch.exceptions.NotFound:
+        abort(404)
+
+    offset = request.headers.get('Last-Event-ID', request.args.get('offset', '0'))
+    try:
+        offset = max(0, int(offset))
+    except ValueError:
+        abort(400)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(_log_events(pipeline_run_id, stream, offset)),
+            mimetype='text/event-stream', headers=headers)
+
 @admin.route("/pipeline_start_single", methods=['POST'])
 def pipeline_start_single():
     current_app.logger.info('pipeline start single')
@@ -145,7 +198,7 @@ def pipeline_status():
 @admin.route("/pipeline_autorun_enable", methods=['POST'])
 def pipeline_autorun_enable():
     current_app.logger.info('enabeling pipeline autorunning')
-    settings = db.get('app_settings')
+    settings = db.get('app_settings', cached=False)
     settings['autorun_pipeline'] = True
     res = db.save(settings)
     return redirect('/pipeline_status')
@@ -154,7 +207,7 @@ def pipeline_autorun_enable():
 @admin.route("/pipeline_autorun_disable", methods=['POST'])
 def pipeline_autorun_disable():
     current_app.logger.info('disabeling pipeline autorunning')
-    settings = db.get('app_settings')
+    settings = db.get('app_settings', cached=False)
     settings['autorun_pipeline'] = False
     db.save(settings)
     return redirect('/pipeline_status')
@@ -10,6 +10,7 @@ from app.parsers import parse_fastq_name
 from app.config import CONFIG
 from app.db import DB
 from app.model import PipelineRun
+from app.pipeline_logs import LogAppender
 
 from pathlib import Path
 import signal
@@ -46,12 +47,15 @@ def group_samples(samples):
 
 
 
-def run_workflow_io(cmd, pipeline_run, is_aborted):
+def run_workflow_io(cmd, pipeline_run, is_aborted, poll_interval=5):
     ''' a function that runs a pipeline run on a workflow backend
     results and logs are saved onto the filesystem by the workflow backend
     but also ingested into the database
 
     this allows searching and viewing and editing the results
+
+    the logs are appended to the database as chunk documents while the process
+    runs, the pipeline run document only keeps their tail, see app.pipeline_logs
     '''
     logger.info(f'running workflow command {cmd}')
 
@@ -61,17 +65,30 @@ def run_workflow_io(cmd, pipeline_run, is_aborted):
         # we write to tempfile, even though there is an output log file in the wdl output directory, 
         # because elsewhere we dont know the run name
         # this will be fixed in future, for example by naming the runs
-        pipeline_run = db.get(pipeline_run.id)
-        prevlog=(pipeline_run.logs.stderr, pipeline_run.logs.stdout)
+        pipeline_run = db.get(pipeline_run.id, cached=False)
 
-        with tempfile.TemporaryFile() as stde:
-            with tempfile.TemporaryFile() as stdo:
+        with tempfile.TemporaryFile() as stdo:
+            with tempfile.TemporaryFile() as stde:
                 pipeline_proc = subprocess.Popen(
                         cmd,
-                        stdout=stde,
-                        stderr=stdo,
+                        stdout=stdo,
+                        stderr=stde,
                         )
 
+                appenders = [
+                    LogAppender(db, pipeline_run.id, 'stdout', stdo),
+                    LogAppender(db, pipeline_run.id, 'stderr', stde),
+                    ]
+
+                def store_logs(final=False):
+                    new_chunks = sum(a.poll(final=final) for a in appenders)
+                    if new_chunks == 0 and not final:
+                        return
+                    logs = pipeline_run.logs.model_copy()
+                    for a in appenders:
+                        a.update_logs(logs)
+                    return logs
+
                 # update db entry periodically when the process runs
                 while pipeline_proc.poll() is None:
                     if is_aborted():
@@ -79,40 +96,33 @@ def run_workflow_io(cmd, pipeline_run, is_aborted):
                         pipeline_proc.send_signal(signal.SIGINT)
                         logger.warning(f'pipeline_run: {pipeline_run.id} was aborted')
 
-                    stde.seek(0)
-                    stdo.seek(0)
-                    pipeline_run.logs.stderr = stde.read().decode('utf-8')
-                    pipeline_run.logs.stdout = stdo.read().decode('utf-8')
+                    logs = store_logs()
+                    if logs is not None:
+                        pipeline_document = pipeline_run.model_dump()
+                        pipeline_document['logs'] = logs.model_dump()
+                        db.save(PipelineRun(**pipeline_document))
+                        pipeline_run = db.get(pipeline_run.id, cached=False)
 
-                    nlog =(pipeline_run.logs.stderr, pipeline_run.logs.stdout)
-                    if nlog != prevlog:
-                        prevlog = nlog
-                        db.save(pipeline_run)
-                        pipeline_run = db.get(pipeline_run.id)
-
-                    time.sleep(5)
+                    time.sleep(poll_interval)
 
 
                 # update db entry at the end
-                pipeline_run = db.get(pipeline_run.id)
-
-                stde.seek(0)
-                stdo.seek(0)
-                pipeline_run.logs.stderr = stde.read().decode('utf-8')
-                pipeline_run.logs.stdout = stdo.read().decode('utf-8')
-
+                pipeline_proc.wait()
+                logs = store_logs(final=True)
+                pipeline_run = db.get(pipeline_run.id, cached=False)
                 pipeline_document = pipeline_run.model_dump()
+                pipeline_document['logs'] = logs.model_dump()
 
                 retcode = pipeline_proc.returncode
                 if retcode == 0:
                     pipeline_document['status'] = 'successful'
-                elif retcode == signal.SIGINT:
+                elif retcode == -signal.SIGINT or retcode == signal.SIGINT:
                     pipeline_document['status'] = 'aborted'
                 else:
                     pipeline_document['status'] = 'error'
 
                 db.save(PipelineRun(**pipeline_document))
-                pipeline_run = db.get(pipeline_run.id)
+                pipeline_run = db.get(pipeline_run.id, cached=False)
                 return pipeline_run
 
 
@@ -120,7 +130,7 @@ def run_workflow_io(cmd, pipeline_run, is_aborted):
         logger.warning(f'error running workflow io {e}')
         
         # check types by converting into domain model object
-        pipeline_run = db.get(pipeline_run.id)
+        pipeline_run = db.get(pipeline_run.id, cached=False)
         pipeline_document = pipeline_run.model_dump()
         pipeline_document['status'] = 'error'
         db.save(PipelineRun(**pipeline_document))
@@ -11,7 +11,8 @@ from app.app import main
 from app.ui import create_app
 
 from app.tasks import start_pipeline
-from app.db import DB
+from app.db import DB, Db
+from app.db_memory import MEMORY_COUCH
 import pathlib
 
 
@@ -273,6 +274,18 @@ def db(couchdb_server, config):
     res = s.delete('ngs_app')
 
 
+@pytest.fixture()
+def memory_db():
+    ''' a Db on an empty in-process couchdb stand-in, see app.db_memory '''
+    memory_config = Config()
+    memory_config.set(dev=True, overrides={'couchdb_backend': 'memory'})
+    MEMORY_COUCH.reset()
+    mdb = Db()
+    mdb.init_db(memory_config)
+    yield mdb
+    MEMORY_COUCH.reset()
+
+
 @pytest.fixture(scope='session')
 def rabbitmq_server(config):
     pass
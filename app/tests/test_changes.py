@@ -0,0 +1,63 @@
+import pytest
+
+from app.changes import ChangesConsumer
+from app.db import NotFound
+
+
+class ChangesDB:
+    ''' fake db with a changes feed of numbered sequences '''
+    def __init__(self, docs):
+        self.feed = [{'seq': i+1, 'id': d['_id'], 'doc': d} for i, d in enumerate(docs)]
+        self.docs = {}
+
+    def get(self, doc_id, cached=True):
+        if doc_id not in self.docs:
+            raise NotFound()
+        return dict(self.docs[doc_id])
+
+    def save(self, doc):
+        self.docs[doc['id']] = dict(doc)
+
+    def changes(self, since=0, limit=None, include_docs=False, selector=None):
+        types = selector['document_type']['$in']
+        results = [c for c in self.feed if c['seq'] > since and c['doc'].get('document_type') in types]
+        results = results[:limit]
+        last_seq = results[-1]['seq'] if len(results) > 0 else since
+        return {'results': [dict(c, doc=dict(c['doc'])) for c in results], 'last_seq': last_seq}
+
+
+def test_changes_consumer_checkpoints():
+    docs = [{'_id': f'r{i}', 'document_type': 'filemaker_record'} for i in range(5)]
+    docs.insert(2, {'_id': 'app_state'})
+    cdb = ChangesDB(docs)
+
+    handled = []
+    consumer = ChangesConsumer(cdb, 'test', batch_size=2)
+
+    @consumer.register('filemaker_record')
+    def handler(records):
+        handled.extend(r['id'] for r in records)
+
+    assert consumer.run() == 5
+    assert handled == [f'r{i}' for i in range(5)]
+    assert cdb.docs['changes_checkpoint_test']['last_seq'] == 6
+
+    # a new consumer with the same name continues at the checkpoint
+    cdb.feed.append({'seq': 7, 'id': 'r5', 'doc': {'_id': 'r5', 'document_type': 'filemaker_record'}})
+    consumer2 = ChangesConsumer(cdb, 'test')
+    consumer2.register('filemaker_record', handler)
+    assert consumer2.run() == 1
+    assert handled[-1] == 'r5'
+
+
+def test_changes_consumer_failed_handler_keeps_checkpoint():
+    cdb = ChangesDB([{'_id': 'r0', 'document_type': 'filemaker_record'}])
+    consumer = ChangesConsumer(cdb, 'failing')
+
+    def handler(records):
+        raise RuntimeError('handler failed')
+
+    consumer.register('filemaker_record', handler)
+    with pytest.raises(RuntimeError):
+        consumer.run()
+    assert 'changes_checkpoint_failing' not in cdb.docs
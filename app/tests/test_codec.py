@@ -0,0 +1,44 @@
+import json
+import pytest
+from datetime import datetime
+from pathlib import Path
+
+from app.codec import dump_document, load_document, construct_trusted
+from app.model import Examination, PipelineRun, PipelineLogs
+from app.benchmarks import sample_documents
+
+
+def test_dump_document_matches_json_roundtrip():
+    for models in sample_documents(2).values():
+        for m in models:
+            assert dump_document(m) == json.loads(m.model_dump_json())
+
+
+def test_trusted_load_matches_validation():
+    for models in sample_documents(2).values():
+        for m in models:
+            d = dump_document(m)
+            cls = type(m)
+            trusted = load_document(cls, d)
+            validated = cls(**d)
+            assert trusted.model_dump() == validated.model_dump()
+
+    run = load_document(PipelineRun, dump_document(sample_documents(1)['pipeline_run'][0]))
+    assert isinstance(run.created_time, datetime)
+    assert isinstance(run.input_samples[0], Path)
+    assert isinstance(run.logs, PipelineLogs)
+
+
+def test_untrusted_documents_are_validated():
+    d = dump_document(sample_documents(1)['examination'][0])
+    d['data_model_version'] = '0.0.0'
+    d['started_date'] = 'not a date'
+
+    # documents of other versions are validated
+    with pytest.raises(ValueError):
+        load_document(Examination, d)
+
+    d = dump_document(sample_documents(1)['examination'][0])
+    del d['examinationtype']
+    with pytest.raises(ValueError):
+        construct_trusted(Examination, d)
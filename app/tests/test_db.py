@@ -1,7 +1,14 @@
+import json
+from urllib.parse import parse_qsl, urlsplit
+
 import pycouchdb as couch
 import pytest
+import responses
+
+import app.db
 
-from app.db import DB, View, DesignDoc, basic_view
+from app.db import DB, Db, View, DesignDoc, basic_view, MissingDocument
+from app.model import SequencerRun
 
 import subprocess
 import time
@@ -39,3 +46,239 @@ def test_create_document(db):
     res = db.get('sequencer_runs')
     res.pop('_rev')
     assert res == init_doc
+
+
+couchdb_url = 'http://localhost:5984/ngs_app'
+
+@pytest.fixture()
+def mocked_db(config):
+    ''' a Db connected to a mocked couchdb, register the responses of the requests '''
+    with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+        rsps.add(responses.HEAD, couchdb_url, status=200)
+        mdb = Db()
+        mdb.from_config(config)
+        yield mdb, rsps
+
+
+def test_get_bulk(mocked_db):
+    mdb, rsps = mocked_db
+    run = {
+        '_id': 'run1',
+        '_rev': '1-a',
+        'document_type': 'sequencer_run',
+        'original_path': '/tmp/run1',
+        'name_dirty': False,
+        'parsed': {},
+        'indexed_time': '2023-01-01T00:00:00',
+        'outputs': [],
+        }
+    rows = [
+        {'id': 'run1', 'key': 'run1', 'value': {'rev': '1-a'}, 'doc': run},
+        {'key': 'missing', 'error': 'not_found'},
+        {'id': 'deleted', 'key': 'deleted', 'value': {'rev': '2-b', 'deleted': True}, 'doc': None},
+        ]
+
+    def callback(request):
+        keys = json.loads(request.body)['keys']
+        res = [r for r in rows if r['key'] in keys]
+        return (200, {'Content-Type': 'application/json'}, json.dumps({'rows': res}))
+
+    rsps.add_callback(responses.POST, couchdb_url + '/_all_docs', callback=callback)
+
+    docs = mdb.get_bulk(['run1', 'missing', 'deleted'], chunk_size=2)
+
+    assert isinstance(docs[0], SequencerRun)
+    assert docs[0].id == 'run1'
+    assert docs[1] == MissingDocument('missing')
+    assert docs[2] == MissingDocument('deleted', reason='deleted')
+    # 3 ids with chunks of 2 need 2 requests
+    assert len([c for c in rsps.calls if c.request.method == 'POST']) == 2
+
+
+def test_lazy_query_pages(mocked_db):
+    mdb, rsps = mocked_db
+    view_rows = [{'id': f'doc{i}', 'key': [i // 2], 'value': None} for i in range(7)]
+
+    def callback(request):
+        params = dict(parse_qsl(urlsplit(request.url).query))
+        rows = view_rows
+        if 'startkey' in params:
+            start = (json.loads(params['startkey']), params.get('startkey_docid', ''))
+            rows = [r for r in rows if (r['key'], r['id']) >= start]
+        rows = rows[:int(params['limit'])]
+        return (200, {'Content-Type': 'application/json'}, json.dumps({'rows': rows}))
+
+    url = couchdb_url + '/_design/test/_view/all'
+    rsps.add_callback(responses.GET, url, callback=callback)
+
+    result = mdb.query('test/all?descending=false', lazy=True, page_size=3)
+    assert list(result.ids()) == [r['id'] for r in view_rows]
+    assert len([c for c in rsps.calls if c.request.method == 'GET']) == 3
+
+    result = mdb.query('test/all', lazy=True, page_size=3, limit=4)
+    assert list(result.ids()) == [f'doc{i}' for i in range(4)]
+
+
+plain_doc = {'_id': 'plain_doc', '_rev': '1-a', 'count': 0}
+
+def test_cached_get(mocked_db):
+    mdb, rsps = mocked_db
+    rsps.add(responses.GET, couchdb_url + '/_changes', json={'results': [], 'last_seq': '1-x'})
+    get = rsps.add(responses.GET, couchdb_url + '/plain_doc', json=plain_doc)
+
+    mdb.enable_cache(changes_interval=3600)
+    assert mdb.get('plain_doc')['count'] == 0
+    assert mdb.get('plain_doc')['count'] == 0
+    assert get.call_count == 1
+    assert mdb.cache_stats()['hits'] == 1
+
+    # saving invalidates the document
+    rsps.add(responses.PUT, couchdb_url + '/plain_doc', json={'ok': True, 'id': 'plain_doc', 'rev': '2-b'})
+    doc = mdb.get('plain_doc')
+    mdb.save(doc)
+    mdb.get('plain_doc')
+    assert get.call_count == 2
+
+
+def test_cached_get_rev_validation(mocked_db):
+    mdb, rsps = mocked_db
+    get = rsps.add(responses.GET, couchdb_url + '/plain_doc', json=plain_doc)
+    head = rsps.add(responses.HEAD, couchdb_url + '/plain_doc', headers={'ETag': '"1-a"'})
+
+    mdb.enable_cache(validation='rev')
+    mdb.get('plain_doc')
+    mdb.get('plain_doc')
+    assert get.call_count == 1
+    assert head.call_count == 1
+
+
+def test_views_dont_emit_documents():
+    for ddoc in app.db.ddocs:
+        for view in ddoc['views'].values():
+            assert 'doc);' not in view['map']
+
+
+def test_migrate_design_docs(mocked_db, monkeypatch):
+    mdb, rsps = mocked_db
+    ddoc = DesignDoc('test', [View('all', 'function (doc) { emit(doc._id, null); }')]).to_dict()
+    monkeypatch.setattr(app.db, 'ddocs', [ddoc])
+
+    live_url = couchdb_url + '/_design/test'
+    staging_url = couchdb_url + '/_design/test_staging'
+    staging = dict(ddoc, _id='_design/test_staging', _rev='1-s')
+
+    rsps.add(responses.GET, live_url, json={'error': 'not_found'}, status=404)
+    rsps.add(responses.HEAD, staging_url, status=404)
+    put_staging = rsps.add(responses.PUT, staging_url, json={'ok': True, 'id': '_design/test_staging', 'rev': '1-s'}, status=201)
+    rsps.add(responses.GET, staging_url, json=staging)
+    rsps.add(responses.GET, couchdb_url, json={'update_seq': '5-abc'})
+    rsps.add(responses.GET, staging_url + '/_view/all', json={'rows': []})
+    rsps.add(responses.GET, staging_url + '/_info', json={'view_index': {'update_seq': 5, 'updater_running': False}})
+    put_live = rsps.add(responses.PUT, live_url, json={'ok': True, 'id': '_design/test', 'rev': '1-l'}, status=201)
+    delete_staging = rsps.add(responses.DELETE, staging_url, json={'ok': True, 'id': '_design/test_staging', 'rev': '2-s'})
+    rsps.add(responses.POST, couchdb_url + '/_view_cleanup', json={'ok': True}, status=202)
+    rsps.add(responses.POST, couchdb_url + '/_index', json={'result': 'exists'})
+
+    assert mdb.migrate_design_docs(poll_interval=0) == ['_design/test']
+    assert put_staging.call_count == 1
+    assert put_live.call_count == 1
+    assert delete_staging.call_count == 1
+    assert json.loads(put_live.calls[0].request.body)['version'] == app.db.DESIGN_DOCS_VERSION
+
+
+def test_indexer_progress(mocked_db):
+    mdb, rsps = mocked_db
+    tasks = [
+        {'type': 'indexer', 'database': 'shards/00000000-7fffffff/ngs_app.1681206311', 'design_document': '_design/patients', 'changes_done': 10, 'total_changes': 50},
+        {'type': 'indexer', 'database': 'shards/80000000-ffffffff/ngs_app.1681206311', 'design_document': '_design/patients', 'changes_done': 30, 'total_changes': 50},
+        {'type': 'indexer', 'database': 'shards/00000000-ffffffff/other.1681206311', 'design_document': '_design/patients', 'changes_done': 0, 'total_changes': 50},
+        {'type': 'replication'},
+        ]
+    rsps.add(responses.GET, 'http://localhost:5984/_active_tasks', json=tasks)
+
+    assert mdb.indexer_progress() == [{
+        'design_document': '_design/patients',
+        'changes_done': 40,
+        'total_changes': 100,
+        'progress': 40,
+        }]
+
+
+def test_stale_query(mocked_db):
+    mdb, rsps = mocked_db
+    view = rsps.add(responses.GET, couchdb_url + '/_design/test/_view/all', json={'rows': []})
+    mdb.query('test/all', stale=True)
+    params = dict(parse_qsl(urlsplit(view.calls[0].request.url).query))
+    assert params['update'] == 'lazy'
+    assert params['stable'] == 'true'
+
+
+def test_find_lazy_bookmarks(mocked_db):
+    mdb, rsps = mocked_db
+    docs = [{'_id': f'exam{i}', 'document_type': 'examination'} for i in range(5)]
+
+    def callback(request):
+        body = json.loads(request.body)
+        start = int(body.get('bookmark', 0))
+        page = docs[start:start+body['limit']]
+        result = {'docs': page, 'bookmark': str(start + len(page))}
+        return (200, {'Content-Type': 'application/json'}, json.dumps(result))
+
+    find = rsps.add_callback(responses.POST, couchdb_url + '/_find', callback=callback)
+
+    selector = app.db.examination_selector(mol_nr=4000, year=2020)
+    assert selector == {'document_type': 'examination', 'filemaker_record.Jahr': 2020, 'filemaker_record.Mol_NR': 4000}
+
+    result = mdb.find_lazy(selector, page_size=2)
+    assert [d['_id'] for d in result.docs()] == [d['_id'] for d in docs]
+    assert find.call_count == 3
+    assert json.loads(find.calls[0].request.body)['selector'] == selector
+
+    page = mdb.find(selector, limit=2)
+    assert page.bookmark == '2'
+    assert page.ids() == ['exam0', 'exam1']
+
+
+def test_create_index(mocked_db):
+    mdb, rsps = mocked_db
+    index = rsps.add(responses.POST, couchdb_url + '/_index', json={'result': 'created', 'id': '_design/mango_test', 'name': 'test'})
+    mdb.create_index(['started_date'], name='test', ddoc='mango_test', partial_filter_selector={'document_type': 'examination'})
+    assert json.loads(index.calls[0].request.body) == {
+        'index': {'fields': ['started_date'], 'partial_filter_selector': {'document_type': 'examination'}},
+        'type': 'json',
+        'name': 'test',
+        'ddoc': 'mango_test',
+        }
+
+
+def test_save_bulk_resolves_conflicts(mocked_db):
+    mdb, rsps = mocked_db
+    stored = {'_id': 'a', '_rev': '2-b', 'document_type': 'app_settings', 'v': 1}
+    bodies = []
+
+    def bulk_docs(request):
+        docs = json.loads(request.body)['docs']
+        bodies.append(docs)
+        res = []
+        for d in docs:
+            if d['_id'] == 'a' and d.get('_rev') != stored['_rev']:
+                res.append({'id': 'a', 'error': 'conflict', 'reason': 'Document update conflict.'})
+            else:
+                res.append({'id': d['_id'], 'ok': True, 'rev': '3-c'})
+        return (201, {'Content-Type': 'application/json'}, json.dumps(res))
+
+    def all_docs(request):
+        rows = [{'id': 'a', 'key': 'a', 'value': {'rev': '2-b'}, 'doc': stored}]
+        return (200, {'Content-Type': 'application/json'}, json.dumps({'rows': rows}))
+
+    rsps.add_callback(responses.POST, couchdb_url + '/_bulk_docs', callback=bulk_docs)
+    rsps.add_callback(responses.POST, couchdb_url + '/_all_docs', callback=all_docs)
+
+    docs = mdb.save_bulk([{'id': 'a', 'v': 2}, {'id': 'b'}], merge='ours')
+
+    # only the conflicting document is sent again, with the latest revision
+    assert bodies[1] == [{'_id': 'a', '_rev': '2-b', 'v': 2}]
+    assert [d['_rev'] for d in docs] == ['3-c', '3-c']
+    stats = mdb.bulk_write_stats()
+    assert stats['conflicts'] == 1
+    assert stats['batches'] == 2
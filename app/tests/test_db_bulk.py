@@ -0,0 +1,92 @@
+import pytest
+
+from app.db_bulk import BulkWriter, BulkWriteError
+from app.tasks_impl import merge_examination_links, merge_sequencer_run_links
+
+
+class BulkDB:
+    ''' fake db that implements the revision checks of _bulk_docs '''
+    def __init__(self, docs=[]):
+        self.docs = {d['_id']: dict(d) for d in docs}
+        self.requests = 0
+
+    def _post_bulk_docs(self, docs):
+        self.requests += 1
+        results = []
+        for d in docs:
+            current = self.docs.get(d['_id'])
+            if current is not None and current['_rev'] != d.get('_rev'):
+                results.append({'id': d['_id'], 'error': 'conflict', 'reason': 'Document update conflict.'})
+                continue
+            n = 0 if current is None else int(current['_rev'].split('-')[0])
+            rev = f'{n+1}-x'
+            self.docs[d['_id']] = dict(d, _rev=rev)
+            results.append({'id': d['_id'], 'ok': True, 'rev': rev})
+        return results
+
+    def _get_bulk_raw(self, ids):
+        return [dict(self.docs[i]) if i in self.docs else None for i in ids]
+
+
+def test_bulk_writer_batches():
+    bdb = BulkDB()
+    writer = BulkWriter(bdb, batch_size=2)
+    docs = writer.write([{'_id': f'd{i}'} for i in range(5)])
+
+    assert [d['_rev'] for d in docs] == ['1-x'] * 5
+    assert bdb.requests == 3
+    assert writer.stats.dict()['docs'] == 5
+    assert writer.stats.conflicts == 0
+
+
+def test_bulk_writer_conflict_raises():
+    bdb = BulkDB([{'_id': 'a', '_rev': '1-x', 'v': 1}])
+    writer = BulkWriter(bdb)
+
+    with pytest.raises(BulkWriteError) as e:
+        writer.write([{'_id': 'a', 'v': 2}, {'_id': 'b'}])
+
+    # the other documents of the batch are saved anyway
+    assert 'b' in bdb.docs
+    assert e.value.failed[0]['id'] == 'a'
+    assert bdb.docs['a']['v'] == 1
+
+
+def test_bulk_writer_merge_policies():
+    bdb = BulkDB([{'_id': 'a', '_rev': '1-x', 'v': 1}, {'_id': 'b', '_rev': '1-x', 'v': 1}])
+
+    docs = BulkWriter(bdb, merge='theirs').write([{'_id': 'a', 'v': 2}])
+    assert docs[0] == {'_id': 'a', '_rev': '1-x', 'v': 1}
+
+    writer = BulkWriter(bdb, merge='ours')
+    docs = writer.write([{'_id': 'b', 'v': 2}])
+    assert docs[0] == {'_id': 'b', '_rev': '2-x', 'v': 2}
+    assert bdb.docs['b']['v'] == 2
+    assert writer.stats.conflicts == 1
+    assert writer.stats.retries == 1
+
+
+def test_merge_examination_links():
+    bdb = BulkDB([{'_id': 'e', '_rev': '3-x', 'sequencer_runs': ['s1'], 'pipeline_runs': ['p1']}])
+    ours = {'_id': 'e', '_rev': '2-x', 'sequencer_runs': ['s2'], 'pipeline_runs': []}
+
+    BulkWriter(bdb, merge=merge_examination_links).write([ours])
+
+    assert bdb.docs['e']['_rev'] == '4-x'
+    assert bdb.docs['e']['sequencer_runs'] == ['s1', 's2']
+    assert bdb.docs['e']['pipeline_runs'] == ['p1']
+
+
+def test_merge_sequencer_run_links():
+    bdb = BulkDB([
+        {'_id': 'r', '_rev': '2-x', 'document_type': 'sequencer_run', 'outputs': ['a.fastq.gz']},
+        {'_id': 'e', '_rev': '2-x', 'document_type': 'examination', 'sequencer_runs': ['s1'], 'pipeline_runs': []},
+        ])
+    run = {'_id': 'r', '_rev': '1-x', 'document_type': 'sequencer_run', 'outputs': ['b.fastq.gz']}
+    exam = {'_id': 'e', '_rev': '1-x', 'document_type': 'examination', 'sequencer_runs': ['r'], 'pipeline_runs': []}
+
+    BulkWriter(bdb, merge=merge_sequencer_run_links).write([run, exam])
+
+    # the newly found outputs arent dropped
+    assert bdb.docs['r']['outputs'] == ['a.fastq.gz', 'b.fastq.gz']
+    assert bdb.docs['e']['sequencer_runs'] == ['s1', 'r']
@@ -0,0 +1,116 @@
+import pytest
+import pycouchdb as couch
+from concurrent.futures import ThreadPoolExecutor
+
+from app.db_cache import DocumentCache
+
+
+def test_lru_eviction():
+    cache = DocumentCache(max_entries=2)
+    cache.put('a', {'_id': 'a', '_rev': '1-a'})
+    cache.put('b', {'_id': 'b', '_rev': '1-b'})
+
+    # touch a, so b is the least recently used document
+    assert cache.get('a') == {'_id': 'a', '_rev': '1-a'}
+    cache.put('c', {'_id': 'c', '_rev': '1-c'})
+
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_size_bound_and_copies():
+    cache = DocumentCache(max_bytes=100)
+    cache.put('a', {'_id': 'a', 'data': 'x'*50})
+    cache.put('b', {'_id': 'b', 'data': 'x'*50})
+    assert len(cache) == 1
+    assert cache.stats()['bytes'] <= 100
+
+    # hits are copies, modifying them doesnt change the cache
+    d = cache.get('b')
+    d['data'] = ''
+    assert cache.get('b')['data'] == 'x'*50
+
+
+def test_apply_changes():
+    cache = DocumentCache()
+    cache.put('a', {'_id': 'a', '_rev': '1-a'})
+    cache.apply_changes(['a', 'unknown'], '5-xyz')
+    assert 'a' not in cache
+    assert cache.last_seq == '5-xyz'
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_shared_by_threads():
+    cache = DocumentCache(max_entries=50)
+
+    def work(n):
+        for i in range(2000):
+            doc_id = f'{(n * 7 + i) % 80}'
+            cache.put(doc_id, {'_id': doc_id, '_rev': f'{i}-x'})
+            cache.get(doc_id)
+            cache.rev(doc_id)
+            if i % 3 == 0:
+                cache.invalidate(doc_id)
+            if i % 500 == 0:
+                cache.apply_changes([doc_id], str(i))
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(work, range(8)))
+
+    stats = cache.stats()
+    assert stats['hits'] + stats['misses'] == 8 * 2000
+    assert len(cache) <= 50
+    # the byte count stays exact under concurrent updates
+    assert stats['bytes'] == sum(len(data) for _, data in cache._docs.values())
+
+
+def test_cached_document_updated_twice(memory_db):
+    memory_db.enable_cache(changes_interval=3600)
+    memory_db.save({'id': 'doc', 'n': 0})
+
+    for n in [1, 2]:
+        doc = memory_db.get('doc')
+        assert doc['n'] == n - 1
+        doc['n'] = n
+        memory_db.save(doc)
+    assert memory_db.get('doc')['n'] == 2
+
+    # another process updates the document, the stale _rev conflicts once,
+    # then the current revision is read instead of the cached one
+    other = memory_db.couchdb.get('doc')
+    other['n'] = 3
+    memory_db.couchdb.save(other)
+    stale = memory_db.get('doc')
+    stale['n'] = 4
+    with pytest.raises(couch.exceptions.Conflict):
+        memory_db.save(stale)
+    doc = memory_db.get('doc')
+    assert doc['n'] == 3
+    doc['n'] = 4
+    memory_db.save(doc)
+
+
+def test_uncached_get_reads_current_revision(memory_db):
+    memory_db.enable_cache(changes_interval=3600)
+    memory_db.get('app_state')
+
+    state = memory_db.couchdb.get('app_state')
+    state['last_synced_filemaker_row'] = 42
+    memory_db.couchdb.save(state)
+    assert memory_db.get('app_state', cached=False)['last_synced_filemaker_row'] == 42
+
+
+def test_schedule_reads_cached_settings(memory_db):
+    from app.tasks_utils import Schedule
+
+    memory_db.enable_cache(changes_interval=3600)
+    schedule = Schedule(memory_db)
+    requests = memory_db.pool.stats()['requests']
+    for _ in range(5):
+        assert schedule.is_enabled()
+        schedule.has_work_now()
+    assert memory_db.pool.stats()['requests'] - requests == 1
@@ -0,0 +1,404 @@
+from copy import deepcopy
+
+import pytest
+
+from app.db import ddocs, mango_indexes, DESIGN_DOCS_VERSION, MissingDocument, NotFound
+from app.db_bulk import BulkWriteError
+from app.db_memory import python_views, PYTHON_VIEWS_VERSION, collate
+from app.fingerprints import FingerprintIndex
+from app.model import Examination
+from app.parsers import parse_date
+
+
+def exam_doc(i, name='Mustermann', mol_nr=None):
+    return {
+        'id': f'exam{i}',
+        'document_type': 'examination',
+        'examinationtype': 'DNA Panel ONCOHS',
+        'started_date': f'2023-01-{i+1:02d}T00:00:00',
+        'sequencer_runs': [f'run{i}'] if i % 2 == 0 else [],
+        'pipeline_runs': [],
+        'filemaker_record': {
+            'id': f'filemaker_record_row_{i}',
+            'Name': name,
+            'Vorname': 'Erika',
+            'GBD': '01/01/1970',
+            'Untersuchung': 'DNA Panel ONCOHS',
+            'Jahr': 2023,
+            'Mol_NR': i if mol_nr is None else mol_nr,
+            },
+        }
+
+
+def test_python_views_cover_design_docs():
+    # update the python views in app.db_memory with the javascript views
+    assert PYTHON_VIEWS_VERSION == DESIGN_DOCS_VERSION
+    for ddoc in ddocs:
+        name = ddoc['_id'][len('_design/'):]
+        for view in ddoc['views']:
+            assert (name, view) in python_views
+
+
+def test_collation_order():
+    values = [{}, ['a', {}], ['a'], 'b', 'a', 2, 1.5, True, False, None]
+    assert sorted(values, key=collate) == list(reversed(values))
+
+
+def test_documents_and_revisions(memory_db):
+    doc = memory_db.save({'id': 'a', 'v': 1})
+    assert doc['_rev'].startswith('1-')
+    assert 'a' in memory_db
+
+    with pytest.raises(Exception):
+        # saving without the latest rev is a conflict
+        memory_db.save({'id': 'a', 'v': 2})
+
+    doc = memory_db.save({'id': 'a', 'rev': doc['_rev'], 'v': 2})
+    assert doc['_rev'].startswith('2-')
+    assert memory_db.get('a')['v'] == 2
+
+    memory_db.delete('a')
+    with pytest.raises(NotFound):
+        memory_db.get('a')
+    assert memory_db.get_bulk(['a', 'b']) == [MissingDocument('a', reason='deleted'), MissingDocument('b')]
+
+
+def test_bulk_write_conflicts(memory_db):
+    memory_db.save_bulk([{'id': f'd{i}', 'v': 0} for i in range(10)], batch_size=3)
+    with pytest.raises(BulkWriteError):
+        memory_db.save_bulk([{'id': 'd1', 'v': 1}])
+
+    docs = memory_db.save_bulk([{'id': 'd1', 'v': 1}, {'id': 'd11'}], merge='ours')
+    assert docs[0]['_rev'].startswith('2-')
+    assert memory_db.get('d1')['v'] == 1
+
+
+def test_views(memory_db):
+    memory_db.save_bulk([exam_doc(i) for i in range(6)])
+
+    exams = memory_db.query('examinations/examinations', include_docs=True).to_wrapped().docs()
+    assert [e.id for e in exams] == [f'exam{i}' for i in range(6)]
+    assert isinstance(exams[0], Examination)
+
+    res = memory_db.query('examinations/examinations', startkey='2023-01-02', endkey='2023-01-04', descending=False)
+    assert res.ids() == ['exam1', 'exam2']
+
+    res = memory_db.query('examinations/examinations', descending=True, limit=2)
+    assert res.ids() == ['exam5', 'exam4']
+
+    assert memory_db.query('examinations/types?group=true').rows == [{'key': 'DNA Panel ONCOHS', 'value': 6}]
+    assert memory_db.query('examinations/examinations_count').rows[0]['value'] == 6
+    assert memory_db.query('examinations/new_examinations').ids() == ['exam0', 'exam2', 'exam4']
+    assert memory_db.query('examinations/mp_number', key=[2023, 3]).ids() == ['exam3']
+
+    # lazy paging with startkey_docid over duplicate keys
+    memory_db.save_bulk([exam_doc(i, mol_nr=1) for i in range(6, 11)])
+    lazy = memory_db.query('examinations/mp_number', key=[2023, 1], lazy=True, page_size=2)
+    assert list(lazy.ids()) == ['exam1', 'exam10', 'exam6', 'exam7', 'exam8', 'exam9']
+
+
+def test_reduce_group_level(memory_db):
+    memory_db.save_bulk([
+        {'id': 'filemaker_record_row_0', 'document_type': 'filemaker_record'},
+        {'id': 'filemaker_record_row_1', 'document_type': 'filemaker_record'},
+        ] + [exam_doc(0)])
+
+    rows = memory_db.query('filemaker/all?group_level=1').rows
+    assert rows == [
+        {'key': ['filemaker_record_row_0'], 'value': 1},
+        {'key': ['filemaker_record_row_1'], 'value': 0},
+        ]
+    res = memory_db.query('filemaker/all', keys=[['filemaker_record_row_0', 1]], reduce=False)
+    assert res.ids() == ['exam0']
+
+
+def test_changes_and_find(memory_db):
+    since = memory_db.changes(since='now')['last_seq']
+    memory_db.save_bulk([exam_doc(i) for i in range(3)] + [{'id': 'other'}])
+
+    changes = memory_db.changes(since=since, selector={'document_type': 'examination'}, include_docs=True)
+    assert [c['id'] for c in changes['results']] == ['exam0', 'exam1', 'exam2']
+
+    res = memory_db.find({'document_type': 'examination', 'filemaker_record.Mol_NR': {'$gte': 1}}, sort=[{'_id': 'desc'}])
+    assert res.ids() == ['exam2', 'exam1']
+
+    page = memory_db.find({'document_type': 'examination'}, limit=2)
+    rest = memory_db.find({'document_type': 'examination'}, limit=2, bookmark=page.bookmark)
+    assert page.ids() + rest.ids() == ['exam0', 'exam1', 'exam2']
+
+
+def test_migrate_design_docs(memory_db):
+    # an up to date database has nothing to migrate
+    assert memory_db.migrate_design_docs(poll_interval=0) == []
+    assert len(memory_db.list_indexes()) == 1 + len(mango_indexes)
+
+    old = memory_db.couchdb.get('_design/patients')
+    old['version'] = 1
+    memory_db.couchdb.save(old)
+    memory_db.save(exam_doc(0))
+
+    assert memory_db.migrate_design_docs(poll_interval=0) == ['_design/patients']
+    assert memory_db.couchdb.get('_design/patients')['version'] == DESIGN_DOCS_VERSION
+    assert '_design/patients_staging' not in memory_db.couchdb
+    assert memory_db.query('patients/patient_aggregation').ids() == ['exam0']
+
+
+def test_bench_ingest(monkeypatch):
+    from app import tasks_impl
+    from app.benchmarks import bench_ingest
+    from app.db import Db
+
+    # dont point the global DB at the memory backend
+    bench_db = Db()
+    monkeypatch.setattr(tasks_impl, 'DB', bench_db)
+    monkeypatch.setattr(tasks_impl, 'db', bench_db)
+
+    results = bench_ingest(n=30, patients=10, repeat=1)
+    assert set(results) == {'ingest', 'create_examinations', 'aggregate_patients'}
+    assert len(bench_db.query('examinations/examinations').rows) == 30
+    assert 0 < len(bench_db.query('patients/patients').rows) <= 10
+
+
+def test_exists_many(memory_db):
+    memory_db.save_bulk([{'id': f'd{i}'} for i in range(1500)])
+    memory_db.delete('d3')
+
+    before = memory_db.connection_stats()['requests']
+    existing = memory_db.exists_many([f'd{i}' for i in range(1000)] + ['missing'])
+    assert memory_db.connection_stats()['requests'] - before == 2
+
+    assert len(existing) == 999
+    assert 'd3' not in existing and 'missing' not in existing
+
+
+def test_filemaker_sync_skips_existing_records(memory_db, monkeypatch):
+    from app import tasks_impl
+    from app.benchmarks import StaticFilemaker, filemaker_records
+
+    monkeypatch.setattr(tasks_impl, 'DB', memory_db)
+    records = filemaker_records(30, 10)
+    # processor modifies the records, filemaker returns new ones for every request
+    tasks_impl.retrieve_new_filemaker_data_incremental(StaticFilemaker(deepcopy(records[:20])), tasks_impl.processor, FingerprintIndex.open(memory_db), backoff_time=0)
+    count = memory_db.couchdb.config()['doc_count']
+
+    # the first 20 records are served again after resetting the checkpoint
+    app_state = memory_db.get('app_state')
+    app_state['last_synced_filemaker_row'] = 0
+    memory_db.save(app_state)
+
+    saved = []
+    save_bulk = memory_db.save_bulk
+    monkeypatch.setattr(memory_db, 'save_bulk', lambda docs, **kwargs: saved.extend(docs) or save_bulk(docs, **kwargs))
+    tasks_impl.retrieve_new_filemaker_data_incremental(StaticFilemaker(records), tasks_impl.processor, FingerprintIndex.open(memory_db), backoff_time=0)
+
+    assert len(saved) == 10
+    assert memory_db.couchdb.config()['doc_count'] == count + 10
+
+
+def test_filemaker_sync_checkpoint_stops_at_failed_page(memory_db, monkeypatch):
+    from app import tasks_impl
+    from app.benchmarks import StaticFilemaker, filemaker_records
+
+    class FailingFilemaker(StaticFilemaker):
+        def get_all_records(self, offset, limit=1000):
+            if offset == 2001:
+                raise RuntimeError('filemaker is unavailable')
+            return super().get_all_records(offset, limit)
+
+    monkeypatch.setattr(tasks_impl, 'DB', memory_db)
+    records = filemaker_records(3500, 100)
+    batches = tasks_impl.retrieve_new_filemaker_data_incremental(FailingFilemaker(records), tasks_impl.processor, FingerprintIndex.open(memory_db), prefetch=4)
+
+    # the page after the failed one was fetched already, but isnt saved
+    assert batches == 2
+    assert memory_db.get('app_state')['last_synced_filemaker_row'] == 2000
+    assert len(memory_db.exists_many([tasks_impl.filemaker_record_doc_id(r) for r in records[2000:]])) == 0
+
+
+def test_filemaker_delta_sync(memory_db, monkeypatch):
+    from app import tasks_impl
+    from app.benchmarks import StaticFilemaker, filemaker_records
+
+    monkeypatch.setattr(tasks_impl, 'DB', memory_db)
+    records = filemaker_records(300, 50)
+    filemaker = StaticFilemaker(deepcopy(records))
+    tasks_impl.retrieve_new_filemaker_data_delta(filemaker, tasks_impl.processor, FingerprintIndex.open(memory_db))
+
+    # BRAF Ex11 isnt an examination type of the pipeline
+    wanted = [r for r in records if r['fieldData']['Untersuchung'] != 'BRAF Ex11']
+    ids = [tasks_impl.filemaker_record_doc_id(r) for r in wanted]
+    assert memory_db.exists_many(ids) == set(ids)
+    assert len(memory_db.exists_many([tasks_impl.filemaker_record_doc_id(r) for r in records])) == len(wanted)
+    newest = max(parse_date(r['fieldData']['Zeitstempel']) for r in wanted)
+    assert memory_db.get('app_state')['last_synced_filemaker_date'] == newest.date().isoformat()
+
+    # the next cycle only asks for the records since the mark
+    requested = []
+    filemaker = StaticFilemaker(deepcopy(records))
+    get_new = filemaker.get_new_records_by_date
+    monkeypatch.setattr(filemaker, 'get_new_records_by_date', lambda *args, **kwargs: requested.append(args) or get_new(*args, **kwargs))
+    tasks_impl.retrieve_new_filemaker_data_delta(filemaker, tasks_impl.processor, FingerprintIndex.open(memory_db))
+    assert set(requested) == {(newest.day, newest.month, newest.year)}
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_create_examinations_in_batches(memory_db, monkeypatch, workers):
+    from app import tasks_impl
+    from app.benchmarks import StaticFilemaker, filemaker_records
+
+    monkeypatch.setattr(tasks_impl, 'DB', memory_db)
+    monkeypatch.setattr(tasks_impl, 'db', memory_db)
+    records = filemaker_records(250, 50)
+    tasks_impl.retrieve_new_filemaker_data_incremental(StaticFilemaker(deepcopy(records)), tasks_impl.processor, FingerprintIndex.open(memory_db))
+
+    requests = memory_db.pool.stats()['requests']
+    assert tasks_impl.create_examinations(batch_size=40, workers=workers) == 250
+    # a few requests per batch instead of two per record
+    assert memory_db.pool.stats()['requests'] - requests < 50
+
+    groups = memory_db.query('filemaker/all?group_level=1&').rows
+    assert sorted(g['value'] for g in groups) == [1] * 250
+    assert tasks_impl.create_examinations(batch_size=40, workers=workers) == 0
+
+
+def test_query_ranges(memory_db):
+    memory_db.save_bulk([exam_doc(i, mol_nr=i % 3) for i in range(9)])
+
+    requests = memory_db.pool.stats()['requests']
+    res = memory_db.query_ranges('examinations/mp_number', [([2023, 2], [2023, 2]), ([2023, 0], [2023, 0])],
+            include_docs=True, batch_size=1)
+    assert res.ids() == ['exam2', 'exam5', 'exam8', 'exam0', 'exam3', 'exam6']
+    assert res.to_wrapped().docs()[0].id == 'exam2'
+    assert memory_db.pool.stats()['requests'] - requests == 2
+
+
+def test_incremental_patient_aggregation(memory_db, monkeypatch):
+    from app import tasks_impl
+    from app.benchmarks import StaticFilemaker, filemaker_records
+
+    monkeypatch.setattr(tasks_impl, 'DB', memory_db)
+    monkeypatch.setattr(tasks_impl, 'db', memory_db)
+    records = filemaker_records(120, 30)
+    tasks_impl.retrieve_new_filemaker_data_incremental(StaticFilemaker(deepcopy(records[:100])), tasks_impl.processor, FingerprintIndex.open(memory_db))
+    tasks_impl.create_examinations()
+    assert tasks_impl.aggregate_patients() > 0
+    # the full aggregation is the checkpoint of the incremental one
+    assert tasks_impl.aggregate_patients(incremental=True) == 0
+
+    tasks_impl.retrieve_new_filemaker_data_incremental(StaticFilemaker(deepcopy(records)), tasks_impl.processor, FingerprintIndex.open(memory_db))
+    tasks_impl.create_examinations()
+
+    requests = memory_db.pool.stats()['requests']
+    assert tasks_impl.aggregate_patients(incremental=True) == 20
+    # the changes, one multiple queries request and one bulk save
+    assert memory_db.pool.stats()['requests'] - requests < 10
+
+    def linked():
+        patients = memory_db.query('patients/patients', include_docs=True).to_wrapped().docs()
+        return {p.id: sorted(p.examinations) for p in patients}
+
+    incremental = linked()
+    # a full aggregation has nothing left to do
+    assert tasks_impl.aggregate_patients() == 0
+    assert linked() == incremental
+    assert sum(len(e) for e in incremental.values()) == 120
+
+
+def test_patient_aggregation_parses_birthdates(memory_db, monkeypatch):
+    from app import tasks_impl
+
+    monkeypatch.setattr(tasks_impl, 'db', memory_db)
+    exams = [exam_doc(i) for i in range(3)]
+    for e, gbd in zip(exams, ['1/2/1970', '01/02/1970', '01/2/1970']):
+        e['filemaker_record'].update(GBD=gbd, Geschlecht='W')
+    memory_db.save_bulk(exams[:2])
+
+    assert tasks_impl.aggregate_patients() == 1
+    patients = memory_db.query('patients/patients', include_docs=True).to_wrapped().docs()
+    assert [sorted(p.examinations) for p in patients] == [['exam0', 'exam1']]
+    assert patients[0].birthdate == parse_date('01/02/1970')
+
+    # the patient of the new examination is found by its parsed birthdate
+    memory_db.save(exams[2])
+    exam = memory_db.get('exam2')
+    assert tasks_impl.patient_group_key(exam) == ('Mustermann', 'Erika', '1970-01-02')
+    assert tasks_impl.link_patients_of_examinations([exam]) == 1
+    patients = memory_db.query('patients/patients', include_docs=True).to_wrapped().docs()
+    assert [sorted(p.examinations) for p in patients] == [['exam0', 'exam1', 'exam2']]
+
+
+def test_aggregate_patients_saves_in_batches(memory_db, monkeypatch):
+    from app import tasks_impl
+
+    monkeypatch.setattr(tasks_impl, 'db', memory_db)
+    monkeypatch.setattr(tasks_impl, 'PATIENT_SAVE_BATCH_SIZE', 2)
+    exams = [exam_doc(i, name=f'Name{i}') for i in range(5)]
+    for e in exams:
+        e['filemaker_record']['Geschlecht'] = 'W'
+    memory_db.save_bulk(exams)
+
+    aggregated = []
+    aggregate_patient_group = tasks_impl.aggregate_patient_group
+    monkeypatch.setattr(tasks_impl, 'aggregate_patient_group', lambda *args: aggregated.append(args[0]) or aggregate_patient_group(*args))
+    saves = []
+    save_bulk = memory_db.save_bulk
+    monkeypatch.setattr(memory_db, 'save_bulk', lambda docs, **kwargs: saves.append((len(docs), len(aggregated))) or save_bulk(docs, **kwargs))
+
+    assert tasks_impl.aggregate_patients() == 5
+    # the patients are saved while the view is read
+    assert saves == [(2, 2), (2, 4), (1, 5)]
+
+
+def test_get_examinations_of_samples(memory_db, monkeypatch):
+    from app import tasks_impl
+
+    monkeypatch.setattr(tasks_impl, 'db', memory_db)
+    memory_db.save_bulk([exam_doc(i, mol_nr=2500 + i) for i in range(4)] + [exam_doc(4, mol_nr=2503)])
+
+    samples = [f'/run/Fastq/{n}-23_S{k}_L001_R{r}_001.fastq.gz'
+            for k, n in enumerate([2500, 2501, 2503, 2600]) for r in [1, 2]]
+    samples.append('/run/Fastq/Undetermined_S0_L001_R1_001.fastq.gz')
+
+    requests = memory_db.pool.stats()['requests']
+    examinations = tasks_impl.get_examinations_of_samples(samples)
+    assert memory_db.pool.stats()['requests'] - requests == 1
+
+    assert {s: e.id if e is not None else None for s, e in examinations.items()} == {
+        samples[0]: 'exam0', samples[1]: 'exam0',
+        samples[2]: 'exam1', samples[3]: 'exam1',
+        # 2503-23 has two examinations, 2600-23 none
+        samples[6]: None, samples[7]: None,
+        }
+    assert [e.id for e in tasks_impl.link_sample_examinations(samples)] == ['exam0', 'exam1']
+
+
+def test_collect_work_retries_examinations_without_run(memory_db, monkeypatch):
+    from app import tasks_impl
+
+    monkeypatch.setattr(tasks_impl, 'db', memory_db)
+    memory_db.save_bulk([exam_doc(i) for i in range(4)])
+
+    # the feed is only a trigger, the changed documents arent read
+    changes = memory_db.changes
+    def trigger_changes(since=0, limit=None, include_docs=False, selector=None):
+        assert not include_docs and limit <= 1
+        return changes(since=since, limit=limit, include_docs=include_docs, selector=selector)
+    monkeypatch.setattr(memory_db, 'changes', trigger_changes)
+
+    def collected():
+        groups = tasks_impl.collect_work(incremental=True)
+        return sorted(e.id for exams in groups.values() for e in exams)
+
+    assert collected() == ['exam0', 'exam2']
+    # starting the runs failed, the examinations are collected again
+    assert collected() == ['exam0', 'exam2']
+
+    for e in memory_db.get_bulk(['exam0', 'exam2']):
+        memory_db.save(e.model_copy(update={'pipeline_runs': ['prun']}))
+    assert collected() == []
+
+    # nothing changed and nothing is pending, the view isnt read
+    def query(*args, **kwargs):
+        raise AssertionError('the view was read')
+    monkeypatch.setattr(memory_db, 'query', query)
+    assert collected() == []
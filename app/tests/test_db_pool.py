@@ -0,0 +1,72 @@
+import pytest
+import responses
+from concurrent.futures import ThreadPoolExecutor
+
+from app.db_pool import PooledSession
+
+
+@responses.activate
+def test_pooled_session_stats():
+    responses.add(responses.GET, 'http://localhost:5984/ngs_app/doc', json={'_id': 'doc'}, status=200)
+    responses.add(responses.GET, 'http://localhost:5984/ngs_app/missing', json={'error': 'not_found'}, status=404)
+
+    pool = PooledSession('testuser', 'testpsw', pool_size=4)
+    pool.session.get('http://localhost:5984/ngs_app/doc')
+    pool.session.get('http://localhost:5984/ngs_app/missing')
+
+    stats = pool.stats()
+    assert stats['requests'] == 2
+    assert stats['errors'] == 1
+    assert stats['pool_size'] == 4
+    assert responses.calls[0].request.headers['Authorization'].startswith('Basic ')
+    assert responses.calls[0].request.headers['Accept-Encoding'] == 'gzip'
+
+
+@responses.activate
+def test_pooled_session_counts_chunked_bodies():
+    # views and _changes are sent chunked, without Content-Length
+    body = b'{"rows": [' + b','.join(b'{"id": "doc%d"}' % i for i in range(100)) + b']}'
+    responses.add(responses.GET, 'http://localhost:5984/ngs_app/_all_docs', body=body, status=200,
+            auto_calculate_content_length=False)
+
+    pool = PooledSession(pool_size=1)
+    r = pool.session.get('http://localhost:5984/ngs_app/_all_docs')
+    assert 'Content-Length' not in r.headers
+    assert pool.stats()['bytes_received'] == len(body)
+
+    r = pool.session.get('http://localhost:5984/ngs_app/_all_docs', stream=True)
+    assert sum(len(c) for c in r.iter_content(64)) == len(body)
+    assert pool.stats()['bytes_received'] == 2 * len(body)
+
+
+@responses.activate
+def test_pooled_session_counts_requests_of_threads():
+    responses.add(responses.GET, 'http://localhost:5984/ngs_app/doc', body=b'{"_id": "doc"}', status=200)
+
+    pool = PooledSession(pool_size=4)
+    def work(n):
+        for i in range(50):
+            pool.session.get('http://localhost:5984/ngs_app/doc')
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(work, range(4)))
+
+    stats = pool.stats()
+    assert stats['requests'] == 200
+    assert stats['bytes_received'] == 200 * len(b'{"_id": "doc"}')
+
+
+def test_pooled_session_check_fork():
+    pool = PooledSession('testuser', 'testpsw')
+    adapters = pool.adapters
+
+    # same process, nothing changes
+    pool.check_fork()
+    assert pool.adapters is adapters
+
+    # pretend the pool was created in a parent process
+    pool.pid = -1
+    pool.check_fork()
+    assert pool.forks == 1
+    assert pool.adapters is not adapters
+    assert pool.session.get_adapter('http://localhost:5984') is pool.adapters[0]
@@ -1,7 +1,13 @@
+import time
+import datetime
+import json
+import threading
+
 import pytest
+import requests
 import responses
 
-from app.filemaker_api import Filemaker
+from app.filemaker_api import Filemaker, RateController, RecordStream, iter_pages
 
 class TestFilemaker:
     @responses.activate
@@ -43,3 +49,181 @@ class TestFilemaker:
         recs = fm.get_all_records(100)
         assert fm._token == resp['response']['token']
         assert recs == filemaker_testdata
+
+
+def test_iter_pages_in_order_with_prefetch():
+    total = 2500
+    in_flight = []
+    max_in_flight = []
+    lock = threading.Lock()
+
+    def get_page(offset, limit):
+        with lock:
+            in_flight.append(offset)
+            max_in_flight.append(len(in_flight))
+        # later pages answer faster, they still have to come out in order
+        time.sleep(0.01 * (total - offset) / total)
+        with lock:
+            in_flight.remove(offset)
+        return {'data': list(range(offset, min(offset + limit, total + 1)))}
+
+    pages = list(iter_pages(get_page, 1, limit=1000, prefetch=3))
+    assert [offset for offset, _ in pages] == [1, 1001, 2001]
+    assert sum(len(r['data']) for _, r in pages) == total
+    assert max(max_in_flight) <= 3
+
+
+def test_iter_pages_raises_failed_page():
+    def get_page(offset, limit):
+        if offset > 2000:
+            raise RuntimeError('offset is after the last record')
+        return {'data': [0] * limit}
+
+    pages = iter_pages(get_page, 1, limit=1000, prefetch=4, retries=0)
+    assert next(pages)[0] == 1
+    assert next(pages)[0] == 1001
+    with pytest.raises(RuntimeError):
+        next(pages)
+
+
+def test_iter_pages_retries_failed_requests():
+    failures = {1001: 2}
+
+    def get_page(offset, limit):
+        if failures.get(offset, 0) > 0:
+            failures[offset] -= 1
+            raise RuntimeError('filemaker is busy')
+        return {'data': [0] * (limit if offset < 2001 else 10)}
+
+    rate = RateController(step=0.001)
+    pages = list(iter_pages(get_page, 1, limit=1000, prefetch=2, rate=rate, retries=2))
+    assert [offset for offset, _ in pages] == [1, 1001, 2001]
+    assert rate.stats()['errors'] == 2
+
+
+def test_iter_pages_closes_streams_on_break():
+    class FakeResponse:
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    fetched = []
+    lock = threading.Lock()
+
+    def get_page(offset, limit):
+        response = FakeResponse()
+        with lock:
+            fetched.append(response)
+        return {'data': RecordStream(response)}
+
+    pages = iter_pages(get_page, 1, limit=1000, prefetch=3)
+    next(pages)
+    pages.close()
+    # the prefetched pages that arrive after the break are closed too
+    time.sleep(0.1)
+    assert len(fetched) > 1
+    assert all(r.closed for r in fetched)
+
+
+def test_rate_controller_adapts_delay():
+    rate = RateController(target_latency=1., step=0.5, max_delay=4.)
+    rate.record(0.1)
+    assert rate.delay == 0.
+    rate.record(2.)
+    assert rate.delay == 0.5
+    rate.record(0.1, error=True)
+    assert rate.delay == 1.
+    for _ in range(5):
+        rate.record(0.1, error=True)
+    assert rate.delay == 4.
+    rate.record(0.1)
+    assert rate.delay == 3.5
+    assert rate.stats()['errors'] == 6
+
+
+server = 'localhost'
+sessions_url = f"https://{server}/fmi/data/v1/databases/table/sessions"
+records_url = f"https://{server}/fmi/data/v1/databases/table/layouts/layout/records"
+
+
+def _login_response(token):
+    return {'response': {'token': token}, 'messages': [{'code': '0', 'message': 'OK'}]}
+
+
+@responses.activate
+def test_filemaker_reuses_token():
+    responses.add(method='POST', url=sessions_url, json=_login_response('t1'))
+    responses.add(method='GET', url=records_url, json={'response': {'data': []}})
+
+    fm = Filemaker(server, 'user', 'psw', 'table', 'layout')
+    for offset in [1, 1001, 2001]:
+        fm.get_all_records(offset)
+    assert fm.logins == 1
+
+    # renewed before filemaker expires it
+    fm._token_timestamp -= datetime.timedelta(minutes=15)
+    fm.get_all_records(1)
+    assert fm.logins == 2
+
+
+@responses.activate
+def test_filemaker_logs_in_again_on_401():
+    responses.add(method='POST', url=sessions_url, json=_login_response('t1'))
+    responses.add(method='POST', url=sessions_url, json=_login_response('t2'))
+    responses.add(method='GET', url=records_url, status=401,
+            json={'response': {}, 'messages': [{'code': '952', 'message': 'Invalid FileMaker Data API token (*)'}]})
+    responses.add(method='GET', url=records_url, json={'response': {'data': [1]}})
+
+    logout = responses.add(method='DELETE', url=f'{sessions_url}/t1', status=401,
+            json={'response': {}, 'messages': [{'code': '952', 'message': 'Invalid FileMaker Data API token (*)'}]})
+
+    fm = Filemaker(server, 'user', 'psw', 'table', 'layout')
+    assert fm.get_all_records(1) == {'data': [1]}
+    assert fm.logins == 2
+    assert responses.calls[-1].request.headers['Authorization'] == 'Bearer t2'
+    # the rejected session is logged out, a failure is ignored
+    assert logout.call_count == 1
+
+
+@responses.activate
+def test_filemaker_keeps_token_on_other_401():
+    responses.add(method='POST', url=sessions_url, json=_login_response('t1'))
+    responses.add(method='GET', url=records_url, status=401,
+            json={'response': {}, 'messages': [{'code': '212', 'message': 'Invalid user account and/or password'}]})
+
+    fm = Filemaker(server, 'user', 'psw', 'table', 'layout')
+    with pytest.raises(requests.HTTPError):
+        fm.get_all_records(1)
+    assert fm.logins == 1
+    assert fm._token == 't1'
+
+
+@responses.activate
+def test_filemaker_context_manager_logs_out():
+    responses.add(method='POST', url=sessions_url, json=_login_response('t1'))
+    responses.add(method='POST', url=records_url.replace('records', '_find'), json={'response': {'data': []}})
+    responses.add(method='DELETE', url=f'{sessions_url}/t1', json={'response': {}})
+
+    with Filemaker(server, 'user', 'psw', 'table', 'layout') as fm:
+        fm._post(records_url.replace('records', '_find'), '{"query": []}')
+
+    assert [c.request.method for c in responses.calls] == ['POST', 'POST', 'DELETE']
+    assert fm._token is None
+
+
+@responses.activate
+def test_filemaker_get_new_records_by_date():
+    find_url = records_url.replace('records', '_find')
+    responses.add(method='POST', url=sessions_url, json=_login_response('t1'))
+    responses.add(method='POST', url=find_url, json={'response': {'data': [1, 2]}})
+    responses.add(method='POST', url=find_url, status=500,
+            json={'response': {}, 'messages': [{'code': '401', 'message': 'No records match the request'}]})
+
+    fm = Filemaker(server, 'user', 'psw', 'table', 'layout')
+    assert fm.get_new_records_by_date(2, 3, 2023, examination_types=['RNA Sarkompanel'])['data'] == [1, 2]
+    body = json.loads(responses.calls[1].request.body)
+    assert body['query'] == [{'Zeitstempel': '>=3/2/2023', 'Untersuchung': '="RNA Sarkompanel"'}]
+    assert body['sort'] == [{'fieldName': 'Zeitstempel', 'sortOrder': 'ascend'}]
+
+    assert fm.get_new_records_by_date(2, 3, 2023, offset=1001) == {'data': []}
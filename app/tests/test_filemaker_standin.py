@@ -0,0 +1,46 @@
+import pytest
+
+from app.filemaker_api import Filemaker
+from app.filemaker_standin import FilemakerStandin, StandinServer, synthetic_record
+from app.benchmarks import bench_filemaker_sync
+
+
+def test_synthetic_records_are_deterministic():
+    assert synthetic_record(7, 100) == synthetic_record(7, 100)
+    assert synthetic_record(7, 100) != synthetic_record(7, 100, seed=1)
+    assert synthetic_record(7, 100)['recordId'] == '8'
+
+
+def test_filemaker_client_against_standin():
+    standin = FilemakerStandin(n=2500, patients=100)
+    with StandinServer(standin) as server:
+        with Filemaker(server.address, 'user', 'psw', standin.database, standin.layout, scheme='http') as fm:
+            pages = list(fm.iter_records(1, limit=1000))
+            assert [len(r['data']) for _, r in pages] == [1000, 1000, 500]
+            assert pages[1][1]['data'][0] == standin.record(1000)
+            assert fm.get_all_records(3001) == {'data': []}
+
+            streamed = [list(r['data']) for _, r in fm.iter_records(1, limit=1000, stream=True)]
+            assert streamed == [r['data'] for _, r in pages]
+
+            found = fm.get_new_records_by_date(1, 6, 2023, examination_types=['RNA Sarkompanel'])['data']
+            assert len(found) > 0
+            assert all(r['fieldData']['Untersuchung'] == 'RNA Sarkompanel' for r in found)
+            assert len(standin.tokens) == 1
+
+        assert fm.logins == 1
+        assert len(standin.tokens) == 0
+
+
+def test_standin_rejects_unknown_tokens():
+    client = FilemakerStandin(n=10).app().test_client()
+    res = client.get('/fmi/data/v1/databases/db/layouts/l/records', headers={'Authorization': 'Bearer nope'})
+    assert res.status_code == 401
+    assert res.get_json()['messages'][0]['code'] == '952'
+
+
+def test_bench_filemaker_sync_with_errors(memory_db):
+    results = bench_filemaker_sync(n=1200, patients=100, error_rate=0.1, prefetch=2)
+    # failed requests are retried, no record is lost
+    assert results['requests']['synced'] == 1200
+    assert results['sync']['docs_per_second'] > 0
@@ -0,0 +1,89 @@
+from copy import deepcopy
+
+from app import tasks_impl
+from app.benchmarks import StaticFilemaker, filemaker_records
+from app.fingerprints import FingerprintIndex, record_fingerprint, row_fingerprint
+
+
+def test_record_fingerprint_is_canonical():
+    a = {'Name': 'Muster', 'Mol_NR': 4000, 'Kürzel': 'E '}
+    b = {'Kürzel': 'E', 'Mol_NR': 4000.0, 'Name': 'Muster'}
+    assert record_fingerprint(a) == record_fingerprint(b)
+    assert record_fingerprint(a) != record_fingerprint(dict(a, Mol_NR=4001))
+
+    # the stored document has the same fingerprint as the record
+    doc = dict(a, _id='x', _rev='1-a', id='x', document_type='filemaker_record')
+    assert record_fingerprint(doc) == record_fingerprint(a)
+
+
+def test_fingerprint_index_persists_and_catches_up(memory_db, tmp_path):
+    path = str(tmp_path / 'fingerprints.idx')
+    records = filemaker_records(30, 10)
+    for r in records[:20]:
+        memory_db.save(tasks_impl.processor(deepcopy(r)))
+
+    index = FingerprintIndex.open(memory_db, path)
+    fingerprints = [tasks_impl.filemaker_row_fingerprint(r) for r in records]
+    assert len(index) == 20
+    assert all(f in index for f in fingerprints[:20])
+    assert not any(f in index for f in fingerprints[20:])
+
+    # another worker saves records, the file learns them from the changes
+    for r in records[20:]:
+        memory_db.save(tasks_impl.processor(deepcopy(r)))
+    index = FingerprintIndex.open(memory_db, path)
+    assert all(f in index for f in fingerprints)
+
+    # a deleted record is synced again after a rebuild
+    doc = memory_db.couchdb.get(tasks_impl.filemaker_record_doc_id(records[0]))
+    memory_db.couchdb.delete(doc)
+    index = FingerprintIndex.open(memory_db, path)
+    assert fingerprints[0] not in index
+    assert len(index) == 29
+
+
+def test_sync_dedupes_old_ids_without_couchdb_lookups(memory_db, monkeypatch):
+    monkeypatch.setattr(tasks_impl, 'DB', memory_db)
+    records = filemaker_records(30, 10)
+
+    count = memory_db.couchdb.config()['doc_count']
+    # synced before the recordId ids, with the old id
+    for r in records[:10]:
+        d = deepcopy(r)
+        doc = dict(d['fieldData'], id=f'filemaker_record_row_{tasks_impl.get_filemaker_id(d)}', document_type='filemaker_record')
+        memory_db.save(doc)
+
+    def exists_many(*args, **kwargs):
+        raise AssertionError('the fingerprint index answers without couchdb')
+    monkeypatch.setattr(memory_db, 'exists_many', exists_many)
+
+    index = FingerprintIndex.open(memory_db)
+    assert index.legacy_ids
+    tasks_impl.retrieve_new_filemaker_data_incremental(StaticFilemaker(deepcopy(records)), tasks_impl.processor, index)
+    assert memory_db.couchdb.config()['doc_count'] == count + 30
+
+
+def test_sync_keeps_rows_with_the_same_content(memory_db, monkeypatch):
+    monkeypatch.setattr(tasks_impl, 'DB', memory_db)
+    records = filemaker_records(3, 10)
+    # a row entered twice, the copy has its own recordId
+    records[1]['fieldData'] = deepcopy(records[0]['fieldData'])
+    assert row_fingerprint('1', 'x') != row_fingerprint('2', 'x')
+
+    index = FingerprintIndex.open(memory_db)
+    tasks_impl.retrieve_new_filemaker_data_incremental(StaticFilemaker(deepcopy(records)), tasks_impl.processor, index)
+    ids = [tasks_impl.filemaker_record_doc_id(r) for r in records]
+    assert memory_db.exists_many(ids) == set(ids)
+
+    # a changed row replaces its document, unchanged rows are skipped
+    records[2]['fieldData']['Befunder'] = 'Y'
+    records[2]['modId'] = '2'
+    app_state = memory_db.get('app_state')
+    app_state['last_synced_filemaker_row'] = 0
+    memory_db.save(app_state)
+    saved = []
+    save_bulk = memory_db.save_bulk
+    monkeypatch.setattr(memory_db, 'save_bulk', lambda docs, **kwargs: saved.extend(docs) or save_bulk(docs, **kwargs))
+    tasks_impl.retrieve_new_filemaker_data_incremental(StaticFilemaker(deepcopy(records)), tasks_impl.processor, index)
+    assert [d['_id'] for d in saved] == [ids[2]]
+    assert memory_db.get(ids[2])['Befunder'] == 'Y'
@@ -0,0 +1,52 @@
+import json
+import tracemalloc
+
+import pytest
+
+from app.json_stream import iter_json_array
+
+
+def _chunked(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+def test_iter_json_array_matches_json_loads():
+    doc = {
+        'response': {
+            'dataInfo': {'foundCount': 3, 'nested': [{'a': [1, 2]}, '}]'], 'x': -1.5e3},
+            'data': [{'n': 12345, 'ü': 'ä€', 'b': True, 'z': None}, 7, 'text, with ] and }', [], {}],
+            },
+        'messages': [{'code': '0', 'message': 'OK'}],
+        }
+    data = json.dumps(doc, ensure_ascii=False).encode('utf-8')
+    expected = doc['response']['data']
+
+    # chunk borders fall into numbers, strings and multi byte characters
+    for size in [1, 2, 3, 7, len(data)]:
+        assert list(iter_json_array(_chunked(data, size), ['response', 'data'])) == expected
+
+
+def test_iter_json_array_edge_cases():
+    assert list(iter_json_array([b'{"data": []}'], ['data'])) == []
+    assert list(iter_json_array([b' { "data" : [ 1 , 2 ] } '], ['data'])) == [1, 2]
+    with pytest.raises(KeyError):
+        list(iter_json_array([b'{"other": 1}'], ['data']))
+    with pytest.raises(ValueError):
+        list(iter_json_array([b'{"data": [1, 2'], ['data']))
+
+
+def test_iter_json_array_memory_is_bounded():
+    record = {f'Feld_{k}': f'wert {k}' * 5 for k in range(100)}
+    data = json.dumps({'response': {'data': [record] * 2000}}).encode('utf-8')
+    chunks = _chunked(data, 64*1024)
+
+    tracemalloc.start()
+    count = 0
+    for r in iter_json_array(iter(chunks), ['response', 'data']):
+        count += 1
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert count == 2000
+    # a few chunks and one record, not the whole page
+    assert peak < len(data) / 10
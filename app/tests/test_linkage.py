@@ -0,0 +1,89 @@
+from datetime import datetime
+
+from app.model import Patient
+from app.linkage import (normalize_name, cologne_phonetic, PatientFeatures, candidate_pairs,
+        find_duplicates, suggestion_id, suggest_patient_merges, merge_suggestions, review_merge_suggestion)
+
+
+def patient(pid, lastname, firstname, birthdate='1970-01-01', gender='W'):
+    return Patient(
+        id=pid,
+        names={'fullname': f'{firstname} {lastname}', 'firstname': firstname, 'lastname': lastname},
+        birthdate=datetime.fromisoformat(birthdate) if birthdate is not None else None,
+        gender=gender,
+        examinations=[f'exam_{pid}'],
+        )
+
+
+def test_normalize_name():
+    assert normalize_name('Müller-Lüdenscheidt') == 'mueller luedenscheidt'
+    assert normalize_name(' Renée  Groß ') == 'renee gross'
+    assert normalize_name(None) == ''
+
+
+def test_cologne_phonetic():
+    assert cologne_phonetic('mueller luedenscheidt') == '65752682'
+    assert cologne_phonetic('wikipedia') == '3412'
+    assert cologne_phonetic('breschnew') == '17863'
+    assert {cologne_phonetic(n) for n in ['meier', 'mayer', 'maier']} == {'67'}
+    assert cologne_phonetic('schmidt') == cologne_phonetic('schmitt')
+
+
+def test_find_duplicates():
+    patients = [
+        patient('a', 'Müller', 'Erika'),
+        patient('b', 'Mueller', 'Erika'),
+        patient('c', 'Muller', 'Erika'),
+        # birthdate typo
+        patient('d', 'Schmidt', 'Hans', '1950-03-04', 'M'),
+        patient('e', 'Schmidt', 'Hans', '1950-04-03', 'M'),
+        # married
+        patient('f', 'Meier', 'Anna', '1980-05-06'),
+        patient('g', 'Krause', 'Anna', '1980-05-06'),
+        # same name, other person
+        patient('h', 'Schmidt', 'Hans', '1991-11-12', 'M'),
+        # same birthdate and lastname, other firstname and gender
+        patient('i', 'Müller', 'Peter', '1970-01-01', 'M'),
+        ]
+    duplicates = find_duplicates(patients)
+    pairs = {(a, b) for a, b, _, _ in duplicates}
+    assert pairs == {('a', 'b'), ('a', 'c'), ('b', 'c'), ('d', 'e'), ('f', 'g')}
+
+    a, b, score, similarities = duplicates[0]
+    assert (a, b, score) == ('a', 'b', 1.)
+    assert similarities == {'lastname': 1., 'firstname': 1., 'birthdate': 1.}
+    assert [d[2] for d in duplicates] == sorted((d[2] for d in duplicates), reverse=True)
+
+
+def test_candidate_pairs_are_near_linear():
+    n = 2000
+    patients = [patient(f'p{k}', f'Name{k % 300}x{k}', f'Vorname{k % 7}', f'{1930 + k % 80}-{k % 12 + 1:02d}-{k % 28 + 1:02d}')
+            for k in range(n)]
+    features = PatientFeatures(patients)
+    i, j = candidate_pairs(features)
+    assert (i < j).all()
+    assert len(i) < 50 * n
+
+    # blocks over the limit are not compared
+    same = [patient(f's{k}', 'Schmidt', 'Hans', None) for k in range(20)]
+    i, j = candidate_pairs(PatientFeatures(same), max_block_size=10)
+    assert len(i) == 0
+
+
+def test_merge_suggestion_review(memory_db):
+    memory_db.save_bulk([
+        patient('a', 'Müller', 'Erika'),
+        patient('b', 'Mueller', 'Erika'),
+        patient('c', 'Krause', 'Peter', '1960-02-03', 'M'),
+        ])
+
+    new = suggest_patient_merges(memory_db)
+    assert [s.id for s in new] == [suggestion_id('b', 'a')]
+    assert new[0].patients == ['a', 'b']
+    assert [s.id for s in merge_suggestions(memory_db)] == [suggestion_id('a', 'b')]
+
+    review_merge_suggestion(memory_db, suggestion_id('a', 'b'), accept=False)
+    # a rejected pair isnt suggested again
+    assert suggest_patient_merges(memory_db) == []
+    assert merge_suggestions(memory_db) == []
+    assert [s.id for s in merge_suggestions(memory_db, 'rejected')] == [suggestion_id('a', 'b')]
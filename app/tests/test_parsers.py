@@ -1,6 +1,6 @@
 import pytest
 
-from app.parsers import parse_fastq_name, parse_miseq_run_name
+from app.parsers import parse_fastq_name, parse_miseq_run_name, birthdate_key
 
 
 def test_parse_fastq_name():
@@ -17,3 +17,9 @@ def test_parse_miseq_run_name():
     miseq_name_example = '220101_M01011_0111_000000000-A11A1'
     parse_miseq_run_name(miseq_name_example)
 
+
+
+def test_birthdate_key():
+    assert birthdate_key('1/2/1970') == birthdate_key('01/02/1970') == '1970-01-02'
+    assert birthdate_key('unbekannt') == 'unbekannt'
+    assert birthdate_key(None) is None
@@ -0,0 +1,61 @@
+import io
+import sys
+from datetime import datetime
+
+from app import pipeline_logs, workflow_backends
+from app.model import PipelineRun
+from app.pipeline_logs import LogAppender, read_log, log_chunks, split_utf8
+
+
+def test_split_utf8():
+    data = 'aä€b'.encode('utf-8')
+    pieces = split_utf8(data, 3)
+    assert b''.join(pieces) == data
+    assert [p.decode('utf-8') for p in pieces] == ['aä', '€', 'b']
+
+
+def test_log_appender_appends_chunks(memory_db, monkeypatch):
+    monkeypatch.setattr(pipeline_logs, 'LOG_CHUNK_BYTES', 8)
+    f = io.BytesIO()
+    appender = LogAppender(memory_db, 'run1', 'stdout', f)
+
+    f.write(b'hello world\n')
+    assert appender.poll() == 2
+    assert appender.poll() == 0
+
+    # the second half of a multi byte character isnt written yet
+    euro = '€'.encode('utf-8')
+    f.write(b'more ' + euro[:1])
+    appender.poll()
+    f.write(euro[1:] + b'\n')
+    appender.poll(final=True)
+
+    assert read_log(memory_db, 'run1', 'stdout') == 'hello world\nmore €\n'
+    assert appender.offset == len('hello world\nmore €\n'.encode('utf-8'))
+    assert read_log(memory_db, 'run1', 'stdout', start=6) == 'world\nmore €\n'
+    assert [c.offset for c in log_chunks(memory_db, 'run1', 'stdout', start=9)] == [8, 12, 17]
+    assert read_log(memory_db, 'run1', 'stderr') == ''
+
+
+def test_run_workflow_io_stores_logs(memory_db, monkeypatch):
+    monkeypatch.setattr(workflow_backends, 'db', memory_db)
+    monkeypatch.setattr(workflow_backends, 'config', {'workflow_output_dir': ''})
+    run = PipelineRun(
+            id='prun1',
+            created_time=datetime.now(),
+            input_samples=[],
+            workflow='test',
+            panel_type='invalid',
+            status='created',
+            logs={'stdout': '', 'stderr': ''},
+            )
+    memory_db.save(run)
+
+    cmd = [sys.executable, '-c', 'import sys; print("out"); print("err", file=sys.stderr)']
+    run = workflow_backends.run_workflow_io(cmd, run, lambda: False, poll_interval=0.01)
+
+    assert run.status == 'successful'
+    assert run.logs.stdout == 'out\n'
+    assert run.logs.stderr == 'err\n'
+    assert run.logs.stdout_bytes == 4
+    assert read_log(memory_db, 'prun1', 'stdout') == 'out\n'
@@ -0,0 +1,178 @@
+import os
+from pathlib import Path
+from datetime import datetime
+
+import pytest
+
+from app.config import Config
+from app.model import SequencerRun
+from app.sequencer_scan import (ScanIndex, SequencerWatcher, Inotify, scan_run,
+        IN_CREATE, IN_CLOSE_WRITE, IN_MOVED_TO, IN_ISDIR)
+
+
+RUN_NAME = '220101_M00000_0000_000000000-XXXXX'
+
+
+def make_run(root, name=RUN_NAME, samples=('2500-22', '2600-22')):
+    fastq_dir = Path(root) / name / 'Alignment_1' / '20220101_000000' / 'Fastq'
+    fastq_dir.mkdir(parents=True)
+    for s in samples:
+        for r in [1, 2]:
+            (fastq_dir / f'{s}_S1_L001_R{r}_001.fastq.gz').touch()
+    age(root)
+    return fastq_dir
+
+
+def age(root):
+    ''' set the folder mtimes into the past, so new entries change them '''
+    for dirpath, _, _ in os.walk(root):
+        os.utime(dirpath, ns=(10**18, 10**18))
+
+
+def test_scan_index(tmp_path):
+    fastq_dir = make_run(tmp_path / 'out')
+    run = tmp_path / 'out' / RUN_NAME
+    index = ScanIndex(str(tmp_path / 'scan.json'))
+    assert index.changed(run)
+
+    fastqs, signature = scan_run(run)
+    assert len(fastqs) == 4
+    index.update(run, fastqs, signature)
+    assert not index.changed(run)
+    # all folders of the run are part of the signature
+    assert len(index.runs[str(run)]['dirs']) == 4
+
+    index.save()
+    loaded = ScanIndex.load(index.path)
+    assert loaded.fastqs(run) == fastqs
+    assert not loaded.changed(run)
+
+    (fastq_dir / '2700-22_S1_L001_R1_001.fastq.gz').touch()
+    assert loaded.changed(run)
+
+    loaded.forget_missing([])
+    assert run not in loaded
+
+    (tmp_path / 'broken.json').write_text('{')
+    assert ScanIndex.load(str(tmp_path / 'broken.json')).runs == {}
+
+
+def test_fastqs_appear_after_the_first_scan(tmp_path):
+    run = tmp_path / 'out' / RUN_NAME
+    fastq_dir = run / 'Alignment_1' / '20220101_000000' / 'Fastq'
+    fastq_dir.mkdir(parents=True)
+    age(run)
+    index = ScanIndex()
+    index.update(run, *scan_run(run))
+    assert index.fastqs(run) == []
+    assert not index.changed(run)
+
+    # the sequencer writes the fastqs after the first scan
+    (fastq_dir / '2500-22_S1_L001_R1_001.fastq.gz').touch()
+    assert index.changed(run)
+    index.update(run, *scan_run(run))
+    age(run)
+    index.update(run, *scan_run(run))
+    assert not index.changed(run)
+
+    # a second analysis off the known path
+    other = run / 'Alignment_2' / '20220102_000000' / 'Fastq'
+    other.mkdir(parents=True)
+    assert index.changed(run)
+    age(run)
+    index.update(run, *scan_run(run))
+    (other / '2500-22_S1_L001_R2_001.fastq.gz').touch()
+    assert index.changed(run)
+    assert len(scan_run(run)[0]) == 2
+
+
+def test_poll_sequencer_output_walks_changed_runs(tmp_path, memory_db, monkeypatch):
+    from app import tasks_impl
+
+    out = tmp_path / 'out'
+    fastq_dir = make_run(out)
+    make_run(out, '220102_M00000_0001_000000000-YYYYY', samples=('2800-22',))
+
+    config = Config()
+    config.set(dev=True, overrides={
+        'miseq_output_folder': str(out),
+        'sequencer_scan_index': str(tmp_path / 'scan.json'),
+        })
+    monkeypatch.setattr(tasks_impl, 'CONFIG', config)
+    monkeypatch.setattr(tasks_impl, 'db', memory_db)
+
+    assert tasks_impl.poll_sequencer_output() == 2
+    runs = memory_db.query('sequencer_runs/all').values()
+    assert len(runs) == 2
+
+    # nothing changed, nothing is walked
+    assert tasks_impl.poll_sequencer_output() == 0
+
+    new_fastq = fastq_dir / '2900-22_S1_L001_R1_001.fastq.gz'
+    new_fastq.touch()
+    assert tasks_impl.poll_sequencer_output() == 1
+    run = memory_db.get(tasks_impl.sequencer_run_id(out / RUN_NAME))
+    assert new_fastq in run.outputs and len(run.outputs) == 5
+
+    # a run that was saved before the deterministic ids
+    legacy_run = out / '220103_M00000_0002_000000000-ZZZZZ'
+    make_run(out, legacy_run.name, samples=('3000-22',))
+    memory_db.save(SequencerRun(id='legacy_run', original_path=str(legacy_run), name_dirty='False',
+        parsed={}, state='successful', indexed_time=datetime.now(), outputs=scan_run(legacy_run)[0]))
+
+    # after losing the index the runs are compared with their documents,
+    # found by id and by a keyed path lookup, and not saved again
+    os.remove(tmp_path / 'scan.json')
+    query = memory_db.query
+    def keyed_query(name, **kwargs):
+        assert name != 'sequencer_runs/all' and 'keys' in kwargs
+        return query(name, **kwargs)
+    monkeypatch.setattr(memory_db, 'query', keyed_query)
+    def save_bulk(*args, **kwargs):
+        raise AssertionError('known runs are saved again')
+    monkeypatch.setattr(memory_db, 'save_bulk', save_bulk)
+    assert tasks_impl.poll_sequencer_output() == 3
+    assert tasks_impl.poll_sequencer_output() == 0
+
+
+def test_sequencer_watcher_events(tmp_path):
+    class FakeInotify:
+        def __init__(self):
+            self.watches = []
+
+        def add_watch(self, path, mask):
+            self.watches.append(str(path))
+            return len(self.watches)
+
+    root = tmp_path / 'out'
+    root.mkdir()
+    reported = []
+    watcher = SequencerWatcher(root, reported.extend, settle=5., inotify=FakeInotify())
+    watcher._watch(root)
+
+    run = root / RUN_NAME
+    fastq_dir = make_run(root)
+    watcher.handle([(1, IN_CREATE | IN_ISDIR, 0, RUN_NAME)], now=0.)
+    assert str(fastq_dir) in watcher.inotify.watches
+
+    fastq_wd = watcher.inotify.watches.index(str(fastq_dir)) + 1
+    watcher.handle([(fastq_wd, IN_CLOSE_WRITE, 0, '2500-22_S1_L001_R1_001.fastq.gz')], now=3.)
+    # other files dont delay the run
+    watcher.handle([(fastq_wd, IN_CLOSE_WRITE, 0, 'Log.txt')], now=7.)
+    assert watcher.settled(now=7.) == []
+    assert watcher.settled(now=8.) == [run]
+    assert watcher.pending == {}
+
+    # a finished run that is moved into the folder
+    watcher.handle([(1, IN_MOVED_TO | IN_ISDIR, 0, 'copied_run')], now=10.)
+    assert watcher.settled(now=15.) == [root / 'copied_run']
+
+
+@pytest.mark.skipif(not Path('/proc/sys/fs/inotify').exists(), reason='needs linux inotify')
+def test_inotify(tmp_path):
+    with Inotify() as inotify:
+        wd = inotify.add_watch(tmp_path, IN_CREATE | IN_CLOSE_WRITE)
+        (tmp_path / 'x.fastq.gz').write_bytes(b'data')
+        events = inotify.read(timeout=1.)
+    assert (wd, IN_CREATE, 0, 'x.fastq.gz') in events
+    assert (wd, IN_CLOSE_WRITE, 0, 'x.fastq.gz') in events
@@ -58,3 +58,22 @@ def test_start_panel_workflow(config):
     panel_type=None
     #start_panel_workflow(config, workflow_inputs, panel_type, sequencer_run_path)
 
+
+
+def test_warm_views_stops_at_timeout(monkeypatch):
+    from app import tasks
+
+    class IndexingDB:
+        checks = 0
+
+        def warm_views(self):
+            pass
+
+        def indexer_progress(self):
+            self.checks += 1
+            return [{'design_document': '_design/patients', 'progress': 10}]
+
+    idb = IndexingDB()
+    monkeypatch.setattr(tasks, 'db', idb)
+    tasks.warm_views(poll_interval=0.01, timeout=0.05)
+    assert 1 < idb.checks < 20
@@ -1,5 +1,8 @@
 
+import io
+import json
 import time
+from datetime import datetime
 from typing import Dict, Tuple
 import subprocess
 
@@ -12,6 +15,10 @@ from app.app import main
 from app.ui import create_app
 from app.tasks import start_pipeline
 from app.db import DB
+from app import ui
+from app.model import PipelineRun
+from app.pipeline_logs import LogAppender, follow_log
+from flask import Flask
 
 @pytest.fixture()
 def app(db, config):
@@ -32,3 +39,93 @@ def runner(app):
     return app.test_cli_runner()
 
 
+
+
+def _logged_run(mdb, status, text):
+    ''' a pipeline run whose stdout was stored by a LogAppender '''
+    f = io.BytesIO(text.encode('utf-8'))
+    appender = LogAppender(mdb, 'prun1', 'stdout', f)
+    appender.poll(final=True)
+    run = PipelineRun(
+            id='prun1',
+            created_time=datetime.now(),
+            input_samples=[],
+            workflow='test',
+            panel_type='invalid',
+            status=status,
+            logs={'stdout': '', 'stderr': ''},
+            )
+    appender.update_logs(run.logs)
+    mdb.save(run)
+    return run
+
+
+@pytest.fixture()
+def memory_client(memory_db, monkeypatch):
+    ''' the ui on the in-process couchdb stand-in '''
+    monkeypatch.setattr(ui, 'db', memory_db)
+    monkeypatch.setattr(ui, 'LOG_STREAM_POLL_INTERVAL', 0.01)
+    monkeypatch.setattr(ui, 'LOG_STREAM_TIMEOUT', 0.05)
+    app = Flask(__name__)
+    app.register_blueprint(ui.admin)
+    return app.test_client()
+
+
+def _events(res):
+    events = []
+    for block in res.get_data(as_text=True).split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n') if ': ' in line and not line.startswith(':'))
+        if 'data' in fields:
+            events.append(fields)
+    return events
+
+
+def test_pipeline_log_stream(memory_db, memory_client):
+    _logged_run(memory_db, 'successful', 'line 1\nline 2\n')
+
+    res = memory_client.get('/pipeline_logs/prun1/stdout')
+    assert res.mimetype == 'text/event-stream'
+    events = _events(res)
+    assert json.loads(events[0]['data']) == {'stream': 'stdout', 'offset': 14, 'text': 'line 1\nline 2\n'}
+    assert events[-1]['event'] == 'end'
+
+    # a reconnecting browser only gets the data after its last event
+    events = _events(memory_client.get('/pipeline_logs/prun1/stdout', headers={'Last-Event-ID': '7'}))
+    assert json.loads(events[0]['data'])['text'] == 'line 2\n'
+
+    events = _events(memory_client.get('/pipeline_logs/prun1/stdout?offset=14'))
+    assert [e.get('event') for e in events] == ['end']
+
+    assert memory_client.get('/pipeline_logs/prun1/other').status_code == 404
+    assert memory_client.get('/pipeline_logs/missing/stdout').status_code == 404
+    assert memory_client.get('/pipeline_logs/prun1/stdout?offset=x').status_code == 400
+
+
+def test_pipeline_log_stream_running(memory_db, memory_client):
+    _logged_run(memory_db, 'running', 'started\n')
+
+    body = memory_client.get('/pipeline_logs/prun1/stdout?offset=8').get_data(as_text=True)
+    # nothing new until the timeout, the browser reconnects afterwards
+    assert ': keepalive' in body
+    assert 'event: end' not in body
+
+
+def test_follow_log_waits_for_new_data(memory_db):
+    f = io.BytesIO()
+    appender = LogAppender(memory_db, 'prun1', 'stdout', f)
+    _logged_run(memory_db, 'running', '')
+
+    def write(text, status):
+        f.seek(0, io.SEEK_END)
+        f.write(text.encode('utf-8'))
+        appender.poll(final=True)
+        latest = memory_db.get('prun1')
+        appender.update_logs(latest.logs)
+        memory_db.save(latest.model_copy(update={'status': status}))
+
+    write('a\n', 'running')
+    # the pipeline writes more and finishes while the follower sleeps
+    sleep = lambda seconds: write('b\n', 'successful')
+
+    pieces = list(follow_log(memory_db, 'prun1', 'stdout', poll_interval=0, sleep=sleep))
+    assert pieces == [(2, 'a\n'), (4, 'b\n')]